@@ -0,0 +1,127 @@
+"""
+Кеш carnival в папке проекта
+
+Используется для данных, которые дорого вычислять на каждом запуске, например хешей файлов.
+Папку можно безопасно удалить, она будет создана заново, и ее не нужно хранить в git.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+import typing
+
+
+carnival_cache_dir = os.getenv("CARNIVAL_CACHE_DIR", ".carnival_cache")
+"""
+Путь до папки кеша, по умолчанию `.carnival_cache` в текущей папке проекта,
+можно изменить через переменную окружения `CARNIVAL_CACHE_DIR`
+"""
+
+
+def get_cache_dir(*subdirs: str) -> str:
+    """
+    Получить путь до папки внутри кеша, создав ее если нужно
+    """
+    path = os.path.abspath(os.path.join(carnival_cache_dir, *subdirs))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _file_sha1(path: str, bufsize: int = 1024 * 1024) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(bufsize)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class FileHashCache:
+    """
+    Постоянный кеш sha1 локальных файлов
+
+    Хеш привязан к (путь, размер, mtime_ns, inode, ctime_ns) и пересчитывается только когда файл изменился.
+    ctime меняется при любой записи и не может быть выставлен вручную, в отличие от mtime
+    """
+
+    save_interval = 1.0
+    """
+    Как часто сохранять кеш на диск, в секундах.
+    Несохраненные изменения нужно сохранить через :py:meth:`flush`, общий кеш сохраняется при выходе
+    """
+
+    def __init__(self, filename: str = "file_hashes.json") -> None:
+        self.filename = filename
+        self._entries: typing.Optional[typing.Dict[str, typing.List[typing.Any]]] = None
+        self._lock = threading.Lock()
+        self._path_locks: typing.Dict[str, threading.Lock] = {}
+        self._is_dirty = False
+        self._saved_at = 0.0
+
+    def _cache_path(self) -> str:
+        return os.path.join(get_cache_dir(), self.filename)
+
+    def _load(self) -> typing.Dict[str, typing.List[typing.Any]]:
+        if self._entries is None:
+            try:
+                with open(self._cache_path(), 'r') as fp:
+                    self._entries = json.load(fp)
+            except (OSError, ValueError):
+                self._entries = {}
+        assert self._entries is not None
+        return self._entries
+
+    def flush(self) -> None:
+        """
+        Сохранить несохраненные изменения на диск
+        """
+        with self._lock:
+            if self._is_dirty:
+                self._save()
+
+    def _save(self) -> None:
+        self._is_dirty = False
+        self._saved_at = time.monotonic()
+        cache_path = self._cache_path()
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump(self._entries, fp)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Cache is optimization only
+            pass
+
+    def sha1(self, path: str) -> str:
+        """
+        Получить sha1 файла, посчитав его только если файл изменился с прошлого раза
+        """
+        path = os.path.realpath(path)
+        with self._lock:
+            path_lock = self._path_locks.setdefault(path, threading.Lock())
+
+        with path_lock:
+            stat = os.stat(path)
+            key = [stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_ctime_ns]
+
+            with self._lock:
+                entry = self._load().get(path)
+            if entry is not None and entry[:4] == key:
+                return str(entry[4])
+
+            digest = _file_sha1(path)
+            with self._lock:
+                self._load()[path] = [*key, digest]
+                self._is_dirty = True
+                if time.monotonic() - self._saved_at >= self.save_interval:
+                    self._save()
+            return digest
+
+
+file_hash_cache = FileHashCache()
+atexit.register(file_hash_cache.flush)
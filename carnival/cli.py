@@ -8,6 +8,8 @@ import colorama  # type: ignore
 from colorama import Fore, Style
 
 from carnival.tasks_loader import get_tasks
+from carnival.task import validate_tasks
+from carnival.hosts.ssh import connection_pool
 
 if typing.TYPE_CHECKING:
     from carnival.task import TaskBase
@@ -35,6 +37,7 @@ def main() -> int:
         >>> --server       Limit run on server addr
         >>> --debug        Turn on debug mode
         >>> --no_validate  Disable step validation
+        >>> --forks N      Run tasks on N hosts in parallel
         >>> --help         Show this message and exit.
     """
     global task_types
@@ -56,10 +59,13 @@ def main() -> int:
                   type=click.Choice(list(discovered_hosts)), multiple=True)
     @click.option('--debug', is_flag=True, default=False, help="Turn on debug mode")
     @click.option('--no-validate', is_flag=True, default=False, help="Disable step validation")
+    @click.option('--forks', type=click.IntRange(min=1), default=1, show_default=True,
+                  help="Run tasks on N hosts in parallel")
     @click.argument('tasks', required=True, type=click.Choice(list(task_types.keys())), nargs=-1)
     def cli(
         debug: bool,
         no_validate: bool,
+        forks: int,
         server: typing.List[str],
         tasks: typing.Iterable[str],
     ) -> int:
@@ -73,21 +79,18 @@ def main() -> int:
         if no_validate:
             print(f"Step validation {Style.BRIGHT}{Fore.YELLOW}OFF{Fore.RESET}{Style.RESET_ALL}")
 
-        # Build chain and validate
-        has_errors = False
-        task_chain: typing.List["TaskBase"] = []
-        for task_class_str in tasks:
-            task = task_types[task_class_str](no_validate=no_validate, servers=server)
-            is_valid = task.validate()
-            if is_valid is False:
-                has_errors = True
-            task_chain.append(task)
-        if has_errors:
-            return 1
-
-        # Run
-        for task in task_chain:
-            task.run()
-        return 0
+        # Validation and all tasks of the chain share connections
+        with connection_pool.keep_open():
+            # Build chain and validate
+            task_chain: typing.List["TaskBase"] = []
+            for task_class_str in tasks:
+                task_chain.append(task_types[task_class_str](no_validate=no_validate, servers=server, forks=forks))
+            if not validate_tasks(task_chain, forks=forks):
+                return 1
+
+            # Run
+            for task in task_chain:
+                task.run()
+            return 0
 
     return cli(complete_var=complete_var)  # type: ignore
@@ -0,0 +1,118 @@
+"""
+Планировщик раздачи одного файла на много хостов: хосты, уже получившие файл, раздают его следующим
+"""
+
+import threading
+import typing
+
+from carnival import SshHost
+
+
+class Swarm:
+    """
+    Источники одного файла
+
+    Хост берет источник через :py:meth:`acquire`: свободный хост, уже получивший файл,
+    либо заливку с локальной машины, если таких заливок было меньше `seeds`.
+    Если свободных источников нет - ждет, пока освободится или появится новый.
+    Каждый получивший файл хост становится источником, так что число источников растет экспоненциально
+    """
+
+    def __init__(self, seeds: int, fanout: int) -> None:
+        """
+        :param seeds: сколько хостов заливаются с локальной машины
+        :param fanout: сколько хостов одновременно скачивают с одного источника
+        """
+        self.seeds = seeds
+        self.fanout = fanout
+
+        self._cond = threading.Condition()
+        self._peers: typing.Dict[SshHost, int] = {}
+        self._leaving: typing.Set[SshHost] = set()
+        self._local_uploads = 0
+        self._active_local_uploads = 0
+
+    def acquire(self, peers: bool = True) -> typing.Optional[SshHost]:
+        """
+        Дождаться свободного источника
+
+        :param peers: можно ли качать с других хостов.
+            `False` - залить с локальной машины, как только будет меньше `seeds` одновременных заливок
+        :return: хост-источник, или `None` если нужно заливать с локальной машины
+        """
+        with self._cond:
+            while True:
+                serving = [x for x in self._peers if x not in self._leaving]
+                if peers:
+                    for peer in serving:
+                        if self._peers[peer] < self.fanout:
+                            self._peers[peer] += 1
+                            return peer
+
+                # All peers are gone, new peers can only come from local uploads
+                is_peers_expected = peers and bool(serving)
+                if (self._local_uploads if is_peers_expected else self._active_local_uploads) < self.seeds:
+                    self._local_uploads += 1
+                    self._active_local_uploads += 1
+                    return None
+
+                self._cond.wait()
+
+    def release(self, source: typing.Optional[SshHost], ok: bool = True) -> None:
+        """
+        Освободить источник, полученный через :py:meth:`acquire`
+
+        :param ok: файл получен. Если нет, заливка с локальной машины не считается,
+            а хост-источник больше не используется
+        """
+        with self._cond:
+            if source is None:
+                self._active_local_uploads -= 1
+                if not ok:
+                    self._local_uploads -= 1
+            elif source in self._peers:
+                self._peers[source] -= 1
+                if not ok:
+                    del self._peers[source]
+                    self._leaving.discard(source)
+            self._cond.notify_all()
+
+    def add_peer(self, host: SshHost) -> None:
+        """
+        Хост получил файл и может раздавать его
+        """
+        with self._cond:
+            self._peers.setdefault(host, 0)
+            self._cond.notify_all()
+
+    def remove_peer(self, host: SshHost) -> None:
+        """
+        Хост больше не раздает файл, например файл будет удален.
+        Ждет, пока закончатся уже начатые скачивания с этого хоста
+        """
+        with self._cond:
+            if host not in self._peers:
+                return
+
+            self._leaving.add(host)
+            self._cond.notify_all()
+            while self._peers.get(host, 0) > 0:
+                self._cond.wait()
+            self._peers.pop(host, None)
+            self._leaving.discard(host)
+            self._cond.notify_all()
+
+
+__swarms_lock = threading.Lock()
+__swarms: typing.Dict[typing.Tuple[str, str], Swarm] = {}
+
+
+def get_swarm(digest: str, remote_path: str, seeds: int, fanout: int) -> Swarm:
+    """
+    Получить общий для всех хостов процесса планировщик файла с sha1 `digest` по пути `remote_path`
+    """
+    with __swarms_lock:
+        key = (digest, remote_path)
+        if key not in __swarms:
+            __swarms[key] = Swarm(seeds=seeds, fanout=fanout)
+        return __swarms[key]
@@ -100,11 +100,15 @@ class UploadImageFile(Step):
         dest_dir: str = '/tmp/',
         rm_after_load: bool = False,
         rsync_opts: typing.Optional[str] = None,
+        distribute: bool = False,
+        peer_forward_agent: bool = False,
     ):
         """
         :param docker_image_path: tar-образ docker
         :param dest_dir: папка куда заливать
         :param rm_after_load: удалить образ после загрузки
+        :param distribute: раздавать образ между хостами вместо rsync, см :py:class:`transfer.PutFile`
+        :param peer_forward_agent: пробросить локальный ssh-agent для раздачи, см :py:class:`transfer.PutFile`
         """
         if not dest_dir.endswith("/"):
             dest_dir += "/"
@@ -113,12 +117,23 @@ class UploadImageFile(Step):
         self.dest_dir = dest_dir
         self.rm_after_load = rm_after_load
         self.rsync_opts = rsync_opts
-
-        self.rsync_step = transfer.Rsync(
-            src_dir_or_file=self.docker_image_path,
-            dst_dir=self.dest_dir,
-            rsync_opts=self.rsync_opts
-        )
+        self.distribute = distribute
+        self.peer_forward_agent = peer_forward_agent
+
+        self.transfer_step: typing.Union[transfer.PutFile, transfer.Rsync]
+        if self.distribute:
+            self.transfer_step = transfer.PutFile(
+                local_path=self.docker_image_path,
+                remote_path=self.dest_dir + os.path.basename(self.docker_image_path),
+                distribute=True,
+                peer_forward_agent=self.peer_forward_agent,
+            )
+        else:
+            self.transfer_step = transfer.Rsync(
+                src_dir_or_file=self.docker_image_path,
+                dst_dir=self.dest_dir,
+                rsync_opts=self.rsync_opts
+            )
 
     def get_name(self) -> str:
         return f"{super().get_name()}(src={self.docker_image_path}, dst={self.dest_dir})"
@@ -127,14 +142,17 @@ class UploadImageFile(Step):
         return [
             validators.CommandRequiredValidator("systemctl"),
             validators.CommandRequiredValidator("docker"),
-            *self.rsync_step.get_validators(),
+            *self.transfer_step.get_validators(),
         ]
 
     def run(self, c: Connection) -> None:
         image_file_name = os.path.basename(self.docker_image_path)
         systemd.Start("docker").run(c=c)
-        self.rsync_step.run(c)
+        self.transfer_step.run(c)
         c.run(f"cd {self.dest_dir}; docker load -i {image_file_name}")
 
         if self.rm_after_load:
+            if isinstance(self.transfer_step, transfer.PutFile):
+                # Hosts that are downloading the image from this host must finish first
+                self.transfer_step.stop_serving(c)
             c.run(f"rm -rf {self.dest_dir}{image_file_name}")
@@ -25,12 +25,14 @@ class UploadService(Step):
         template_context: typing.Dict[str, typing.Any],
 
         static_files: typing.Iterable[typing.Union[str, typing.Tuple[str, str]]] = (),
+        fsync: bool = False,
     ):
         """
         :param app_dir: Путь до папки назначения
         :param static_files: Список файлов. Может быть списком файлов или кортежей (src, dst)
         :param template_files: Список jinja2-шаблонов. Может быть списком файлов или кортежей (src, dst)
         :param template_context: Контекст шаблонов, один на все шаблоны
+        :param fsync: сбросить файлы на диск перед атомарным переименованием
         """
         self.app_dir = app_dir
 
@@ -60,17 +62,19 @@ class UploadService(Step):
 
         self.template_context = template_context
 
-        self.transfer_chain: typing.List[Step] = []
+        self.transfer_chain: typing.List[typing.Union[transfer.PutFile, transfer.PutTemplate]] = []
         for file_path, dest_fname in self.static_files:
             self.transfer_chain.append(transfer.PutFile(
                 local_path=file_path,
                 remote_path=os.path.join(self.app_dir, dest_fname),
+                fsync=fsync,
             ))
         for template_path, dest_fname in self.template_files:
             self.transfer_chain.append(transfer.PutTemplate(
                 template_path=template_path,
                 remote_path=os.path.join(self.app_dir, dest_fname),
                 context=self.template_context,
+                fsync=fsync,
             ))
 
     def get_name(self) -> str:
@@ -88,8 +92,16 @@ class UploadService(Step):
 
         c.run(f"mkdir -p {self.app_dir}")
 
-        for transfer_step in self.transfer_chain:
-            transfer_step.run(c)
+        # Upload all files first and then rename them together,
+        # so docker-compose never sees half-updated service directory
+        staged_files: typing.List[transfer.StagedFile] = []
+        try:
+            for transfer_step in self.transfer_chain:
+                staged_files.extend(transfer_step.stage(c))
+        except BaseException:
+            transfer.discard_files(c, staged_files)
+            raise
+        transfer.commit_files(c, staged_files)
 
         c.run("docker-compose rm -f", cwd=self.app_dir, hide=True)
 
@@ -267,7 +279,9 @@ class Logs(Step):
         ]
 
     def run(self, c: Connection) -> typing.Any:
-        c.run(f"docker-compose logs -f --tail={self.tail}", cwd=self.app_dir, hide=False)
+        with c.stream(f"docker-compose logs -f --tail={self.tail}", cwd=self.app_dir) as lines:
+            for line in lines:
+                print(line, flush=True)
 
 
 class LogsServices(Step):
@@ -298,7 +312,9 @@ class LogsServices(Step):
         ]
 
     def run(self, c: Connection) -> typing.Any:
-        c.run(f"docker-compose logs -f --tail={self.tail} {self.services}", cwd=self.app_dir, hide=False)
+        with c.stream(f"docker-compose logs -f --tail={self.tail} {self.services}", cwd=self.app_dir) as lines:
+            for line in lines:
+                print(line, flush=True)
 
 
 class WaitHealthy(Step):
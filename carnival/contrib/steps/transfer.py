@@ -1,79 +1,871 @@
+import itertools
+import mmap
 import os.path
+import shlex
+import struct
+import tarfile
+import threading
+import time
 import typing
-from io import BytesIO
+import zlib
+from dataclasses import dataclass
 from hashlib import sha1
 from uuid import uuid4
 
 from tqdm import tqdm  # type: ignore
 from paramiko.config import SSH_PORT
 
-from carnival import Connection, localhost_connection, SshHost
-from carnival.templates import render
-from carnival.steps import shortcuts, Step, validators
+from carnival import Connection, Host, localhost_connection, SshHost
+from carnival.cache import file_hash_cache
+from carnival.hosts.base.result import CommandError
+from carnival.hosts.ssh import SshConnection
+from carnival.templates import render_stream
+from carnival.steps import Step, validators
+from carnival.utils import run_parallel
 
+from ._swarm import get_swarm
 
-def _file_sha1sum(c: Connection, fpath: str) -> typing.Optional[str]:
-    if not shortcuts.is_file(c, fpath):
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+
+DEFAULT_BUFSIZE = 1024 * 1024
+"""
+Размер блока передачи файлов по умолчанию
+"""
+
+_COMMAND_TIMEOUT = 3600
+
+remote_objects_dir = os.getenv("CARNIVAL_REMOTE_OBJECTS_DIR")
+"""
+Папка хранилища файлов по содержимому на серверах, например `/var/cache/carnival/objects`,
+задается переменной окружения `CARNIVAL_REMOTE_OBJECTS_DIR`. По умолчанию выключено.
+
+Залитые :py:class:`PutFile` и :py:class:`PutTemplate` файлы копируются в хранилище под своим sha1.
+Если файл с таким содержимым уже есть в хранилище хоста, он копируется на место назначения на самом хосте,
+а не передается по сети еще раз.
+Копирование использует reflink там, где файловая система его поддерживает
+"""
+
+
+def _read_chunks(reader: typing.IO[bytes], bufsize: int) -> typing.Iterator[bytes]:
+    while True:
+        data = reader.read(bufsize)
+        if len(data) == 0:
+            break
+        yield data
+
+
+def _local_file_chunks(path: str, bufsize: int, offset: int = 0) -> typing.Iterator[bytes]:
+    """
+    Читать локальный файл через mmap, без промежуточных копий в буферы файла
+    """
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            # empty file cannot be mapped
+            return
+
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for chunk_offset in range(offset, len(mm), bufsize):
+                yield mm[chunk_offset:chunk_offset + bufsize]
+
+
+def _remote_file_chunks(c: Connection, path: str, bufsize: int, offset: int = 0) -> typing.Iterator[bytes]:
+    with c.file_read(path, offset=offset) as reader:
+        yield from _read_chunks(reader, bufsize)
+
+
+def _local_file_prefix_sha1(path: str, size: int) -> str:
+    digest = sha1()
+    for chunk in _local_file_chunks(path, DEFAULT_BUFSIZE):
+        digest.update(chunk[:size])
+        size -= len(chunk)
+        if size <= 0:
+            break
+    return digest.hexdigest()
+
+
+def _remote_file_prefix_sha1(c: Connection, path: str, size: int) -> str:
+    return c.run(
+        f'head -c {size} "$(echo {path})" | (sha1sum 2>/dev/null || shasum -a1) | cut -d" " -f1',
+        hide=True,
+        timeout=_COMMAND_TIMEOUT,
+    ).stdout
+
+
+@dataclass
+class _FileInfo:
+    user_id: int
+    group_id: int
+    exists: bool
+    size: typing.Optional[int] = None
+    mtime: typing.Optional[int] = None
+    sha1: typing.Optional[str] = None
+    object_exists: bool = False
+
+
+def _get_file_info(
+    c: Connection,
+    path: str,
+    hash_if_size: typing.Optional[int],
+    object_path: typing.Optional[str] = None,
+) -> _FileInfo:
+    """
+    Получить за одну команду id пользователя и группы соединения,
+    существование, размер, mtime и sha1 файла
+
+    :param hash_if_size: считать sha1 только если размер файла совпадает, не считать если `None`
+    :param object_path: заодно проверить наличие файла в хранилище, см :py:data:`remote_objects_dir`
+    """
+    hash_size = "" if hash_if_size is None else str(hash_if_size)
+    object_check = "0" if object_path is None else f'$([ -f "{object_path}" ] && echo 1 || echo 0)'
+    command = "; ".join([
+        f'f="$(echo {path})"',
+        f'u="$(id -u) $(id -g) {object_check}"',
+        'if [ -f "$f" ]',
+        "then set -- $(stat -c '%s %Y' \"$f\" 2>/dev/null || stat -f '%z %m' \"$f\")",
+        'h=-',
+        f'if [ "$1" = "{hash_size}" ]',
+        'then h=$( (sha1sum "$f" 2>/dev/null || shasum -a1 "$f") | cut -d" " -f1)',
+        'fi',
+        'echo "$u 1 $1 $2 $h"',
+        'else echo "$u 0"',
+        'fi',
+    ])
+    fields = c.run(command, hide=True).stdout.strip().split("\n")[-1].split()
+
+    info = _FileInfo(
+        user_id=int(fields[0]),
+        group_id=int(fields[1]),
+        object_exists=fields[2] == "1",
+        exists=fields[3] == "1",
+    )
+    if info.exists:
+        info.size = int(fields[4])
+        info.mtime = int(fields[5])
+        if fields[6] != "-":
+            info.sha1 = fields[6]
+    return info
+
+
+def _get_object_path(digest: str) -> typing.Optional[str]:
+    if remote_objects_dir is None:
+        return None
+    return os.path.join(remote_objects_dir, digest[:2], digest)
+
+
+@dataclass
+class StagedFile:
+    """
+    Файл, залитый во временный файл рядом с местом назначения, но еще не переименованный
+    """
+    upload_path: str
+    staging_path: str
+    dst_path: str
+    owner: typing.Tuple[int, int]
+    chmod: typing.Optional[str] = None
+    fsync: bool = False
+    object_path: typing.Optional[str] = None
+    """
+    Скопировать файл в хранилище при переименовании, см :py:data:`remote_objects_dir`
+    """
+
+
+def _get_staging_path(dst_path: str) -> str:
+    dirname, basename = os.path.split(dst_path)
+    return os.path.join(dirname, f".{basename}.carnival.{uuid4().hex}.tmp")
+
+
+_COMPRESSION_MIN_SIZE = 256 * 1024
+_COMPRESSION_PROBE_SIZE = 256 * 1024
+
+_link_rates: typing.Dict[Host, float] = {}
+"""
+Измеренная скорость передачи на хост, байт в секунду, по уже переданным файлам
+"""
+_zstd_hosts: typing.Dict[Host, bool] = {}
+
+
+def _get_compression(c: Connection, sample: bytes, size: int) -> typing.Optional[str]:
+    """
+    Выбрать сжатие потока для файла по сжимаемости первого блока и скорости канала до хоста
+
+    zstd используется, если установлен пакет `zstandard`, а на хосте есть команда `zstd`
+
+    :return: `gzip`, `zstd` или `None`, если сжатие не ускорит передачу
+    """
+    if not isinstance(c.host, SshHost) or c.host.connect_config.compression:
         return None
-    return c.run(f"cat {fpath} | shasum -a1", hide=True).stdout.strip(" -\t\n")
+    if size < _COMPRESSION_MIN_SIZE or not sample:
+        return None
+
+    probe = sample[:_COMPRESSION_PROBE_SIZE]
+    started_at = time.monotonic()
+    ratio = len(zlib.compress(probe, 1)) / len(probe)
+    compress_rate = len(probe) / max(time.monotonic() - started_at, 0.000001)
+    if ratio > 0.9:
+        return None
+
+    link_rate = _link_rates.get(c.host)
+    if link_rate is None:
+        # Link speed is unknown until first transfer, compress only well compressible data
+        if ratio > 0.5:
+            return None
+    elif max(1 / compress_rate, ratio / link_rate) > 0.8 / link_rate:
+        # Compressed stream is as slow as the slowest of compression and sending compressed data
+        return None
+
+    if zstandard is not None:
+        if c.host not in _zstd_hosts:
+            _zstd_hosts[c.host] = c.run("command -v zstd", hide=True, warn=True).ok
+        if _zstd_hosts[c.host]:
+            return "zstd"
+    return "gzip"
+
+
+def _get_compressor(compression: str) -> typing.Any:
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    # wbits=31 writes gzip header
+    return zlib.compressobj(1, zlib.DEFLATED, 31)
+
+
+def _get_decompressor(compression: str) -> typing.Any:
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    # wbits=31 reads gzip header
+    return zlib.decompressobj(31)
+
+
+def _remote_compressed_chunks(
+    c: Connection, path: str, compression: str, bufsize: int, offset: int = 0,
+    on_read: typing.Optional[typing.Callable[[int], None]] = None,
+) -> typing.Iterator[bytes]:
+    """
+    Читать файл на хосте сжатым потоком `compression` и распаковывать локально
+
+    :param on_read: вызывается с размером каждого полученного сжатого блока
+    """
+    promise = c.run_promise(
+        f'tail -c +{offset + 1} "$(echo {path})" | {compression} -c -1',
+        use_sudo=False,
+        timeout=_COMMAND_TIMEOUT,
+        pty=False,
+    )
+    promise.close_stdin()
+    decompressor = _get_decompressor(compression)
+    for packed in _read_chunks(promise.stdout, bufsize):
+        if on_read is not None:
+            on_read(len(packed))
+        data = decompressor.decompress(packed)
+        if data:
+            yield data
+    if compression != "zstd":
+        yield decompressor.flush()
+    promise.get_result(hide=True).check_result(warn=False, hide=True)
+
+
+def _get_partial_path(dst_path: str, source_key: str) -> typing.Tuple[str, str]:
+    """
+    Путь до недокачанного файла, одинаковый при повторных запусках для одного источника
+
+    :return: путь и glob-шаблон недокачанных файлов места назначения от других версий источника
+    """
+    dirname, basename = os.path.split(dst_path)
+    prefix = f".{basename}.carnival."
+    return os.path.join(dirname, f"{prefix}{source_key}.part"), f'"{os.path.join(dirname, prefix)}"*.part'
+
+
+def _get_partial_info(c: Connection, partial_path: str, partial_glob: str) -> typing.Tuple[int, str]:
+    """
+    Удалить недокачанные файлы от других версий источника и получить размер и sha1 текущего
+
+    :return: размер и sha1, `(0, "")` если файла нет
+    """
+    command = "; ".join([
+        f'p="{partial_path}"',
+        f'for f in {partial_glob}',
+        'do [ "$f" = "$p" ] || rm -f "$f"',
+        'done',
+        'if [ -f "$p" ]',
+        "then s=$(stat -c '%s' \"$p\" 2>/dev/null || stat -f '%z' \"$p\")",
+        'h=$( (sha1sum "$p" 2>/dev/null || shasum -a1 "$p") | cut -d" " -f1)',
+        'echo "$s $h"',
+        'fi',
+    ])
+    output = c.run(command, hide=True, timeout=_COMMAND_TIMEOUT).stdout
+    if not output:
+        return 0, ""
+    size, digest = output.split()
+    return int(size), digest
+
+
+_RANGES_MIN_SIZE = 64 * 1024 * 1024
+
+
+def _transfer_ranges(
+    reader_conn: Connection,
+    reader_path: str,
+    writer_conn: Connection,
+    writer_path: str,
+    offset: int,
+    size: int,
+    channels: int,
+    bufsize: int,
+    pbar: tqdm,
+) -> None:
+    """
+    Передать байты файла с `offset` до `size` несколькими диапазонами одновременно, каждый через свою SFTP-сессию
+
+    Одна SFTP-сессия упирается в окно ssh-канала на каналах с большой задержкой.
+    Соединения хостов берутся из пула, так что все сессии идут через одно ssh-соединение
+    """
+    # Create file once, range writers must not truncate each other
+    with writer_conn.file_write(writer_path, offset=offset or None):
+        pass
+
+    range_size = -(-(size - offset) // channels)
+    ranges = [(start, min(start + range_size, size)) for start in range(offset, size, range_size)]
+    pbar_lock = threading.Lock()
+
+    def transfer_range(file_range: typing.Tuple[int, int]) -> None:
+        start, end = file_range
+        with reader_conn.host.connect() as range_reader_conn, writer_conn.host.connect() as range_writer_conn:
+            with range_reader_conn.file_read(reader_path, offset=start, size=end - start) as reader:
+                with range_writer_conn.file_write(writer_path, offset=start) as writer:
+                    position = start
+                    while position < end:
+                        data = reader.read(min(bufsize, end - position))
+                        if not data:
+                            raise IOError(f"unexpected end of {reader_path}")
+                        writer.write(data)
+                        position += len(data)
+                        with pbar_lock:
+                            pbar.update(len(data))
+
+    run_parallel(transfer_range, ranges, workers=len(ranges))
+
+
+def _get_file_sha1(c: Connection, path: str) -> str:
+    return c.run(
+        f'(sha1sum "{path}" 2>/dev/null || shasum -a1 "{path}") | cut -d" " -f1',
+        use_sudo=False,
+        hide=True,
+        timeout=_COMMAND_TIMEOUT,
+    ).stdout
 
 
 def _transfer_file(
-    reader: typing.IO[bytes],
+    read_chunks: typing.Callable[[int], typing.Iterable[bytes]],
     writer_conn: Connection,
     writer_dst_path: str,
     dst_file_size: int,
     dst_file_path: str,
-    bufsize: int = 32768,
-) -> None:
+    owner: typing.Tuple[int, int],
+    chmod: typing.Optional[str] = None,
+    fsync: bool = False,
+    source_key: typing.Optional[str] = None,
+    source_prefix_sha1: typing.Optional[typing.Callable[[int], str]] = None,
+    source: typing.Optional[typing.Tuple[Connection, str]] = None,
+    channels: int = 1,
+    link_host: typing.Optional[Host] = None,
+    get_wire_size: typing.Optional[typing.Callable[[], int]] = None,
+) -> StagedFile:
+    """
+    Залить файл во временный файл в папке назначения, см :py:func:`commit_files`
+
+    Временный файл лежит на той же файловой системе, что и место назначения,
+    поэтому переименование атомарно и не копирует файл еще раз
+
+    Если сжатие ускорит передачу (см :py:func:`_get_compression`), файл передается сжатым потоком
+    и распаковывается на хосте, иначе заливается по SFTP.
+    SFTP не умеет sudo, поэтому с `use_sudo` файл передается через stdin команды под sudo
+
+    Если задан `source_key`, файл пишется в недокачанный файл с постоянным именем, который не удаляется при ошибке.
+    Следующая попытка проверяет его sha1 по началу источника и продолжает с его конца
+
+    Большие несжимаемые файлы передаются `channels` диапазонами одновременно, см :py:func:`_transfer_ranges`,
+    и проверяются по sha1 всего файла. Диапазоны пишутся по SFTP, поэтому с `use_sudo` не используются
+
+    :param read_chunks: читать источник блоками с позиции
+    :param source_key: хеш источника, задает имя недокачанного файла
+    :param source_prefix_sha1: sha1 первых N байт источника
+    :param source: соединение и путь до источника, нужны для передачи диапазонами
+    :param channels: сколько диапазонов передавать одновременно
+    :param link_host: удаленный хост передачи, для него запоминается скорость канала. По умолчанию хост `writer_conn`
+    :param get_wire_size: сколько байт прошло по сети, если `read_chunks` читает сжатый поток и распаковывает его
+    """
+    if link_host is None:
+        link_host = writer_conn.host
     write_size = 0
+    wire_size = 0
 
     # Create dirs if needed
     dirname = os.path.dirname(writer_dst_path)
     if dirname:
         writer_conn.run(f'mkdir -p "{dirname}"', hide=True)
 
-    tempfile_path = os.path.join(writer_conn.tempdir, f'carnival.{uuid4()}.tmp')
+    staging_path = _get_staging_path(writer_dst_path)
+    upload_path = staging_path
+    offset = 0
+    if source_key is not None:
+        assert source_prefix_sha1 is not None, "source_prefix_sha1 required to resume"
+        upload_path, partial_glob = _get_partial_path(writer_dst_path, source_key)
+        partial_size, partial_sha1 = _get_partial_info(writer_conn, upload_path, partial_glob)
+        if 0 < partial_size <= dst_file_size and partial_sha1 == source_prefix_sha1(partial_size):
+            offset = write_size = partial_size
+            offset_str = tqdm.format_sizeof(offset, suffix="B", divisor=1024)
+            Step.log_action(writer_dst_path, f"resuming transfer from {offset_str}")
 
-    with tqdm(
-        desc=f"Transferring {dst_file_path}",
-            unit='B', unit_scale=True, total=dst_file_size,
-            leave=False,
-    ) as pbar:
-        with writer_conn.file_write(tempfile_path) as writer:
-            while True:
-                data = reader.read(bufsize)
-                if len(data) == 0:
-                    break
+    use_ranges = (
+        channels > 1 and not writer_conn.use_sudo and source is not None and source_prefix_sha1 is not None
+        and dst_file_size - offset >= _RANGES_MIN_SIZE
+        and (isinstance(writer_conn.host, SshHost) or isinstance(source[0].host, SshHost))
+    )
+    compression: typing.Optional[str] = None
+    if use_ranges:
+        # Ranges open the source themselves, choose compression by a bounded sample instead of opening whole stream
+        assert source is not None
+        with source[0].file_read(source[1], offset=offset, size=_COMPRESSION_PROBE_SIZE) as reader:
+            compression = _get_compression(writer_conn, reader.read(_COMPRESSION_PROBE_SIZE), dst_file_size - offset)
+        use_ranges = compression is None
+
+    chunks: typing.Iterator[bytes] = iter(())
+    first_chunk = b""
+    if not use_ranges:
+        chunks = iter(read_chunks(offset))
+        first_chunk = next(chunks, b"")
+        if compression is None:
+            compression = _get_compression(writer_conn, first_chunk, dst_file_size - offset)
+
+    started_at = time.monotonic()
+    try:
+        with tqdm(
+            desc=f"Transferring {dst_file_path}",
+                unit='B', unit_scale=True, unit_divisor=1024, total=dst_file_size, initial=offset,
+                leave=False,
+        ) as pbar:
+            if use_ranges:
+                assert source is not None and source_prefix_sha1 is not None
+                _transfer_ranges(
+                    reader_conn=source[0], reader_path=source[1],
+                    writer_conn=writer_conn, writer_path=upload_path,
+                    offset=offset, size=dst_file_size, channels=channels,
+                    bufsize=DEFAULT_BUFSIZE, pbar=pbar,
+                )
+                write_size = dst_file_size
+                wire_size = dst_file_size - offset
+                if _get_file_sha1(writer_conn, upload_path) != source_prefix_sha1(dst_file_size):
+                    source_key = None
+                    raise IOError(f"sha1 mismatch after transfer of {dst_file_path}")
+            elif compression is None and not writer_conn.use_sudo:
+                with writer_conn.file_write(upload_path, offset=offset or None) as writer:
+                    for data in itertools.chain([first_chunk], chunks):
+                        writer.write(data)
+                        pbar.update(len(data))
+                        write_size += len(data)
+                wire_size = write_size - offset
+            else:
+                # SFTP does not support sudo, stream into staging file through command stdin
+                decompress_command = "cat" if compression is None else f"{compression} -dc"
+                promise = writer_conn.run_promise(
+                    f'{decompress_command} {">>" if offset > 0 else ">"} "{upload_path}"',
+                    use_sudo=writer_conn.use_sudo,
+                    timeout=_COMMAND_TIMEOUT,
+                    pty=False,
+                )
+                compressor = None if compression is None else _get_compressor(compression)
+                for data in itertools.chain([first_chunk], chunks):
+                    packed = data if compressor is None else compressor.compress(data)
+                    promise.stdin.write(packed)
+                    pbar.update(len(data))
+                    write_size += len(data)
+                    wire_size += len(packed)
+                if compressor is not None:
+                    packed = compressor.flush()
+                    promise.stdin.write(packed)
+                    wire_size += len(packed)
+                promise.close_stdin()
+                promise.get_result(hide=True).check_result(warn=False, hide=True)
+        elapsed = max(time.monotonic() - started_at, 0.001)
+        if get_wire_size is not None:
+            wire_size = get_wire_size()
+
+        if dst_file_size != write_size:
+            source_key = None
+            raise IOError(f"size mismatch! {dst_file_size} != {write_size}")
+    except BaseException:
+        if source_key is None:
+            writer_conn.run(f'rm -f "{upload_path}"', hide=True, warn=True)
+        raise
+
+    if wire_size >= DEFAULT_BUFSIZE:
+        link_rate = wire_size / elapsed
+        if compression is not None or get_wire_size is not None:
+            # Compressed transfer may be limited by compression, not by link
+            link_rate = max(link_rate, _link_rates.get(link_host, 0))
+        _link_rates[link_host] = link_rate
+
+    size_str = tqdm.format_sizeof(write_size - offset, suffix="B", divisor=1024)
+    speed_str = tqdm.format_sizeof((write_size - offset) / elapsed, suffix="B/s", divisor=1024)
+    if compression is not None:
+        wire_size_str = tqdm.format_sizeof(wire_size, suffix="B", divisor=1024)
+        size_str = f"{size_str} ({compression} {wire_size_str})"
+    Step.log_action(writer_dst_path, f"transferred {size_str} in {elapsed:.1f}s ({speed_str})")
+
+    return StagedFile(
+        upload_path=upload_path,
+        staging_path=staging_path,
+        dst_path=writer_dst_path,
+        owner=owner,
+        chmod=chmod,
+        fsync=fsync,
+    )
+
+
+def _copy_command(src: str, dst: str) -> str:
+    # reflink shares blocks on btrfs/xfs, `--reflink` is GNU only
+    return f'(cp --reflink=auto "{src}" "{dst}" 2>/dev/null || cp "{src}" "{dst}")'
+
+
+def _stage_object(
+    c: Connection,
+    object_path: str,
+    dst_path: str,
+    owner: typing.Tuple[int, int],
+    chmod: typing.Optional[str] = None,
+    fsync: bool = False,
+) -> typing.Optional[StagedFile]:
+    """
+    Скопировать файл из хранилища на хосте во временный файл рядом с местом назначения, см :py:func:`commit_files`
+
+    Не жесткая ссылка: владелец и права назначаются временному файлу, а файл на месте назначения
+    могут изменить, и то и другое испортило бы файл в хранилище
+
+    :return: `None`, если скопировать не удалось, например файл хранилища недоступен.
+        Хранилище это только оптимизация, тогда файл нужно передать по сети
+    """
+    staging_path = _get_staging_path(dst_path)
+    commands = [_copy_command(object_path, staging_path)]
+    dirname = os.path.dirname(dst_path)
+    if dirname:
+        commands.insert(0, f'mkdir -p "{dirname}"')
+    if not c.run(" && ".join(commands), hide=True, warn=True).ok:
+        c.run(f'rm -f "{staging_path}"', hide=True, warn=True)
+        Step.log_action(dst_path, "copy from remote objects failed, transferring file")
+        return None
+    Step.log_action(dst_path, "copied from remote objects")
+
+    return StagedFile(
+        upload_path=staging_path,
+        staging_path=staging_path,
+        dst_path=dst_path,
+        owner=owner,
+        chmod=chmod,
+        fsync=fsync,
+    )
+
+
+def commit_files(c: Connection, staged_files: typing.Sequence[StagedFile]) -> None:
+    """
+    Переименовать залитые файлы в места назначения одной командой
 
-                writer.write(data)
-                pbar.update(len(data))
-                write_size += len(data)
+    Владелец, права и fsync применяются к временным файлам до переименования,
+    так что файл появляется на месте назначения уже готовым
+    """
+    if not staged_files:
+        return
+
+    prepare_commands: typing.List[str] = []
+    rename_commands: typing.List[str] = []
+    fsync_paths: typing.List[str] = []
+    for staged in staged_files:
+        if staged.upload_path != staged.staging_path:
+            prepare_commands.append(f'mv -f "{staged.upload_path}" "{staged.staging_path}"')
+        # если используется sudo - нужно назначить владельца
+        user_id, user_group_id = staged.owner
+        prepare_commands.append(f'chown {user_id}:{user_group_id} "{staged.staging_path}"')
+        if staged.chmod is not None:
+            prepare_commands.append(f'chmod {staged.chmod} "{staged.staging_path}"')
+        if staged.fsync:
+            fsync_paths.append(f'"{staged.staging_path}"')
+        if staged.object_path is not None:
+            # Store is best effort, it must not fail the commit
+            object_tmp_path = f"{staged.object_path}.{uuid4().hex}.tmp"
+            prepare_commands.append(
+                f'( ( mkdir -p "{os.path.dirname(staged.object_path)}" && '
+                f'{_copy_command(staged.staging_path, object_tmp_path)} && '
+                f'mv -f "{object_tmp_path}" "{staged.object_path}" ) 2>/dev/null || rm -f "{object_tmp_path}" )'
+            )
+        rename_commands.append(f'mv -f "{staged.staging_path}" "{staged.dst_path}"')
+
+    if fsync_paths:
+        # `sync FILE...` is coreutils 8.24+, fallback to full sync
+        fsync_paths_str = " ".join(fsync_paths)
+        prepare_commands.append(f'(sync {fsync_paths_str} 2>/dev/null || sync)')
+
+    try:
+        c.run(" && ".join([*prepare_commands, *rename_commands]), hide=True)
+    except BaseException:
+        discard_files(c, staged_files)
+        raise
+
+    for staged in staged_files:
+        if staged.chmod is not None:
+            Step.log_action(staged.dst_path, f"chmod set to {staged.chmod}")
+
+
+def discard_files(c: Connection, staged_files: typing.Sequence[StagedFile]) -> None:
+    """
+    Удалить залитые, но не переименованные файлы, например если заливка следующего файла не удалась
+    """
+    if not staged_files:
+        return
+
+    staged_paths = " ".join(f'"{x.upload_path}" "{x.staging_path}"' for x in staged_files)
+    c.run(f"rm -f {staged_paths}", hide=True, warn=True)
+
+
+# Runs on the host with python3, keep compatible with old python3 versions
+_DELTA_SCRIPT = r"""
+import hashlib, struct, sys, zlib
+mode, path, block_size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+if mode == "signatures":
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(block_size)
+            if len(block) < block_size:
+                break
+            sys.stdout.buffer.write(struct.pack(">I", zlib.adler32(block)) + hashlib.sha1(block).digest())
+    sys.stdout.buffer.flush()
+    sys.exit(0)
+
+ops, digest = sys.stdin.buffer, hashlib.sha1()
+with open(path, "rb") as src, open(sys.argv[4], "wb") as dst:
+    while True:
+        op = ops.read(1)
+        if op == b"C":
+            index, size = struct.unpack(">QQ", ops.read(16))
+            src.seek(index * block_size)
+        elif op == b"L":
+            size, = struct.unpack(">Q", ops.read(8))
+        else:
+            break
+        while size > 0:
+            data = (src if op == b"C" else ops).read(min(size, 1048576))
+            if not data:
+                sys.exit("unexpected end of " + ("file" if op == b"C" else "delta"))
+            dst.write(data)
+            digest.update(data)
+            size -= len(data)
+print(digest.hexdigest())
+"""
+
+_ADLER_MOD = 65521
+
+
+class _DeltaError(IOError):
+    pass
+
+
+def _get_delta_block_size(size: int) -> int:
+    """
+    Как в rsync: размер блока около корня из размера файла, от 4KB до 1MB
+    """
+    block_size = 4096
+    while block_size * block_size < size and block_size < 1024 * 1024:
+        block_size *= 2
+    return block_size
+
+
+def _get_remote_signatures(
+    c: Connection,
+    path: str,
+    block_size: int,
+) -> typing.Dict[int, typing.Dict[bytes, int]]:
+    """
+    Посчитать на сервере adler32 и sha1 каждого полного блока файла
 
-    if dst_file_size != write_size:
-        writer_conn.run(f"rm {tempfile_path}")
-        raise IOError(f"size mismatch! {dst_file_size} != {write_size}")
+    :return: adler32 -> sha1 -> номер блока
+    """
+    promise = c.run_promise(
+        f'python3 -c {shlex.quote(_DELTA_SCRIPT)} signatures "$(echo {path})" {block_size}',
+        use_sudo=c.use_sudo,
+        timeout=_COMMAND_TIMEOUT,
+        pty=False,
+    )
+    promise.close_stdin()
+    data = promise.stdout.read()
+    result = promise.get_result(hide=True)
+    if not result.ok:
+        raise _DeltaError(result.stderr or "python3 is required for delta transfer")
+
+    signatures: typing.Dict[int, typing.Dict[bytes, int]] = {}
+    for index, offset in enumerate(range(0, len(data) - len(data) % 24, 24)):
+        weak = int.from_bytes(data[offset:offset + 4], "big")
+        signatures.setdefault(weak, {}).setdefault(data[offset + 4:offset + 24], index)
+    return signatures
 
-    writer_conn.run(f"mv {tempfile_path} {writer_dst_path}")
-    # если используется sudo - нужно назначить владельца
-    user_id = shortcuts.get_user_id(writer_conn)
-    user_group_id = shortcuts.get_user_group_id(writer_conn)
-    writer_conn.run(f"chown {user_id}:{user_group_id} {writer_dst_path}")
 
-    Step.log_action(writer_dst_path, "transferred")
+def _get_delta_ops(
+    data: typing.Union[bytes, mmap.mmap],
+    block_size: int,
+    signatures: typing.Dict[int, typing.Dict[bytes, int]],
+) -> typing.List[typing.Tuple[bool, int, int]]:
+    """
+    Найти блоки файла на сервере в локальном файле скользящей контрольной суммой, как rsync
+
+    :return: список `(is_copy, start, size)`: скопировать `size` байт с блока `start` файла на сервере,
+        или передать `size` байт локального файла с позиции `start`
+    """
+    ops: typing.List[typing.Tuple[bool, int, int]] = []
+    size = len(data)
+    offset = literal_start = matched = 0
+    weak_a = weak_b = 0
+    weak: typing.Optional[int] = None
+    while offset + block_size <= size:
+        if weak is None:
+            weak = zlib.adler32(data[offset:offset + block_size])
+            weak_a, weak_b = weak & 0xffff, weak >> 16
+
+        strong_map = signatures.get(weak)
+        if strong_map is not None:
+            index = strong_map.get(sha1(data[offset:offset + block_size]).digest())
+            if index is not None:
+                if literal_start < offset:
+                    ops.append((False, literal_start, offset - literal_start))
+                if ops and ops[-1][0] and ops[-1][1] * block_size + ops[-1][2] == index * block_size:
+                    ops[-1] = (True, ops[-1][1], ops[-1][2] + block_size)
+                else:
+                    ops.append((True, index, block_size))
+                offset += block_size
+                literal_start = offset
+                matched += block_size
+                weak = None
+                continue
+
+        if offset + block_size == size:
+            break
+
+        # Mostly unchanged files are cheap, rolling byte by byte in python over changed data is not
+        if offset > 64 * block_size and matched < offset // 2:
+            raise _DeltaError("file changed too much for delta transfer")
+
+        # https://en.wikipedia.org/wiki/Adler-32, roll window one byte forward
+        out_byte, in_byte = data[offset], data[offset + block_size]
+        weak_a = (weak_a - out_byte + in_byte) % _ADLER_MOD
+        weak_b = (weak_b - block_size * out_byte - 1 + weak_a) % _ADLER_MOD
+        weak = (weak_b << 16) | weak_a
+        offset += 1
+
+    if literal_start < size:
+        ops.append((False, literal_start, size - literal_start))
+    return ops
+
+
+def _delta_transfer_file(
+    c: Connection,
+    local_path: str,
+    dst_path: str,
+    block_size: int,
+    owner: typing.Tuple[int, int],
+    chmod: typing.Optional[str] = None,
+    fsync: bool = False,
+) -> StagedFile:
+    """
+    Собрать рядом с местом назначения новую версию файла из блоков текущей и изменившихся данных,
+    см :py:func:`commit_files`
+
+    Передаются только изменившиеся данные и номера совпавших блоков, сборка идет на сервере через python3.
+    Собранный файл проверяется по sha1
+
+    :raises _DeltaError: если передача разницей невозможна или невыгодна, нужно залить файл целиком
+    """
+    started_at = time.monotonic()
+    signatures = _get_remote_signatures(c, dst_path, block_size)
+    local_size = os.stat(local_path).st_size
+
+    with open(local_path, 'rb') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ops = _get_delta_ops(mm, block_size, signatures)
+            literal_size = sum(size for is_copy, _, size in ops if not is_copy)
+
+            staging_path = _get_staging_path(dst_path)
+            promise = c.run_promise(
+                f'python3 -c {shlex.quote(_DELTA_SCRIPT)} patch "$(echo {dst_path})" {block_size} "{staging_path}"',
+                use_sudo=c.use_sudo,
+                timeout=_COMMAND_TIMEOUT,
+                pty=False,
+            )
+            try:
+                with tqdm(
+                    desc=f"Transferring delta {dst_path}",
+                    unit='B', unit_scale=True, unit_divisor=1024, total=literal_size,
+                    leave=False,
+                ) as pbar:
+                    for is_copy, start, size in ops:
+                        if is_copy:
+                            promise.stdin.write(b"C" + struct.pack(">QQ", start, size))
+                            continue
+
+                        promise.stdin.write(b"L" + struct.pack(">Q", size))
+                        for offset in range(start, start + size, DEFAULT_BUFSIZE):
+                            chunk = mm[offset:min(offset + DEFAULT_BUFSIZE, start + size)]
+                            promise.stdin.write(chunk)
+                            pbar.update(len(chunk))
+                    promise.stdin.write(b"E")
+                promise.close_stdin()
+                result = promise.get_result(hide=True)
+
+                if result.stdout.split("\n")[-1] != file_hash_cache.sha1(local_path):
+                    raise _DeltaError(f"delta transfer failed: {result.stderr or 'sha1 mismatch'}")
+            except BaseException:
+                c.run(f'rm -f "{staging_path}"', hide=True, warn=True)
+                raise
+
+    elapsed = max(time.monotonic() - started_at, 0.001)
+    literal_str = tqdm.format_sizeof(literal_size, suffix="B", divisor=1024)
+    size_str = tqdm.format_sizeof(local_size, suffix="B", divisor=1024)
+    Step.log_action(dst_path, f"transferred {literal_str} delta of {size_str} in {elapsed:.1f}s")
+
+    return StagedFile(
+        upload_path=staging_path,
+        staging_path=staging_path,
+        dst_path=dst_path,
+        owner=owner,
+        chmod=chmod,
+        fsync=fsync,
+    )
 
 
 class GetFile(Step):
     """
     Скачать файл с удаленного сервера на локальный диск
+
+    Хорошо сжимаемые файлы скачиваются сжатым потоком и распаковываются локально, см :py:func:`_get_compression`
     """
-    def __init__(self, remote_path: str, local_path: str):
+    def __init__(
+        self,
+        remote_path: str,
+        local_path: str,
+        bufsize: int = DEFAULT_BUFSIZE,
+        fsync: bool = False,
+        channels: int = 4,
+    ):
         """
         :param remote_path: Путь до файла на сервере
         :param local_path: Локальный путь назначения
+        :param bufsize: размер блока передачи
+        :param fsync: сбросить файл на диск перед атомарным переименованием
+        :param channels: сколько SFTP-сессий использовать для больших файлов
         """
         self.remote_path = remote_path
         self.local_path = local_path
+        self.bufsize = bufsize
+        self.fsync = fsync
+        self.channels = channels
 
     def get_name(self) -> str:
         return f"{super().get_name()}(remote_path={self.remote_path}, local_path={self.local_path})"
@@ -88,35 +880,203 @@ class GetFile(Step):
         ]
 
     def run(self, c: "Connection") -> None:
-        remote_sha1 = _file_sha1sum(c, self.remote_path)
-        local_sha1 = _file_sha1sum(localhost_connection, self.local_path)
-        if remote_sha1 is not None and local_sha1 is not None:
-            if remote_sha1 == local_sha1:
-                return
-
-        with c.file_read(self.remote_path) as reader:
-            dst_file_size = c.file_stat(self.remote_path).st_size
-            _transfer_file(
-                reader=reader,
-                writer_conn=localhost_connection,
-                writer_dst_path=self.local_path,
-                dst_file_size=dst_file_size, dst_file_path=self.remote_path,
-            )
+        local_path = self._get_local_path(c)
+        local_size: typing.Optional[int] = None
+        if os.path.isfile(local_path):
+            local_size = os.stat(local_path).st_size
+
+        remote_info = _get_file_info(c, self.remote_path, hash_if_size=local_size)
+        if remote_info.sha1 is not None and remote_info.sha1 == file_hash_cache.sha1(local_path):
+            return
+
+        if remote_info.size is None:
+            raise FileNotFoundError(f"{self.remote_path} not exists on {c.host}")
+        self._download(c, local_path, remote_info.size, remote_info.mtime)
+
+    def _get_local_path(self, c: "Connection") -> str:
+        return self.local_path
+
+    def _download(self, c: "Connection", local_path: str, size: int, mtime: typing.Optional[int]) -> None:
+        compression: typing.Optional[str] = None
+        if size >= _COMPRESSION_MIN_SIZE:
+            with c.file_read(self.remote_path, size=_COMPRESSION_PROBE_SIZE) as reader:
+                compression = _get_compression(c, reader.read(_COMPRESSION_PROBE_SIZE), size)
+
+        if compression is not None:
+            Step.log_action(local_path, f"downloading {compression} stream")
+
+        wire_size = 0
+
+        def count_wire_size(size: int) -> None:
+            nonlocal wire_size
+            wire_size += size
+
+        def read_chunks(offset: int) -> typing.Iterator[bytes]:
+            if compression is not None:
+                return _remote_compressed_chunks(
+                    c, self.remote_path, compression, self.bufsize, offset, on_read=count_wire_size,
+                )
+            return _remote_file_chunks(c, self.remote_path, self.bufsize, offset)
+
+        # Hashing remote file before download costs a full read, size and mtime identify its version well enough
+        source_key = sha1(f"{c.host.addr}:{self.remote_path}:{size}:{mtime}".encode())
+        staged = _transfer_file(
+            read_chunks=read_chunks,
+            writer_conn=localhost_connection,
+            writer_dst_path=local_path,
+            dst_file_size=size, dst_file_path=self.remote_path,
+            owner=(os.getuid(), os.getgid()),
+            fsync=self.fsync,
+            source_key=source_key.hexdigest(),
+            source_prefix_sha1=lambda size: _remote_file_prefix_sha1(c, self.remote_path, size),
+            # Compressed stream is a single channel
+            source=(c, self.remote_path) if compression is None else None,
+            channels=self.channels,
+            link_host=c.host,
+            # Link speed is measured by compressed bytes, not by bytes written
+            get_wire_size=(lambda: wire_size) if compression is not None else None,
+        )
+        commit_files(localhost_connection, [staged])
+
+
+__download_slots_lock = threading.Lock()
+__download_slots: typing.Dict[typing.Tuple[str, str], threading.BoundedSemaphore] = {}
+
+
+def _get_download_slots(remote_path: str, local_path: str, max_transfers: int) -> threading.BoundedSemaphore:
+    """
+    Получить общий для всех хостов процесса семафор скачиваний `remote_path` в `local_path`
+    """
+    with __download_slots_lock:
+        key = (remote_path, local_path)
+        if key not in __download_slots:
+            __download_slots[key] = threading.BoundedSemaphore(max_transfers)
+        return __download_slots[key]
+
+
+class GetFiles(GetFile):
+    """
+    Скачать один и тот же файл со всех хостов задачи, каждый в свой локальный путь
+
+    Локальный путь содержит `{host}`, он заменяется на адрес хоста
+
+    Хосты скачиваются одновременно, если задача выполняется на нескольких хостах сразу (`--forks`),
+    но передают данные не более `max_transfers` хостов одновременно,
+    остальные ждут свободного слота уже после проверки, нужно ли скачивать файл
+
+    >>> class CollectLogs(Task[MyRole]):
+    >>>     forks = 50
+    >>>
+    >>>     def get_steps(self) -> typing.List["Step"]:
+    >>>         return [transfer.GetFiles("/var/log/app.log", "logs/{host}/app.log", max_transfers=8)]
+    """
+
+    def __init__(
+        self,
+        remote_path: str,
+        local_path: str,
+        max_transfers: int = 8,
+        bufsize: int = DEFAULT_BUFSIZE,
+        fsync: bool = False,
+        channels: int = 1,
+    ):
+        """
+        :param remote_path: Путь до файла на сервере
+        :param local_path: Локальный путь назначения, `{host}` заменяется на адрес хоста
+        :param max_transfers: сколько хостов скачивать одновременно
+        :param bufsize: размер блока передачи
+        :param fsync: сбросить файл на диск перед атомарным переименованием
+        :param channels: сколько SFTP-сессий использовать для больших файлов на один хост
+        """
+        if "{host}" not in local_path:
+            raise ValueError(f"local_path must contain {{host}}, got {local_path}")
+
+        super().__init__(
+            remote_path=remote_path, local_path=local_path, bufsize=bufsize, fsync=fsync, channels=channels,
+        )
+        self.max_transfers = max_transfers
+
+    def get_validators(self) -> typing.List["validators.StepValidatorBase"]:
+        return [
+            validators.IsFileValidator(self.remote_path),
+        ]
+
+    def _get_local_path(self, c: "Connection") -> str:
+        return self.local_path.replace("{host}", c.host.addr)
+
+    def _download(self, c: "Connection", local_path: str, size: int, mtime: typing.Optional[int]) -> None:
+        with _get_download_slots(self.remote_path, self.local_path, self.max_transfers):
+            super()._download(c, local_path, size, mtime)
 
 
 class PutFile(Step):
     """
     Закачать файл на сервер
 
+    С `distribute=True` большой файл раздается на хосты задачи деревом:
+    с локальной машины файл заливается только на `seeds` хостов одновременно,
+    остальные хосты скачивают его по ssh с хостов, уже получивших файл.
+    sha1 проверяется на каждом хосте до переименования, при ошибке файл заливается с локальной машины.
+    Время раздачи растет как логарифм числа хостов, а не линейно.
+
+    Для раздачи нужно выполнять задачу на нескольких хостах одновременно (`--forks`),
+    а хосты должны пускать друг друга по ssh: своими ключами или через проброшенный ssh-agent (`peer_forward_agent`).
+    Проброшенным агентом может воспользоваться любой, у кого есть root на хосте, пока идет скачивание,
+    поэтому он выключен по умолчанию.
+    Ключ хоста-источника проверяется по ключу, который увидела локальная машина при подключении к нему,
+    а не принимается при первом подключении
+
+    С `delta=True` изменившийся большой файл передается разницей, как в rsync:
+    передаются только изменившиеся данные, остальное собирается из блоков текущего файла на сервере.
+    Для этого на сервере нужен python3, иначе файл заливается целиком
     """
-    def __init__(self, local_path: str, remote_path: str, chmod: typing.Optional[str] = None):
+    def __init__(
+        self,
+        local_path: str,
+        remote_path: str,
+        chmod: typing.Optional[str] = None,
+        bufsize: int = DEFAULT_BUFSIZE,
+        fsync: bool = False,
+        distribute: bool = False,
+        seeds: int = 2,
+        fanout: int = 2,
+        peer_ssh_command: str = "ssh -o BatchMode=yes",
+        peer_timeout: int = 3600,
+        peer_forward_agent: bool = False,
+        delta: bool = False,
+        delta_block_size: typing.Optional[int] = None,
+        channels: int = 4,
+    ):
         """
         :param local_path: путь до локального файла
         :param remote_path: путь куда сохранить на сервере
+        :param chmod: права файла, не меняются если `None`
+        :param bufsize: размер блока передачи
+        :param fsync: сбросить файл на диск перед атомарным переименованием
+        :param distribute: раздавать файл между хостами, только для ssh-хостов
+        :param seeds: сколько хостов одновременно заливаются с локальной машины
+        :param fanout: сколько хостов одновременно скачивают с одного хоста
+        :param peer_ssh_command: команда ssh, которой хост скачивает файл с другого хоста
+        :param peer_timeout: таймаут скачивания с другого хоста
+        :param peer_forward_agent: пробросить локальный ssh-agent на хосты для скачивания с других хостов
+        :param delta: передавать только изменения файла
+        :param delta_block_size: размер блока для поиска изменений, по умолчанию около корня из размера файла
+        :param channels: сколько SFTP-сессий использовать для больших файлов
         """
         self.local_path = local_path
         self.remote_path = remote_path
         self.chmod = chmod
+        self.bufsize = bufsize
+        self.fsync = fsync
+        self.distribute = distribute
+        self.seeds = seeds
+        self.fanout = fanout
+        self.peer_ssh_command = peer_ssh_command
+        self.peer_timeout = peer_timeout
+        self.peer_forward_agent = peer_forward_agent
+        self.delta = delta
+        self.delta_block_size = delta_block_size
+        self.channels = channels
 
     def get_name(self) -> str:
         return f"{super().get_name()}(local_path={self.local_path}, remote_path={self.remote_path})"
@@ -130,24 +1090,192 @@ class PutFile(Step):
             ),
         ]
 
-    def run(self, c: "Connection") -> None:
-        remote_sha1 = _file_sha1sum(c, self.remote_path)
-        local_sha1 = _file_sha1sum(localhost_connection, self.local_path)
-        if remote_sha1 is not None and local_sha1 is not None:
-            if remote_sha1 == local_sha1:
-                return
-
-        with localhost_connection.file_read(self.local_path) as reader:
-            dst_file_size = localhost_connection.file_stat(self.local_path).st_size
-            _transfer_file(
-                reader=reader,
-                writer_conn=c,
-                writer_dst_path=self.remote_path,
-                dst_file_size=dst_file_size, dst_file_path=self.remote_path,
+    def _get_object_path(self) -> typing.Optional[str]:
+        if remote_objects_dir is None:
+            return None
+        return _get_object_path(file_hash_cache.sha1(self.local_path))
+
+    def _get_file_info(self, c: "Connection") -> _FileInfo:
+        local_size = os.stat(self.local_path).st_size
+        return _get_file_info(c, self.remote_path, hash_if_size=local_size, object_path=self._get_object_path())
+
+    def _upload(self, c: "Connection", remote_info: _FileInfo) -> StagedFile:
+        owner = (remote_info.user_id, remote_info.group_id)
+        object_path = self._get_object_path()
+        if object_path is not None and remote_info.object_exists:
+            staged_object = _stage_object(
+                c, object_path, self.remote_path, owner=owner, chmod=self.chmod, fsync=self.fsync,
             )
-        if self.chmod is not None:
-            c.run(f"chmod {self.chmod} {self.remote_path}")
-            self.log_action(self.remote_path, f"chmod set to {self.chmod}")
+            if staged_object is not None:
+                return staged_object
+
+        staged = self._transfer(c, remote_info)
+        staged.object_path = object_path
+        return staged
+
+    def _transfer(self, c: "Connection", remote_info: _FileInfo) -> StagedFile:
+        local_size = os.stat(self.local_path).st_size
+        owner = (remote_info.user_id, remote_info.group_id)
+
+        # Small files are cheaper to transfer whole than to compute signatures
+        if self.delta and local_size > 0 and remote_info.size is not None and remote_info.size >= DEFAULT_BUFSIZE:
+            try:
+                return _delta_transfer_file(
+                    c=c,
+                    local_path=self.local_path,
+                    dst_path=self.remote_path,
+                    block_size=self.delta_block_size or _get_delta_block_size(remote_info.size),
+                    owner=owner,
+                    chmod=self.chmod,
+                    fsync=self.fsync,
+                )
+            except _DeltaError as e:
+                self.log_action(self.remote_path, f"{e}, transferring whole file")
+
+        return _transfer_file(
+            read_chunks=lambda offset: _local_file_chunks(self.local_path, self.bufsize, offset),
+            writer_conn=c,
+            writer_dst_path=self.remote_path,
+            dst_file_size=local_size,
+            dst_file_path=self.remote_path,
+            owner=owner,
+            chmod=self.chmod,
+            fsync=self.fsync,
+            source_key=file_hash_cache.sha1(self.local_path),
+            source_prefix_sha1=lambda size: _local_file_prefix_sha1(self.local_path, size),
+            source=(localhost_connection, self.local_path),
+            channels=self.channels,
+        )
+
+    def stage(self, c: "Connection") -> typing.List[StagedFile]:
+        """
+        Залить файл рядом с местом назначения, не переименовывая, см :py:func:`commit_files`
+
+        Раздача между хостами тут не используется: другие хосты качают уже переименованный файл
+
+        :return: пустой список если файл не изменился
+        """
+        remote_info = self._get_file_info(c)
+        if remote_info.sha1 is not None and remote_info.sha1 == file_hash_cache.sha1(self.local_path):
+            return []
+
+        return [self._upload(c, remote_info)]
+
+    def _pull_from_peer(self, c: SshConnection, peer: SshHost, digest: str, remote_info: _FileInfo) -> StagedFile:
+        """
+        Скачать файл на хост `c` с хоста `peer` и проверить sha1
+        """
+        staging_path = _get_staging_path(self.remote_path)
+        upload_path = staging_path
+        if c.use_sudo:
+            # ssh keys of the user are not available under sudo, download to tempdir and move next to destination
+            upload_path = os.path.join(c.tempdir, f'carnival.{uuid4()}.tmp')
+
+        peer_addr = peer.connect_config.hostname
+        if peer.connect_config.user:
+            peer_addr = f"{peer.connect_config.user}@{peer_addr}"
+        peer_command = shlex.quote(f'cat "$(echo {self.remote_path})"')
+        # Pin peer host key seen by local machine, options set in `peer_ssh_command` take precedence
+        with peer.connect() as peer_conn:
+            peer_key = peer_conn.get_host_key()
+        known_host = shlex.quote(f"carnival-peer {peer_key.get_name()} {peer_key.get_base64()}")
+        ssh_command = (
+            f'{self.peer_ssh_command} -o UserKnownHostsFile="$k" -o StrictHostKeyChecking=yes '
+            f'-o HostKeyAlias=carnival-peer -p {peer.connect_config.port} {peer_addr} {peer_command}'
+        )
+
+        started_at = time.monotonic()
+        promise = c.run_promise(
+            f'k="$(mktemp)" && printf "%s\\n" {known_host} > "$k" && {{ {ssh_command} > "{upload_path}"; r=$?; }}; '
+            f'rm -f "$k"; [ "$r" = 0 ] && (sha1sum "{upload_path}" 2>/dev/null || shasum -a1 "{upload_path}")',
+            use_sudo=False,
+            timeout=self.peer_timeout,
+            pty=False,
+            forward_agent=self.peer_forward_agent,
+        )
+        result = promise.get_result(hide=True)
+        elapsed = max(time.monotonic() - started_at, 0.001)
+
+        received_digest = result.stdout.strip().split(" ")[0] if result.return_code == 0 else ""
+        if received_digest != digest:
+            c.run(f'rm -f "{upload_path}"', hide=True, warn=True)
+            error = result.stderr.strip() or "sha1 mismatch"
+            raise IOError(f"failed to get {self.remote_path} from {peer.addr}: {error}")
+
+        size = os.stat(self.local_path).st_size
+        size_str = tqdm.format_sizeof(size, suffix="B", divisor=1024)
+        speed_str = tqdm.format_sizeof(size / elapsed, suffix="B/s", divisor=1024)
+        self.log_action(self.remote_path, f"got {size_str} from {peer.addr} in {elapsed:.1f}s ({speed_str})")
+
+        return StagedFile(
+            upload_path=upload_path,
+            staging_path=staging_path,
+            dst_path=self.remote_path,
+            owner=(remote_info.user_id, remote_info.group_id),
+            chmod=self.chmod,
+            fsync=self.fsync,
+        )
+
+    def _run_distributed(self, c: SshConnection) -> None:
+        digest = file_hash_cache.sha1(self.local_path)
+        swarm = get_swarm(digest, self.remote_path, seeds=self.seeds, fanout=self.fanout)
+
+        remote_info = self._get_file_info(c)
+        if remote_info.sha1 == digest:
+            swarm.add_peer(c.host)
+            return
+
+        if remote_info.object_exists:
+            commit_files(c, [self._upload(c, remote_info)])
+            swarm.add_peer(c.host)
+            return
+
+        # Errors on this host must not be blamed on peer
+        dirname = os.path.dirname(self.remote_path)
+        if dirname:
+            c.run(f'mkdir -p "{dirname}"', hide=True)
+
+        source = swarm.acquire()
+        ok = False
+        try:
+            if source is not None:
+                try:
+                    staged = self._pull_from_peer(c, source, digest, remote_info)
+                except (IOError, CommandError) as e:
+                    self.log_action(self.remote_path, f"{e}, uploading from local")
+                    swarm.release(source, ok=False)
+                    source = swarm.acquire(peers=False)
+                else:
+                    # Peer has done its part, it stays a source whatever happens next
+                    ok = True
+
+            if source is None:
+                staged = self._upload(c, remote_info)
+
+            commit_files(c, [staged])
+            # Become a source before releasing the current one, so waiting hosts prefer peers to local uploads
+            swarm.add_peer(c.host)
+            ok = True
+        finally:
+            swarm.release(source, ok=ok)
+
+    def stop_serving(self, c: "Connection") -> None:
+        """
+        Перестать раздавать файл с хоста `c` другим хостам, см `distribute`.
+        Ждет, пока закончатся уже начатые скачивания с этого хоста, после этого файл можно удалить
+        """
+        if not self.distribute or not isinstance(c.host, SshHost):
+            return
+
+        swarm = get_swarm(file_hash_cache.sha1(self.local_path), self.remote_path, seeds=self.seeds, fanout=self.fanout)
+        swarm.remove_peer(c.host)
+
+    def run(self, c: "Connection") -> None:
+        if self.distribute and isinstance(c, SshConnection):
+            self._run_distributed(c)
+            return
+
+        commit_files(c, self.stage(c))
 
 
 class PutTemplate(Step):
@@ -156,15 +1284,23 @@ class PutTemplate(Step):
     См раздел templates.
     """
 
-    def __init__(self, template_path: str, remote_path: str, context: typing.Dict[str, typing.Any]):
+    def __init__(
+        self,
+        template_path: str,
+        remote_path: str,
+        context: typing.Dict[str, typing.Any],
+        fsync: bool = False,
+    ):
         """
         :param template_path: путь до локального файла jinja
         :param remote_path: путь куда сохранить на сервере
         :param context: контекс для рендеринга jinja2
+        :param fsync: сбросить файл на диск перед атомарным переименованием
         """
         self.template_path = template_path
         self.remote_path = remote_path
         self.context = context
+        self.fsync = fsync
 
     def get_name(self) -> str:
         return f"{super().get_name()}(template_path={self.template_path})"
@@ -174,22 +1310,218 @@ class PutTemplate(Step):
             validators.TemplateValidator(self.template_path, context=self.context),
         ]
 
-    def run(self, c: "Connection") -> None:
-        filebytes = render(template_path=self.template_path, **self.context).encode()
+    def _render_chunks(self, offset: int = 0) -> typing.Iterator[bytes]:
+        """
+        Рендерить шаблон блоками по :py:data:`DEFAULT_BUFSIZE` байт, начиная с позиции `offset`
+        """
+        buffer = bytearray()
+        for text in render_stream(self.template_path, **self.context):
+            buffer += text.encode()
+            if offset > 0:
+                skip = min(offset, len(buffer))
+                del buffer[:skip]
+                offset -= skip
+            while len(buffer) >= DEFAULT_BUFSIZE:
+                yield bytes(buffer[:DEFAULT_BUFSIZE])
+                del buffer[:DEFAULT_BUFSIZE]
+        if buffer:
+            yield bytes(buffer)
+
+    def stage(self, c: "Connection") -> typing.List[StagedFile]:
+        """
+        Залить файл рядом с местом назначения, не переименовывая, см :py:func:`commit_files`
 
-        remote_sha1 = _file_sha1sum(c, self.remote_path)
-        local_sha1 = sha1(filebytes).hexdigest()
+        Шаблон рендерится по частям: сначала только для sha1, затем, если файл изменился,
+        еще раз прямо в файл на сервере
+
+        :return: пустой список если файл не изменился
+        """
+        # Hash-only pass: rendered file is not kept in memory, it is rendered again only if upload is needed
+        hasher = sha1()
+        size = 0
+        for chunk in self._render_chunks():
+            hasher.update(chunk)
+            size += len(chunk)
+        digest = hasher.hexdigest()
+        object_path = _get_object_path(digest)
 
-        if remote_sha1 is not None and local_sha1 is not None:
-            if remote_sha1 == local_sha1:
-                return
+        remote_info = _get_file_info(c, self.remote_path, hash_if_size=size, object_path=object_path)
+        if remote_info.sha1 is not None and remote_info.sha1 == digest:
+            return []
 
-        _transfer_file(
-            reader=BytesIO(filebytes),
+        owner = (remote_info.user_id, remote_info.group_id)
+        if object_path is not None and remote_info.object_exists:
+            staged_object = _stage_object(c, object_path, self.remote_path, owner=owner, fsync=self.fsync)
+            if staged_object is not None:
+                return [staged_object]
+
+        staged = _transfer_file(
+            read_chunks=self._render_chunks,
             writer_conn=c,
             writer_dst_path=self.remote_path,
-            dst_file_size=len(filebytes), dst_file_path=self.remote_path,
+            dst_file_size=size, dst_file_path=self.remote_path,
+            owner=owner,
+            fsync=self.fsync,
         )
+        staged.object_path = object_path
+        return [staged]
+
+    def run(self, c: "Connection") -> None:
+        commit_files(c, self.stage(c))
+
+
+@dataclass
+class _ManifestEntry:
+    size: int
+    mtime: int
+    sha1: typing.Optional[str] = None
+
+
+def _get_local_manifest(local_dir: str, checksum: bool) -> typing.Dict[str, _ManifestEntry]:
+    manifest: typing.Dict[str, _ManifestEntry] = {}
+    for dirpath, _, filenames in os.walk(local_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+
+            stat = os.stat(path)
+            entry = _ManifestEntry(size=stat.st_size, mtime=int(stat.st_mtime))
+            if checksum:
+                entry.sha1 = file_hash_cache.sha1(path)
+            manifest[os.path.relpath(path, local_dir)] = entry
+    return manifest
+
+
+def _get_remote_manifest(c: Connection, remote_dir: str, checksum: bool) -> typing.Dict[str, _ManifestEntry]:
+    """
+    Получить список файлов папки на сервере с размерами, mtime и, если нужно, sha1 одной командой
+    """
+    command = (
+        f'cd "$(echo {remote_dir})" 2>/dev/null || exit 0; '
+        "find . -type f -exec stat -c '%s %Y %n' {} + 2>/dev/null || find . -type f -exec stat -f '%z %m %N' {} +"
+    )
+    if checksum:
+        command += "; echo --; find . -type f -exec sha1sum {} + 2>/dev/null || find . -type f -exec shasum -a1 {} +"
+
+    manifest: typing.Dict[str, _ManifestEntry] = {}
+    is_hashes_section = False
+    for line in c.run(command, hide=True).stdout.splitlines():
+        if not line.strip():
+            continue
+        if line == "--":
+            is_hashes_section = True
+            continue
+
+        if not is_hashes_section:
+            size, mtime, path = line.split(" ", 2)
+            manifest[os.path.relpath(path)] = _ManifestEntry(size=int(size), mtime=int(mtime))
+        else:
+            digest, path = line.split("  ", 1)
+            relpath = os.path.relpath(path)
+            if relpath in manifest:
+                manifest[relpath].sha1 = digest
+    return manifest
+
+
+class PutDir(Step):
+    """
+    Синхронизировать локальную папку с папкой на сервере, без rsync
+
+    Сравнивает список файлов с размерами и mtime (или sha1, если `checksum=True`) локально и на сервере,
+    получая список с сервера одной командой.
+    Изменившиеся файлы передаются одним tar-архивом через соединение carnival,
+    поэтому работают те же авторизация, gateway и пул соединений.
+
+    Передаются только обычные файлы, симлинки и пустые папки пропускаются.
+    """
+
+    def __init__(
+        self,
+        local_dir: str,
+        remote_dir: str,
+        delete: bool = False,
+        checksum: bool = False,
+        timeout: int = 600,
+    ):
+        """
+        :param local_dir: локальная папка
+        :param remote_dir: папка на сервере
+        :param delete: удалить на сервере файлы, которых нет в локальной папке
+        :param checksum: сравнивать файлы по sha1, а не по размеру и mtime
+        :param timeout: таймаут передачи
+        """
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.delete = delete
+        self.checksum = checksum
+        self.timeout = timeout
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}(local_dir={self.local_dir}, remote_dir={self.remote_dir})"
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.Local(validators.IsDirectoryValidator(self.local_dir)),
+            validators.CommandRequiredValidator("tar"),
+            validators.CommandRequiredValidator("find"),
+        ]
+
+    def _is_changed(self, local: _ManifestEntry, remote: typing.Optional[_ManifestEntry]) -> bool:
+        if remote is None or remote.size != local.size:
+            return True
+        if self.checksum:
+            return remote.sha1 != local.sha1
+        return remote.mtime != local.mtime
+
+    def _upload(self, c: Connection, paths: typing.List[str], total_size: int) -> None:
+        promise = c.run_promise(
+            f'mkdir -p "$(echo {self.remote_dir})" && tar --no-same-owner -xf - -C "$(echo {self.remote_dir})"',
+            use_sudo=c.use_sudo,
+            timeout=self.timeout,
+            pty=False,
+        )
+        with tqdm(
+            desc=f"Transferring {self.remote_dir}",
+            unit='B', unit_scale=True, unit_divisor=1024, total=total_size,
+            leave=False,
+        ) as pbar:
+            with tarfile.open(fileobj=promise.stdin, mode="w|", bufsize=DEFAULT_BUFSIZE) as tar:
+                for path in paths:
+                    local_path = os.path.join(self.local_dir, path)
+                    with open(local_path, 'rb') as fp:
+                        tar.addfile(tar.gettarinfo(local_path, arcname=path, fileobj=fp), fileobj=fp)
+                    pbar.update(os.path.getsize(local_path))
+        promise.close_stdin()
+        promise.get_result(hide=True).check_result(warn=False, hide=True)
+
+    def _remove(self, c: Connection, paths: typing.List[str]) -> None:
+        promise = c.run_promise(
+            f'cd "$(echo {self.remote_dir})" && xargs -0 rm -f --',
+            use_sudo=c.use_sudo,
+            timeout=self.timeout,
+            pty=False,
+        )
+        promise.stdin.write(b"\0".join(x.encode() for x in paths))
+        promise.close_stdin()
+        promise.get_result(hide=True).check_result(warn=False, hide=True)
+
+    def run(self, c: Connection) -> None:
+        local_manifest = _get_local_manifest(self.local_dir, checksum=self.checksum)
+        remote_manifest = _get_remote_manifest(c, self.remote_dir, checksum=self.checksum)
+
+        changed = sorted(x for x, entry in local_manifest.items() if self._is_changed(entry, remote_manifest.get(x)))
+        if changed:
+            total_size = sum(local_manifest[x].size for x in changed)
+            self._upload(c, changed, total_size)
+            size_str = tqdm.format_sizeof(total_size, suffix="B", divisor=1024)
+            self.log_action(self.remote_dir, f"{len(changed)} files transferred ({size_str})")
+
+        if self.delete:
+            extraneous = sorted(set(remote_manifest.keys()) - set(local_manifest.keys()))
+            if extraneous:
+                self._remove(c, extraneous)
+                self.log_action(self.remote_dir, f"{len(extraneous)} files deleted")
 
 
 class Rsync(Step):
@@ -278,8 +1610,13 @@ class Rsync(Step):
 
 
 __all__ = (
+    "StagedFile",
+    "commit_files",
+    "discard_files",
     "GetFile",
+    "GetFiles",
     "PutFile",
     "PutTemplate",
+    "PutDir",
     "Rsync",
 )
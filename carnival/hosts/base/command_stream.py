@@ -0,0 +1,58 @@
+import codecs
+import typing
+
+from .result import CapturedOutput
+from .result_promise import ResultPromise
+
+
+class CommandStream:
+    """
+    Вывод выполняющейся команды, см :py:meth:`carnival.Connection.stream`
+
+    Вывод читается с хоста только по мере того, как его запрашивает обработчик,
+    поэтому медленный обработчик притормаживает команду, а не копит ее вывод в памяти
+    """
+
+    def __init__(self, promise: ResultPromise) -> None:
+        self.promise = promise
+        self.stderr = CapturedOutput()
+        """
+        stderr команды, с pty он смешан с stdout
+        """
+        self.return_code: typing.Optional[int] = None
+        """
+        Код возврата, известен после того как вывод прочитан до конца
+        """
+        self._is_read = False
+
+    def chunks(self) -> typing.Iterator[bytes]:
+        """
+        Блоки stdout по мере поступления
+        """
+        assert not self._is_read, "Command output can be read only once"
+        self._is_read = True
+
+        for is_stderr, data in self.promise.iter_output():
+            if is_stderr:
+                self.stderr.write(data)
+            elif data:
+                yield data
+        self.return_code = self.promise.wait()
+
+    def lines(self) -> typing.Iterator[str]:
+        """
+        Строки stdout по мере поступления, без перевода строки
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        line_tail = ""
+        for chunk in self.chunks():
+            *lines, line_tail = (line_tail + decoder.decode(chunk)).split("\n")
+            for line in lines:
+                yield line.rstrip("\r")
+
+        line_tail += decoder.decode(b"", final=True)
+        if line_tail:
+            yield line_tail.rstrip("\r")
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return self.lines()
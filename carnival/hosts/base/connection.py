@@ -1,8 +1,11 @@
+import contextlib
 import typing
 import abc
 
+from .command_stream import CommandStream
 from .result import Result
 from .result_promise import ResultPromise
+from .shell_session import ShellSession
 from .stat_result import StatResult
 
 
@@ -18,7 +21,12 @@ class Connection:
 
     tempdir = "/tmp"
 
-    def __init__(self, host: "Host", use_sudo: bool = False) -> None:
+    session_timeout = 24 * 3600
+    """
+    Сколько может жить сессия shell, см :py:attr:`use_session`
+    """
+
+    def __init__(self, host: "Host", use_sudo: bool = False, pty: bool = True, use_session: bool = False) -> None:
         """
         Конекст с хостом, все конекты являются контекст-менеджерами
 
@@ -26,10 +34,22 @@ class Connection:
         >>>    c.run("ls -1")
 
         :param host: хост с которым связано соединение
-        :param use_sudo: использовать sudo для выполнения команд
+        :param use_sudo: использовать sudo для выполнения команд.
+            Команда целиком передается в `sudo sh -c`, переменные и glob раскрываются уже под sudo
+        :param pty: запускать команды в pseudo-terminal, если не указано другое.
+            Без pty stdout и stderr команды приходят раздельно и без изменений, см :py:attr:`Result.stdout_bytes`
+        :param use_session: выполнять :py:meth:`run` в одном постоянном shell, см :py:attr:`use_session`
         """
         self.host = host
         self.use_sudo = use_sudo
+        self.pty = pty
+        self.use_session = use_session
+        """
+        Выполнять :py:meth:`run` и :py:meth:`run_many` в постоянной сессии `sh` на хосте, а не отдельным процессом.
+        Сессия открывается при первой команде, для команд с sudo - своя сессия, повышение прав происходит один раз.
+        Команды в сессии выполняются без pty и без stdin
+        """
+        self._sessions: typing.Dict[bool, ShellSession] = {}
 
     def __enter__(self) -> "Connection":
         raise NotImplementedError
@@ -45,7 +65,18 @@ class Connection:
         env: typing.Optional[typing.Dict[str, str]] = None,
         cwd: typing.Optional[str] = None,
         timeout: int = 60,
+        pty: bool = True,
     ) -> ResultPromise:
+        """
+        Запустить команду, не дожидаясь ее завершения
+
+        :param command: Команда для запуска
+        :param use_sudo: использовать sudo для выполнения команды
+        :param env: задать переменные окружения для команды
+        :param cwd: Перейти в папку при выполнении команды
+        :param timeout: таймаут выполнения команды
+        :param pty: запустить команду в pseudo-terminal, для передачи бинарных данных через stdin нужно отключить
+        """
         raise NotImplementedError
 
     def run(
@@ -58,6 +89,7 @@ class Connection:
         warn: bool = False,
         cwd: typing.Optional[str] = None,
         timeout: int = 60,
+        pty: typing.Optional[bool] = None,
     ) -> Result:
         """
         Запустить команду
@@ -70,20 +102,140 @@ class Connection:
         :param warn: Вывести stderr
         :param cwd: Перейти в папку при выполнении команды
         :param timeout: таймаут выполнения команды
+        :param pty: запустить команду в pseudo-terminal, если не задано используется значение `self.pty`.
+            pty смешивает stderr с stdout и заменяет `\\n` на `\\r\\n`, для бинарного вывода его нужно отключить
         """
 
         if use_sudo is None:
             use_sudo = self.use_sudo
+        if pty is None:
+            pty = self.pty
+
+        promise: ResultPromise
+        if self.use_session:
+            promise = self._get_session(use_sudo).submit(command=command, env=env, cwd=cwd, timeout=timeout)
+        else:
+            promise = self.run_promise(
+                command=command,
+                env=env,
+                cwd=cwd,
+                use_sudo=use_sudo,
+                timeout=timeout,
+                pty=pty,
+            )
+        result = promise.get_result(hide=hide, show_command=show_command)
+        result.check_result(warn=warn, hide=hide)
+        return result
+
+    def run_many(
+        self,
+        commands: typing.Sequence[str],
+        use_sudo: typing.Optional[bool] = None,
+        env: typing.Optional[typing.Dict[str, str]] = None,
+        hide: bool = True,
+        warn: bool = False,
+        cwd: typing.Optional[str] = None,
+        timeout: int = 60,
+    ) -> typing.List[Result]:
+        """
+        Запустить несколько команд по очереди
+
+        В сессии (:py:attr:`use_session`) все команды отправляются сразу, не дожидаясь результатов предыдущих,
+        поэтому выполняются даже после ошибки одной из них. Без сессии равносильно :py:meth:`run` для каждой команды
+
+        Параметры как у :py:meth:`run`, для всех команд
+        """
+        if not self.use_session:
+            return [
+                self.run(command, use_sudo=use_sudo, env=env, hide=hide, warn=warn, cwd=cwd, timeout=timeout)
+                for command in commands
+            ]
+
+        if use_sudo is None:
+            use_sudo = self.use_sudo
+        session = self._get_session(use_sudo)
+        promises = [session.submit(command=command, env=env, cwd=cwd, timeout=timeout) for command in commands]
+
+        results: typing.List[Result] = []
+        for promise in promises:
+            result = promise.get_result(hide=hide)
+            result.check_result(warn=warn, hide=hide)
+            results.append(result)
+        return results
+
+    def _get_session(self, use_sudo: bool) -> ShellSession:
+        session = self._sessions.get(use_sudo)
+        if session is None or session.is_broken:
+            promise = self.run_promise("sh", use_sudo=use_sudo, timeout=self.session_timeout, pty=False)
+            session = ShellSession(promise)
+            self._sessions[use_sudo] = session
+        return session
+
+    def close_sessions(self) -> None:
+        """
+        Завершить сессии shell, см :py:attr:`use_session`
+        """
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
 
-        result = self.run_promise(
+    @contextlib.contextmanager
+    def stream(
+        self,
+        command: str,
+        use_sudo: typing.Optional[bool] = None,
+        env: typing.Optional[typing.Dict[str, str]] = None,
+        warn: bool = False,
+        cwd: typing.Optional[str] = None,
+        timeout: int = 60,
+        pty: typing.Optional[bool] = None,
+    ) -> typing.Iterator[CommandStream]:
+        """
+        Запустить команду и читать ее вывод по мере поступления, например логи
+
+        Если выйти из контекста, не дочитав вывод, команда прерывается.
+        Если вывод прочитан до конца, код возврата проверяется как в :py:meth:`run`
+
+        >>> with c.stream("journalctl -f -u nginx") as lines:
+        >>>     for line in lines:
+        >>>         if "emerg" in line:
+        >>>             break
+
+        :param command: Команда для запуска
+        :param use_sudo: использовать sudo для выполнения команды, если не задано используется значение `self.use_sudo`
+        :param env: задать переменные окружения для команды
+        :param warn: Вывести stderr вместо исключения, если команда завершилась с ошибкой
+        :param cwd: Перейти в папку при выполнении команды
+        :param timeout: таймаут выполнения команды
+        :param pty: запустить команду в pseudo-terminal, тогда при прерывании команда получит SIGHUP.
+            Если не задано используется значение `self.pty`
+        """
+        if use_sudo is None:
+            use_sudo = self.use_sudo
+        if pty is None:
+            pty = self.pty
+
+        promise = self.run_promise(
             command=command,
             env=env,
             cwd=cwd,
             use_sudo=use_sudo,
             timeout=timeout,
-        ).get_result(hide=hide, show_command=show_command)
-        result.check_result(warn=warn, hide=hide)
-        return result
+            pty=pty,
+        )
+        stream = CommandStream(promise)
+        try:
+            yield stream
+        finally:
+            promise.close()
+
+        if stream.return_code is not None:
+            Result(
+                return_code=stream.return_code,
+                stderr=stream.stderr,
+                stdout="",
+                command=promise.command,
+            ).check_result(warn=warn, hide=True)
 
     @abc.abstractmethod
     def file_stat(self, path: str) -> StatResult:
@@ -94,22 +246,55 @@ class Connection:
         :param path:  путь до файла
         """
 
+    def file_stat_many(self, paths: typing.Sequence[str]) -> typing.List[typing.Optional[StatResult]]:
+        """
+        Получить fstat нескольких файлов за один раз,
+        не поддерживает `use_sudo`
+
+        :param paths: пути до файлов
+        :return: fstat в порядке `paths`, `None` для несуществующих файлов
+        """
+        results: typing.List[typing.Optional[StatResult]] = []
+        for path in paths:
+            try:
+                results.append(self.file_stat(path))
+            except FileNotFoundError:
+                results.append(None)
+        return results
+
+    def exists_many(self, paths: typing.Sequence[str]) -> typing.List[bool]:
+        """
+        Проверить существование нескольких файлов за один раз,
+        не поддерживает `use_sudo`
+
+        :param paths: пути до файлов
+        """
+        return [x is not None for x in self.file_stat_many(paths)]
+
     @abc.abstractmethod
-    def file_read(self, path: str) -> typing.ContextManager[typing.IO[bytes]]:
+    def file_read(
+        self,
+        path: str,
+        offset: int = 0,
+        size: typing.Optional[int] = None,
+    ) -> typing.ContextManager[typing.IO[bytes]]:
         """
         Открыть файл на чтение
         не поддерживает `use_sudo`
 
         :param path: путь до файла
+        :param offset: начать чтение с позиции
+        :param size: сколько байт будет прочитано, ограничивает чтение наперед. `None` - до конца файла
         :return: дескриптор файла
         """
 
     @abc.abstractmethod
-    def file_write(self, path: str) -> typing.ContextManager[typing.IO[bytes]]:
+    def file_write(self, path: str, offset: typing.Optional[int] = None) -> typing.ContextManager[typing.IO[bytes]]:
         """
         Открыть файл на запись
         не поддерживает `use_sudo`
 
         :param path: путь до файла
+        :param offset: писать с позиции, не обрезая файл. `None` - перезаписать файл
         :return: дескриптор файла
         """
@@ -1,18 +1,106 @@
+import io
+import tempfile
+import typing
+
 
 class CommandError(BaseException):
     pass
 
 
+capture_spill_size = 1024 * 1024
+"""
+Сколько байт вывода команды держать в памяти, остальное пишется во временный файл
+"""
+
+capture_head_size = 64 * 1024
+"""
+Сколько байт начала вывода команды показывать при ошибке
+"""
+
+capture_tail_size = 64 * 1024
+"""
+Сколько байт конца вывода команды показывать при ошибке
+"""
+
+
+class CapturedOutput:
+    """
+    Вывод одного потока команды
+
+    Первые :py:data:`capture_spill_size` байт хранятся в памяти, дальше вывод пишется во временный файл.
+    Начало и конец вывода всегда доступны без чтения файла
+    """
+
+    def __init__(self) -> None:
+        self.size = 0
+        self.head = b""
+        self._tail = bytearray()
+        self._buffer: typing.Optional[io.BytesIO] = io.BytesIO()
+        self._file: typing.Optional[typing.IO[bytes]] = None
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if len(self.head) < capture_head_size:
+            self.head += data[:capture_head_size - len(self.head)]
+        self._tail += data[-capture_tail_size:]
+        del self._tail[:-capture_tail_size]
+
+        if self._buffer is not None and self._buffer.tell() + len(data) > capture_spill_size:
+            self._file = tempfile.TemporaryFile()
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+
+        if self._buffer is not None:
+            self._buffer.write(data)
+        else:
+            assert self._file is not None
+            self._file.write(data)
+
+    @property
+    def tail(self) -> bytes:
+        return bytes(self._tail)
+
+    def getvalue(self) -> bytes:
+        """
+        Прочитать весь вывод
+        """
+        if self._buffer is not None:
+            return self._buffer.getvalue()
+
+        assert self._file is not None
+        self._file.seek(0)
+        data = self._file.read()
+        self._file.seek(0, io.SEEK_END)
+        return data
+
+    def get_summary(self) -> bytes:
+        """
+        Вывод целиком, если он небольшой, иначе начало и конец
+        """
+        if self.size <= capture_head_size + capture_tail_size:
+            return self.getvalue()
+        skipped = self.size - len(self.head) - len(self._tail)
+        return self.head + f"\n... {skipped} bytes skipped ...\n".encode() + self.tail
+
+
+def _clean(data: typing.Union[str, bytes]) -> str:
+    if isinstance(data, bytes):
+        data = data.decode()
+    return data.replace("\r", "").strip()
+
+
 class Result:
     """
     Результат выполнения команды
+
+    Большой вывод команды хранится во временном файле и читается при первом обращении к `stdout`/`stderr`
     """
 
     def __init__(
             self,
             return_code: int,
-            stderr: str,
-            stdout: str,
+            stderr: typing.Union[str, CapturedOutput],
+            stdout: typing.Union[str, CapturedOutput],
             command: str,
     ) -> None:
         """
@@ -24,28 +112,79 @@ class Result:
         """
         self.command = command
         self.return_code = return_code
-        self.stderr = stderr.replace("\r", "").strip()
-        self.stdout = stdout.replace("\r", "").strip()
+        self._stderr_output = stderr
+        self._stdout_output = stdout
+        self._stderr: typing.Optional[str] = None
+        self._stdout: typing.Optional[str] = None
+
+    @property
+    def stdout(self) -> str:
+        """
+        stdout команды без `\\r` и пробелов по краям
+        """
+        if self._stdout is None:
+            self._stdout = _clean(self._get_bytes(self._stdout_output))
+        return self._stdout
+
+    @property
+    def stderr(self) -> str:
+        """
+        stderr команды без `\\r` и пробелов по краям
+        """
+        if self._stderr is None:
+            self._stderr = _clean(self._get_bytes(self._stderr_output))
+        return self._stderr
+
+    @property
+    def stdout_bytes(self) -> bytes:
+        """
+        stdout команды без изменений, для бинарного вывода. Команда должна быть запущена без pty
+        """
+        return self._get_bytes(self._stdout_output)
+
+    @property
+    def stderr_bytes(self) -> bytes:
+        """
+        stderr команды без изменений. С pty stderr смешан с stdout
+        """
+        return self._get_bytes(self._stderr_output)
+
+    @staticmethod
+    def _get_bytes(output: typing.Union[str, CapturedOutput]) -> bytes:
+        if isinstance(output, CapturedOutput):
+            return output.getvalue()
+        return output.encode()
+
+    @staticmethod
+    def _summary(output: typing.Union[str, CapturedOutput]) -> str:
+        if isinstance(output, CapturedOutput):
+            # Head and tail may cut multibyte characters
+            return _clean(output.get_summary().decode(errors="replace"))
+        return _clean(output)
 
     def check_result(self, warn: bool, hide: bool) -> None:
         """
         Проверить результат выполнения, выкинуть ошибку если она была
 
+        Большой вывод показывается началом и концом, см :py:data:`capture_head_size`
+
         :param warn: вывести результат неуспешной команды вместо того чтобы выкинуть исключение :py:exc:`.CommandError`
         """
         if not self.ok:
+            stdout = self._summary(self._stdout_output)
+            stderr = self._summary(self._stderr_output)
             if warn:
                 if not hide:
-                    if self.stdout:
-                        print(self.stdout, flush=True)
-                    if self.stderr:
-                        print(self.stderr, flush=True)
+                    if stdout:
+                        print(stdout, flush=True)
+                    if stderr:
+                        print(stderr, flush=True)
 
             if not warn:
-                if self.stdout:
-                    print(self.stdout, flush=True)
-                if self.stderr:
-                    print(self.stderr, flush=True)
+                if stdout:
+                    print(stdout, flush=True)
+                if stderr:
+                    print(stderr, flush=True)
                 raise CommandError(f"{self.command} failed with exist code: {self.return_code}")
 
     @property
@@ -1,25 +1,65 @@
-import io
-from threading import Thread
 import sys
+import time
 import typing
 import abc
+from subprocess import TimeoutExpired
 
 from colorama import Fore as F  # type: ignore
 
-from .result import Result
+from .result import CapturedOutput, Result
+
+
+OUTPUT_CHUNK_SIZE = 64 * 1024
+"""
+Сколько байт вывода команды читать за раз
+"""
+
+OUTPUT_FLUSH_INTERVAL = 0.1
+"""
+Как часто, в секундах, выводить на экран накопленный вывод команды без перевода строки
+"""
 
 
 class ResultPromise:
     command: str
+    timeout: int
+    stdin: typing.IO[bytes]
     stdout: typing.IO[bytes]
     stderr: typing.IO[bytes]
 
+    def close_stdin(self) -> None:
+        """
+        Закрыть stdin команды, команда получит EOF
+        """
+        self.stdin.close()
+
     @abc.abstractmethod
     def is_done(self) -> bool: ...
 
+    @abc.abstractmethod
+    def close(self) -> None:
+        """
+        Прервать команду, если она еще выполняется, и освободить ее потоки
+        """
+
+    @abc.abstractmethod
+    def iter_output(self, idle_timeout: typing.Optional[float] = None) -> typing.Iterator[typing.Tuple[bool, bytes]]:
+        """
+        Читать stdout и stderr команды одновременно, блоками по мере поступления, до конца обоих потоков
+
+        :param idle_timeout: если за это время новых данных не было, вернуть пустой блок
+        :return: пары (это stderr, блок данных)
+        """
+
     @abc.abstractmethod
     def wait(self) -> int: ...
 
+    def _get_hidden_deadline(self) -> typing.Optional[float]:
+        """
+        Время, после которого прервать скрытую команду, `None` - ждать завершения
+        """
+        return None
+
     def get_result(self, hide: bool, show_command: bool = False) -> Result:
         """
         Получить результат
@@ -30,53 +70,41 @@ class ResultPromise:
         if show_command is True:
             print(f"{F.GREEN}${F.RESET} {self.command}")
 
-        if hide is True:
-            retcode = self.wait()
-            return Result(
-                return_code=retcode,
-                stderr=self.stderr.read().decode(),
-                stdout=self.stdout.read().decode(),
-                command=self.command,
-            )
-
-        # Копируем stdout & stderr команды на экран и в буферы
-        # чтобы вернуть результат
-        threads = []
-
-        cmd_stdout = io.BytesIO()
-        cmd_stderr = io.BytesIO()
-
-        def output_thread(fromio: typing.IO[bytes], toios: typing.List[typing.IO[bytes]]) -> None:
-            while not self.is_done():
-                try:
-                    data = fromio.read(1)
-                except IOError:
-                    continue
-                for toio in toios:
-                    toio.write(data)
-                    toio.flush()
-
-            data = fromio.read()
-            for toio in toios:
-                toio.write(data)
-                toio.flush()
-
-        threads.append(Thread(target=output_thread, args=(self.stdout, [sys.stdout.buffer, cmd_stdout])))
-        threads.append(Thread(target=output_thread, args=(self.stderr, [sys.stderr.buffer, cmd_stderr])))
-
-        for t in threads:
-            t.start()
-
-        for t in threads:
-            t.join()
-
-        cmd_stdout.seek(0)
-        cmd_stderr.seek(0)
+        # Вывод читается одновременно с выполнением команды, иначе команда с большим выводом
+        # заблокируется на записи в заполненный канал
+        cmd_stdout = CapturedOutput()
+        cmd_stderr = CapturedOutput()
+        outputs = {False: (sys.stdout.buffer, cmd_stdout), True: (sys.stderr.buffer, cmd_stderr)}
+        deadline = self._get_hidden_deadline() if hide else None
+        flushed_at = time.monotonic()
+        pending = set()
+
+        for is_stderr, data in self.iter_output(idle_timeout=OUTPUT_FLUSH_INTERVAL):
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutExpired(self.command, self.timeout)
+
+            screen, buffer = outputs[is_stderr]
+            buffer.write(data)
+            if hide:
+                continue
+            if data:
+                screen.write(data)
+                pending.add(screen)
+
+            # Flush complete lines at once, partial lines like prompts after a short delay
+            if pending and (b"\n" in data or time.monotonic() - flushed_at >= OUTPUT_FLUSH_INTERVAL):
+                for screen in pending:
+                    screen.flush()
+                pending.clear()
+                flushed_at = time.monotonic()
+
+        for screen in pending:
+            screen.flush()
 
         retcode = self.wait()
         return Result(
             return_code=retcode,
-            stderr=cmd_stderr.read().decode(),
-            stdout=cmd_stdout.read().decode(),
+            stderr=cmd_stderr,
+            stdout=cmd_stdout,
             command=self.command,
         )
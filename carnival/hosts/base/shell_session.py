@@ -0,0 +1,212 @@
+"""
+Постоянная сессия shell на хосте, см :py:attr:`carnival.Connection.use_session`
+
+Команды пишутся в stdin одного долгоживущего `sh` и выполняются по очереди.
+Конец вывода каждой команды отмечается уникальным маркером, после маркера в stdout пишется код возврата
+"""
+
+import collections
+import io
+import shlex
+import threading
+import time
+import typing
+from uuid import uuid4
+
+from .result import Result
+from .result_promise import OUTPUT_FLUSH_INTERVAL, ResultPromise
+
+
+class SessionError(IOError):
+    """
+    Сессия shell оборвалась, команда могла не выполниться
+    """
+
+
+class _SessionCommand:
+    def __init__(self, marker: bytes) -> None:
+        self.marker = marker
+        self.chunks: typing.Deque[typing.Tuple[bool, bytes]] = collections.deque()
+        # stdout, stderr
+        self.done = [False, False]
+        self.return_code: typing.Optional[int] = None
+
+    @property
+    def is_done(self) -> bool:
+        return all(self.done)
+
+
+class ShellSession:
+    """
+    Сессия shell, через которую выполняются команды соединения
+
+    Команды можно отправлять, не дожидаясь результата предыдущих, результаты читаются по порядку
+    """
+
+    def __init__(self, promise: ResultPromise) -> None:
+        """
+        :param promise: запущенный `sh` без pty, читающий команды из stdin
+        """
+        self.promise = promise
+        self.is_broken = False
+        self._lock = threading.RLock()
+        self._output = promise.iter_output(idle_timeout=OUTPUT_FLUSH_INTERVAL)
+        self._queue: typing.Deque[_SessionCommand] = collections.deque()
+        # Not yet parsed output tails of stdout and stderr, may contain beginning of a marker
+        self._pending = [b"", b""]
+
+    def submit(
+        self,
+        command: str,
+        env: typing.Optional[typing.Dict[str, str]] = None,
+        cwd: typing.Optional[str] = None,
+        timeout: int = 60,
+    ) -> "SessionResultPromise":
+        """
+        Отправить команду, не дожидаясь результата
+
+        Команда выполняется в подоболочке, поэтому `cd`, `export` и `exit` не влияют на следующие команды.
+        stdin команды - `/dev/null`
+        """
+        marker = f"__carnival_{uuid4().hex}__"
+        script = f"eval {shlex.quote(command)}"
+        if env:
+            script = "".join(f"export {k}={shlex.quote(v)}; " for k, v in env.items()) + script
+        if cwd is not None:
+            script = f"cd {cwd} && {script}"
+        script = (
+            f"( {script} ) </dev/null; "
+            # Leading newline separates marker from output without trailing newline, it is not part of output
+            f"printf '\\n{marker} %d\\n' $?; printf '\\n{marker}\\n' >&2\n"
+        )
+
+        with self._lock:
+            if self.is_broken:
+                raise SessionError("Shell session is closed")
+            entry = _SessionCommand(marker.encode())
+            self._queue.append(entry)
+            try:
+                self.promise.stdin.write(script.encode())
+                self.promise.stdin.flush()
+            except (OSError, ValueError) as ex:
+                self.close()
+                raise SessionError(f"Shell session is closed: {ex}") from ex
+        return SessionResultPromise(self, entry, command=command, timeout=timeout)
+
+    def _read(self) -> None:
+        """
+        Прочитать следующий блок вывода и разобрать его по командам
+        """
+        try:
+            is_stderr, data = next(self._output)
+        except (StopIteration, OSError) as ex:
+            self.close()
+            raise SessionError("Shell session is closed") from ex
+
+        if data:
+            self._parse(is_stderr, self._pending[is_stderr] + data)
+            while self._queue and self._queue[0].is_done:
+                self._queue.popleft()
+
+    def _parse(self, is_stderr: bool, data: bytes) -> None:
+        for entry in self._queue:
+            if entry.done[is_stderr]:
+                continue
+
+            marker = b"\n" + entry.marker
+            index = data.find(marker)
+            if index == -1:
+                # Keep possible beginning of marker until next block
+                keep = min(len(data), len(marker) - 1)
+                if len(data) > keep:
+                    entry.chunks.append((is_stderr, data[:len(data) - keep]))
+                self._pending[is_stderr] = data[len(data) - keep:]
+                return
+
+            trailer_end = data.find(b"\n", index + len(marker))
+            if trailer_end == -1:
+                # Marker line is not complete yet
+                if index > 0:
+                    entry.chunks.append((is_stderr, data[:index]))
+                self._pending[is_stderr] = data[index:]
+                return
+
+            if index > 0:
+                entry.chunks.append((is_stderr, data[:index]))
+            if not is_stderr:
+                entry.return_code = int(data[index + len(marker):trailer_end])
+            entry.done[is_stderr] = True
+            data = data[trailer_end + 1:]
+
+        # Output after all known commands can only come from background processes
+        self._pending[is_stderr] = b""
+
+    def next_chunk(self, entry: _SessionCommand) -> typing.Optional[typing.Tuple[bool, bytes]]:
+        """
+        Следующий блок вывода команды, пустой блок если данных пока нет, `None` если вывод закончился
+        """
+        with self._lock:
+            if entry.chunks:
+                return entry.chunks.popleft()
+            if entry.is_done:
+                return None
+            self._read()
+            if entry.chunks:
+                return entry.chunks.popleft()
+            return False, b""
+
+    def close(self) -> None:
+        """
+        Завершить shell, команды в очереди завершатся с :py:exc:`SessionError`
+        """
+        with self._lock:
+            self.is_broken = True
+            self.promise.close()
+
+
+class SessionResultPromise(ResultPromise):
+    """
+    Команда, отправленная в :py:class:`ShellSession`
+    """
+
+    def __init__(self, session: ShellSession, entry: _SessionCommand, command: str, timeout: int) -> None:
+        self.session = session
+        self.entry = entry
+        self.command = command
+        self.timeout = timeout
+        self.started_at = time.monotonic()
+        self.stdin = io.BytesIO()
+
+    def close_stdin(self) -> None:
+        pass
+
+    def is_done(self) -> bool:
+        return self.entry.is_done
+
+    def close(self) -> None:
+        if not self.entry.is_done:
+            # Command is still running in the shell, it can be stopped only with the shell
+            self.session.close()
+
+    def iter_output(self, idle_timeout: typing.Optional[float] = None) -> typing.Iterator[typing.Tuple[bool, bytes]]:
+        while True:
+            chunk = self.session.next_chunk(self.entry)
+            if chunk is None:
+                return
+            yield chunk
+
+    def wait(self) -> int:
+        for _ in self.iter_output():
+            pass
+        assert self.entry.return_code is not None
+        return self.entry.return_code
+
+    def _get_hidden_deadline(self) -> typing.Optional[float]:
+        return self.started_at + self.timeout
+
+    def get_result(self, hide: bool, show_command: bool = False) -> Result:
+        try:
+            return super().get_result(hide=hide, show_command=show_command)
+        except BaseException:
+            self.close()
+            raise
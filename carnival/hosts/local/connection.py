@@ -12,7 +12,7 @@ class LocalConnection(Connection):
         return self
 
     def __exit__(self, *args: typing.Any) -> None:
-        pass
+        self.close_sessions()
 
     def run_promise(
             self,
@@ -21,6 +21,7 @@ class LocalConnection(Connection):
             env: typing.Optional[typing.Dict[str, str]] = None,
             cwd: typing.Optional[str] = None,
             timeout: int = 60,
+            pty: bool = True,
     ) -> LocalResultPromise:
         return LocalResultPromise(
             command=command,
@@ -40,8 +41,20 @@ class LocalConnection(Connection):
             st_atime=stat.st_atime,
         )
 
-    def file_read(self, path: str) -> typing.ContextManager[typing.IO[bytes]]:
-        return open(path, 'rb')
-
-    def file_write(self, path: str) -> typing.ContextManager[typing.IO[bytes]]:
-        return open(path, 'wb')
+    def file_read(
+        self,
+        path: str,
+        offset: int = 0,
+        size: typing.Optional[int] = None,
+    ) -> typing.ContextManager[typing.IO[bytes]]:
+        reader = open(path, 'rb')
+        reader.seek(offset)
+        return reader
+
+    def file_write(self, path: str, offset: typing.Optional[int] = None) -> typing.ContextManager[typing.IO[bytes]]:
+        if offset is None:
+            return open(path, 'wb')
+
+        writer = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT, 0o666), 'wb')
+        writer.seek(offset)
+        return writer
@@ -1,10 +1,18 @@
+import selectors
+import shlex
+import time
 import typing
 import os
-from subprocess import Popen, PIPE
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired, run
 
-from carnival.hosts.base.result_promise import ResultPromise
+from carnival.hosts.base.result_promise import OUTPUT_CHUNK_SIZE, ResultPromise
 from carnival.hosts.base.result import Result
 
+CLOSE_TIMEOUT = 5
+"""
+Сколько секунд ждать завершения прерванной команды
+"""
+
 
 class LocalResultPromise(ResultPromise):
     def __init__(
@@ -19,27 +27,92 @@ class LocalResultPromise(ResultPromise):
         if env is not None:
             proc_env.update(env)
 
+        args: typing.Union[str, typing.List[str]] = command
         if use_sudo is True:
-            command = f"sudo -n -- sh -c '{command}'"
+            # Without intermediate shell process is sudo itself and can be signalled, see `close`
+            args = ["sudo", "-n", "--", "sh", "-c", command]
+            command = f"sudo -n -- sh -c {shlex.quote(command)}"
 
         self.proc = Popen(
-            command, shell=True,
+            args, shell=not use_sudo,
             stderr=PIPE, stdin=PIPE, stdout=PIPE, cwd=cwd,
             env=proc_env,
         )
         self.command = command
+        self.use_sudo = use_sudo
+        assert self.proc.stdin is not None
         assert self.proc.stdout is not None
         assert self.proc.stderr is not None
+        self.stdin = self.proc.stdin
         self.stdout = self.proc.stdout
         self.stderr = self.proc.stderr
         self.timeout = timeout
 
+    def _sudo_kill(self, signal: str) -> None:
+        # sudo runs as root, it can be signalled only through sudo. sudo relays SIGTERM to the command
+        try:
+            run(
+                ["sudo", "-n", "kill", f"-{signal}", str(self.proc.pid)],
+                stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, timeout=CLOSE_TIMEOUT,
+            )
+        except (OSError, TimeoutExpired):
+            pass
+
+    def _wait_closed(self) -> bool:
+        try:
+            self.proc.wait(timeout=CLOSE_TIMEOUT)
+            return True
+        except TimeoutExpired:
+            return False
+
+    def close(self) -> None:
+        if self.proc.poll() is None:
+            if not self.use_sudo:
+                try:
+                    self.proc.kill()
+                except ProcessLookupError:
+                    pass
+                self._wait_closed()
+            else:
+                self._sudo_kill("TERM")
+                if not self._wait_closed():
+                    self._sudo_kill("KILL")
+                    self._wait_closed()
+
+        # Popen.__exit__ would wait for a command that could not be stopped
+        for stream in (self.stdin, self.stdout, self.stderr):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
     def is_done(self) -> bool:
         return self.proc.poll() is not None
 
     def wait(self) -> int:
         return self.proc.wait(timeout=self.timeout)
 
+    def _get_hidden_deadline(self) -> typing.Optional[float]:
+        return time.monotonic() + self.timeout
+
+    def iter_output(self, idle_timeout: typing.Optional[float] = None) -> typing.Iterator[typing.Tuple[bool, bytes]]:
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.stdout.fileno(), selectors.EVENT_READ, False)
+            selector.register(self.stderr.fileno(), selectors.EVENT_READ, True)
+
+            while selector.get_map():
+                events = selector.select(timeout=idle_timeout)
+                if not events:
+                    yield False, b""
+                    continue
+
+                for key, _ in events:
+                    data = os.read(key.fd, OUTPUT_CHUNK_SIZE)
+                    if data:
+                        yield key.data, data
+                    else:
+                        selector.unregister(key.fd)
+
     def get_result(self, hide: bool, show_command: bool = False) -> Result:
         result = super().get_result(hide=hide, show_command=show_command)
         self.proc.__exit__(None, None, None)
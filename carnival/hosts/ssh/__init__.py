@@ -5,6 +5,7 @@ from paramiko.config import SSH_PORT
 
 from carnival.hosts.base.host import Host
 from .connection import SshConnection
+from .pool import connection_pool
 from .ssh_config import SSHConfig
 
 
@@ -30,6 +31,8 @@ class SshHost(Host):
         gateway: typing.Optional['SshHost'] = None,
         connect_timeout: int = 10,
         missing_host_key_policy: typing.Type[MissingHostKeyPolicy] = AutoAddPolicy,
+        pty: bool = True,
+        use_session: bool = False,
     ):
         """
         :param addr: Адрес сервера
@@ -39,8 +42,12 @@ class SshHost(Host):
         :param gateway: Gateway
         :param connect_timeout: SSH таймаут соединения
         :param missing_host_key_policy: политика system host keys
+        :param pty: запускать команды в pseudo-terminal, см :py:class:`carnival.Connection`
+        :param use_session: выполнять команды в постоянной сессии shell, см :py:attr:`carnival.Connection.use_session`
         """
         super(SshHost, self).__init__(use_sudo=use_sudo)
+        self.pty = pty
+        self.use_session = use_session
 
         if ":" in addr:
             raise ValueError("Please set port in 'ssh_port' arg")
@@ -69,10 +76,22 @@ class SshHost(Host):
 
     def connect(self) -> SshConnection:
         """
+        SSH-соединение берется из общего пула :py:data:`connection_pool`,
+        поэтому повторные вызовы не приводят к новому рукопожатию
+
         :returns: Возвращает контекстменеджер соединения для хоста
         """
         return SshConnection(
             host=self,
             conf=self.connect_config,
             use_sudo=self.use_sudo,
+            pty=self.pty,
+            use_session=self.use_session,
         )
+
+
+__all__ = (
+    'SshHost',
+    'SshConnection',
+    'connection_pool',
+)
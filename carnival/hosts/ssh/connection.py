@@ -2,11 +2,18 @@ import typing
 from contextlib import contextmanager
 
 from paramiko.client import SSHClient
+from paramiko.message import Message
+from paramiko.pkey import PKey
+from paramiko.sftp import CMD_ATTRS, CMD_READ, CMD_STAT, CMD_STATUS, SFTPError
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.sftp_client import SFTPClient
+from paramiko.sftp_file import SFTPFile
 
 from carnival.hosts.base.connection import Connection
 from carnival.hosts.base.result_promise import ResultPromise
 from carnival.hosts.base.stat_result import StatResult
 
+from .pool import connection_pool
 from .result_promise import SshResultPromise
 from .ssh_config import HostnameConfig
 
@@ -15,17 +22,102 @@ if typing.TYPE_CHECKING:
     from carnival.hosts.ssh import SshHost
 
 
+try:
+    # Exists only in paramiko 2.x, the same versions have private apis used below
+    from paramiko.py3compat import long  # type: ignore
+except ImportError:  # pragma: no cover
+    long = None
+
+# paramiko has no public api for pipelined requests, private one is checked before use and
+# pyproject.toml pins paramiko to 2.x where it is known to work. Without it requests are sent one by one
+_sftp_pipelining = long is not None and all(
+    hasattr(SFTPClient, name) for name in ("_async_request", "_read_response", "_convert_status", "_adjust_cwd")
+) and all(
+    hasattr(SFTPFile, name) for name in ("MAX_REQUEST_SIZE", "_async_response")
+)
+
+
+sftp_prefetch_window = 8 * 1024 * 1024
+"""
+Сколько байт файла запрашивать заранее при чтении через SFTP.
+Больше окно - меньше простоев на медленных каналах, но больше памяти под непрочитанные блоки
+"""
+
+
+class _PrefetchReader:
+    """
+    Файл SFTP, который при последовательном чтении запрашивает блоки заранее
+
+    `SFTPFile.prefetch` запрашивает сразу весь файл и держит его в памяти, пока его не прочитают,
+    здесь запрошено не больше :py:data:`sftp_prefetch_window` байт впереди текущей позиции.
+    Остальные методы файла передаются `SFTPFile` как есть
+    """
+
+    def __init__(self, reader: SFTPFile, end: int) -> None:
+        self.reader = reader
+        self.end = end
+        self._prefetched = reader.tell()
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self.reader, name)
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        return iter(self.reader)
+
+    def __enter__(self) -> "_PrefetchReader":
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.reader.close()
+
+    def _prefetch(self, stop: int) -> None:
+        # Same as `SFTPFile._start_prefetch`, but without thread: window is small enough to send requests at once
+        reader = self.reader
+        reader._prefetching = True  # type: ignore
+        reader._prefetch_done = False  # type: ignore
+        for offset in range(self._prefetched, stop, reader.MAX_REQUEST_SIZE):
+            length = min(reader.MAX_REQUEST_SIZE, stop - offset)
+            num = reader.sftp._async_request(  # type: ignore
+                reader, CMD_READ, reader.handle, long(offset), int(length),
+            )
+            with reader._prefetch_lock:  # type: ignore
+                reader._prefetch_extents[num] = (offset, length)  # type: ignore
+        self._prefetched = stop
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self.reader.seek(offset, whence)
+        # Blocks already requested are still used if reading returns to them
+        self._prefetched = self.reader.tell()
+        return self._prefetched
+
+    def read(self, size: typing.Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            # Whole rest of file in window sized reads, each of them extends prefetch
+            return b"".join(iter(lambda: self.read(sftp_prefetch_window // 2), b""))
+
+        position = self.reader.tell()
+        self._prefetched = max(self._prefetched, position)
+        if self._prefetched < self.end and self._prefetched - position < sftp_prefetch_window // 2:
+            self._prefetch(min(self.end, position + sftp_prefetch_window))
+
+        data: bytes = self.reader.read(size)
+        return data
+
+
 class SshConnection(Connection):
     def __init__(
         self,
         host: "SshHost",
         conf: HostnameConfig,
         use_sudo: bool = False,
+        pty: bool = True,
+        use_session: bool = False,
     ) -> None:
-        super().__init__(host=host, use_sudo=use_sudo)
+        super().__init__(host=host, use_sudo=use_sudo, pty=pty, use_session=use_session)
         self.host: "SshHost" = host
         self.conf = conf
         self.conn: typing.Optional[SSHClient] = None
+        self.sftp: typing.Optional[SFTPClient] = None
 
     def __enter__(self) -> "SshConnection":
         # Connection now lazy, see `._ensure_connection`
@@ -33,12 +125,18 @@ class SshConnection(Connection):
         return self
 
     def __exit__(self, *args: typing.Any) -> None:
+        self.close_sessions()
+        if self.sftp is not None:
+            self.sftp.close()
+            self.sftp = None
         if self.conn is not None:
-            self.conn.close()
+            # Connection belongs to pool, it is closed when last user releases it
+            connection_pool.release(self.conf)
+            self.conn = None
 
     def _ensure_connection(self) -> None:
         if self.conn is None:
-            self.conn = self.conf.connect()
+            self.conn = connection_pool.get(self.conf)
 
     def run_promise(
         self,
@@ -47,7 +145,12 @@ class SshConnection(Connection):
         env: typing.Optional[typing.Dict[str, str]] = None,
         cwd: typing.Optional[str] = None,
         timeout: int = 60,
+        pty: bool = True,
+        forward_agent: bool = False,
     ) -> ResultPromise:
+        """
+        :param forward_agent: пробросить локальный ssh-agent в команду, например для ssh с сервера на другой сервер
+        """
         self._ensure_connection()
         assert self.conn is not None, "Connection is not opened"
         return SshResultPromise(
@@ -57,14 +160,32 @@ class SshConnection(Connection):
             cwd=cwd,
             use_sudo=use_sudo,
             timeout=timeout,
+            pty=pty,
+            forward_agent=forward_agent,
         )
 
-    def file_stat(self, path: str) -> StatResult:
+    def get_host_key(self) -> PKey:
+        """
+        Ключ, которым хост представился при подключении, проверяется по `missing_host_key_policy` хоста
+        """
+        self._ensure_connection()
+        assert self.conn is not None, "Connection is not opened"
+        transport = self.conn.get_transport()
+        assert transport is not None, "Connection is not opened"
+        return transport.get_remote_server_key()
+
+    def _get_sftp(self) -> SFTPClient:
+        """
+        SFTP-сессия открывается при первом обращении и переиспользуется до выхода из контекста
+        """
         self._ensure_connection()
         assert self.conn is not None, "Connection is not opened"
-        sftp = self.conn.open_sftp()
+        if self.sftp is None:
+            self.sftp = self.conn.open_sftp()
+        return self.sftp
 
-        stat = sftp.stat(path)
+    @staticmethod
+    def _to_stat_result(stat: SFTPAttributes) -> StatResult:
         assert stat.st_mode is not None
         assert stat.st_size is not None
         assert stat.st_uid is not None
@@ -79,20 +200,73 @@ class SshConnection(Connection):
             st_atime=stat.st_atime,
         )
 
+    def file_stat(self, path: str) -> StatResult:
+        return self._to_stat_result(self._get_sftp().stat(path))
+
+    def file_stat_many(self, paths: typing.Sequence[str]) -> typing.List[typing.Optional[StatResult]]:
+        if not _sftp_pipelining:
+            return super().file_stat_many(paths)
+
+        sftp = self._get_sftp()
+        responses: typing.Dict[int, typing.Tuple[int, Message]] = {}
+
+        class ResponseCollector:
+            # Receives responses in any order, see `SFTPClient._read_response`
+            @staticmethod
+            def _async_response(t: int, msg: Message, num: int) -> None:
+                responses[num] = (t, msg)
+
+        # paramiko has no public api for pipelined requests,
+        # send all requests first and then read responses, like `SFTPFile.prefetch` does
+        nums = [
+            sftp._async_request(ResponseCollector, CMD_STAT, sftp._adjust_cwd(path))  # type: ignore
+            for path in paths
+        ]
+        while len(responses) < len(nums):
+            sftp._read_response()  # type: ignore
+
+        results: typing.List[typing.Optional[StatResult]] = []
+        for num in nums:
+            t, msg = responses[num]
+            if t == CMD_STATUS:
+                try:
+                    sftp._convert_status(msg)  # type: ignore
+                except FileNotFoundError:
+                    results.append(None)
+                    continue
+            if t != CMD_ATTRS:
+                raise SFTPError("Expected attributes")
+            results.append(self._to_stat_result(SFTPAttributes._from_msg(msg)))  # type: ignore
+        return results
+
     @contextmanager
-    def file_read(self, path: str) -> typing.Generator[typing.IO[bytes], None, None]:
-        self._ensure_connection()
-        assert self.conn is not None, "Connection is not opened"
-        sftp = self.conn.open_sftp()
-        with sftp.open(path, 'rb') as reader:
-            typed_reader = typing.cast(typing.IO[bytes], reader)
-            yield typed_reader
+    def file_read(
+        self,
+        path: str,
+        offset: int = 0,
+        size: typing.Optional[int] = None,
+    ) -> typing.Generator[typing.IO[bytes], None, None]:
+        with self._get_sftp().open(path, 'rb') as reader:
+            reader.seek(offset)
+            end = reader.stat().st_size if size is None else offset + size
+            assert end is not None
+            if _sftp_pipelining:
+                # Files are read sequentially, request blocks ahead instead of one round trip per block
+                yield typing.cast(typing.IO[bytes], _PrefetchReader(reader, end))
+            else:
+                yield typing.cast(typing.IO[bytes], reader)
 
     @contextmanager
-    def file_write(self, path: str) -> typing.Generator[typing.IO[bytes], None, None]:
-        self._ensure_connection()
-        assert self.conn is not None, "Connection is not opened"
-        sftp = self.conn.open_sftp()
-        with sftp.open(path, 'wb') as writer:
+    def file_write(
+        self,
+        path: str,
+        offset: typing.Optional[int] = None,
+    ) -> typing.Generator[typing.IO[bytes], None, None]:
+        sftp = self._get_sftp()
+        with sftp.open(path, 'r+b' if offset is not None and self.file_stat_many([path])[0] else 'wb') as writer:
+            if offset is not None:
+                writer.seek(offset)
+            # Do not wait for server ack after every block, errors are raised on close
+            writer.set_pipelined(True)
             typed_writer = typing.cast(typing.IO[bytes], writer)
             yield typed_writer
@@ -0,0 +1,129 @@
+"""
+Пул SSH-соединений, общий для всего процесса
+
+Одно аутентифицированное соединение на хост используется валидацией, выполнением задач
+и всеми задачами группы, так что за один запуск carnival на каждый хост приходится одно рукопожатие.
+paramiko позволяет открывать каналы одного соединения из разных потоков,
+поэтому соединение выдается всем желающим одновременно.
+
+Соединение закрывается, когда его отпускает последний пользователь.
+Внутри :py:meth:`SshConnectionPool.keep_open` соединения живут до выхода из контекста,
+так их держит `carnival` между задачами.
+"""
+
+import atexit
+import threading
+import typing
+from contextlib import contextmanager
+
+from paramiko.client import SSHClient
+from paramiko.ssh_exception import SSHException
+
+from .ssh_config import HostnameConfig
+
+
+PoolKey = typing.Tuple[
+    str, int, typing.Optional[str], typing.Optional[str], typing.Optional[str], typing.Optional[str],
+]
+
+
+def _pool_key(conf: HostnameConfig) -> PoolKey:
+    # Hosts with different credentials must not share authenticated client
+    return conf.hostname, conf.port, conf.user, conf.password, conf.key_filename, conf.proxycommand
+
+
+def _is_alive(client: SSHClient) -> bool:
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+
+    try:
+        transport.send_ignore()
+    except (SSHException, EOFError, OSError):
+        return False
+    return True
+
+
+class SshConnectionPool:
+    def __init__(self) -> None:
+        self._clients: typing.Dict[PoolKey, SSHClient] = {}
+        self._users: typing.Dict[PoolKey, int] = {}
+        self._keep_open = 0
+        self._lock = threading.Lock()
+        self._key_locks: typing.Dict[PoolKey, threading.Lock] = {}
+
+    def get(self, conf: HostnameConfig) -> SSHClient:
+        """
+        Получить соединение с хостом, открыв его если нужно.
+        Соединение нужно вернуть в пул через :py:meth:`release`
+
+        Соединение из пула проверяется на живость, мертвое соединение переоткрывается
+        """
+        key = _pool_key(conf)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+            self._users[key] = self._users.get(key, 0) + 1
+
+        try:
+            with key_lock:
+                client = self._clients.get(key)
+                if client is not None and _is_alive(client):
+                    return client
+
+                if client is not None:
+                    client.close()
+
+                client = conf.connect()
+                self._clients[key] = client
+                return client
+        except BaseException:
+            self.release(conf)
+            raise
+
+    def release(self, conf: HostnameConfig) -> None:
+        """
+        Отпустить соединение, полученное через :py:meth:`get`.
+        Соединение без пользователей закрывается, если пул не внутри :py:meth:`keep_open`
+        """
+        key = _pool_key(conf)
+        client = None
+        with self._lock:
+            self._users[key] -= 1
+            if self._users[key] == 0:
+                del self._users[key]
+                if not self._keep_open:
+                    client = self._clients.pop(key, None)
+
+        if client is not None:
+            client.close()
+
+    @contextmanager
+    def keep_open(self) -> typing.Generator[None, None, None]:
+        """
+        Не закрывать соединения без пользователей до выхода из контекста, на выходе закрыть все соединения
+        """
+        with self._lock:
+            self._keep_open += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._keep_open -= 1
+                is_last = self._keep_open == 0
+            if is_last:
+                self.close_all()
+
+    def close_all(self) -> None:
+        """
+        Закрыть все соединения пула
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+
+        for client in clients:
+            client.close()
+
+
+connection_pool = SshConnectionPool()
+atexit.register(connection_pool.close_all)
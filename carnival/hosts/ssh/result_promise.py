@@ -1,8 +1,11 @@
+import selectors
+import shlex
 import typing
 
+from paramiko.agent import AgentRequestHandler
 from paramiko.client import SSHClient
 
-from carnival.hosts.base.result_promise import ResultPromise
+from carnival.hosts.base.result_promise import OUTPUT_CHUNK_SIZE, ResultPromise
 
 
 class SshResultPromise(ResultPromise):
@@ -14,6 +17,8 @@ class SshResultPromise(ResultPromise):
         timeout: int,
         use_sudo: bool,
         env: typing.Optional[typing.Dict[str, str]] = None,
+        pty: bool = True,
+        forward_agent: bool = False,
     ):
         self.timeout = timeout
         self.conn = conn
@@ -22,24 +27,67 @@ class SshResultPromise(ResultPromise):
             command = f"cd {cwd}; {command}"
 
         if use_sudo is True:
-            command = command.replace('"', '\\"')
-            command = f'sudo -n -- sh -c "{command}"'
+            command = f'sudo -n -- sh -c {shlex.quote(command)}'
 
         self.command = command
 
+        transport = self.conn.get_transport()
+        assert transport is not None, "Connection is not opened"
+
+        # Same as `SSHClient.exec_command`, but agent forwarding must be requested before exec
+        channel = transport.open_session(timeout=timeout)
+        if forward_agent:
+            AgentRequestHandler(channel)
         # https://stackoverflow.com/questions/39429680/python-paramiko-redirecting-stderr-is-affected-by-get-pty-true
-        _, stdout, stderr = self.conn.exec_command(
-            command,
-            timeout=timeout,
-            environment=env,
-            get_pty=True,  # Combines stdout and stderr, we dont want it
-        )
+        if pty:
+            channel.get_pty()  # Combines stdout and stderr, we dont want it
+        channel.settimeout(timeout)
+        if env:
+            channel.update_environment(env)
+        channel.exec_command(command)
+
+        stdin = channel.makefile_stdin("wb", -1)
+        stdout = channel.makefile("r", -1)
+        stderr = channel.makefile_stderr("r", -1)
         self.stdout_channel = stdout.channel
+        self.stdin = stdin  # type: ignore
         self.stdout = stdout  # type: ignore
         self.stderr = stderr  # type: ignore
 
+    def close_stdin(self) -> None:
+        self.stdin.close()
+        self.stdout_channel.shutdown_write()
+
+    def close(self) -> None:
+        # With pty remote command gets SIGHUP
+        self.stdout_channel.close()
+
     def is_done(self) -> bool:
         return self.stdout_channel.exit_status_ready()
 
     def wait(self) -> int:
         return self.stdout_channel.recv_exit_status()
+
+    def iter_output(self, idle_timeout: typing.Optional[float] = None) -> typing.Iterator[typing.Tuple[bool, bytes]]:
+        channel = self.stdout_channel
+        with selectors.DefaultSelector() as selector:
+            # Channel fileno is readable while stdout or stderr buffer has data, or channel is closed
+            selector.register(channel.fileno(), selectors.EVENT_READ)
+
+            while True:
+                # Data received before eof is already buffered, check eof first to not lose it
+                is_eof = channel.eof_received or channel.closed
+                is_read = False
+                if channel.recv_ready():
+                    yield False, channel.recv(OUTPUT_CHUNK_SIZE)
+                    is_read = True
+                if channel.recv_stderr_ready():
+                    yield True, channel.recv_stderr(OUTPUT_CHUNK_SIZE)
+                    is_read = True
+                if is_read:
+                    continue
+
+                if is_eof:
+                    break
+                if not selector.select(timeout=idle_timeout):
+                    yield False, b""
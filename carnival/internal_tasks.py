@@ -1,6 +1,7 @@
 import typing
 
 from carnival import TaskBase
+from carnival.task import validate_tasks
 from carnival.hosts.base.host import Host
 from carnival.utils import get_class_full_name
 
@@ -52,8 +53,10 @@ class Validate(TaskBase):
         task_list = list(task_types.keys())
         task_list.sort()
 
-        for task_name in task_list:
-            task_types[task_name](no_validate=False, servers=[]).validate()
+        validate_tasks(
+            [task_types[task_name](no_validate=False, servers=[], forks=self.get_forks()) for task_name in task_list],
+            forks=self.get_forks(),
+        )
 
 
 class Roles(TaskBase):
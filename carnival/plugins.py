@@ -1,18 +1,146 @@
-import typing
+"""
+Поиск плагинов carnival
+
+Плагин это пакет, объявленный в группе entry points `carnival.plugins`, например в pyproject.toml плагина:
+
+    [tool.poetry.plugins."carnival.plugins"]
+    carnival_myplugin = "carnival_myplugin"
+
+Пакеты с именем `carnival_*` тоже считаются плагинами, как и раньше,
+и импортируются при загрузке задач, чтобы их задачи были видны в CLI, см :py:func:`import_legacy_plugins`.
+
+Найденные плагины сохраняются в кеше проекта и ищутся заново только когда меняется набор установленных пакетов.
+Модули плагинов из entry points импортируются только при использовании, см :py:func:`load_plugin`
+"""
+
 import importlib
+import json
+import os
 import pkgutil
+import sys
+import threading
+import typing
+import warnings
+from hashlib import sha1
 
+from carnival.cache import get_cache_dir
 
-def discover_plugins() -> typing.Dict[str, typing.Any]:
+PLUGINS_ENTRY_POINT_GROUP = "carnival.plugins"
+
+__plugins: typing.Optional[typing.Dict[str, str]] = None
+__legacy_plugins: typing.List[str] = []
+__plugins_lock = threading.Lock()
+
+
+def _get_environment_state() -> str:
     """
-    Get modules, name starting with carnival_
+    Хеш набора установленных пакетов: пути поиска модулей и mtime их папок,
+    которые меняются при установке и удалении пакетов
     """
+    digest = sha1()
+    for path in sys.path:
+        try:
+            mtime = os.stat(path or os.curdir).st_mtime_ns
+        except OSError:
+            mtime = 0
+        digest.update(f"{path}:{mtime}\n".encode())
+    return digest.hexdigest()
 
-    discovered_plugins: typing.Dict[str, typing.Any] = {}
 
+def _get_entry_points() -> typing.List[typing.Any]:
+    from importlib.metadata import entry_points
+
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return list(eps.select(group=PLUGINS_ENTRY_POINT_GROUP))
+    # python < 3.10
+    return list(eps.get(PLUGINS_ENTRY_POINT_GROUP, []))
+
+
+def _scan_plugins() -> typing.Tuple[typing.Dict[str, str], typing.List[str]]:
+    """
+    :return: имя плагина -> имя модуля, и имена плагинов, найденных только по имени пакета
+    """
+    plugins: typing.Dict[str, str] = {}
+
+    # Legacy plugins by package name, found without import
     for finder, name, ispkg in pkgutil.iter_modules():
         if name.startswith('carnival_') or name == 'carnival':
             if name != 'carnival_tasks' and ispkg is True:
-                discovered_plugins[name] = importlib.import_module(name)
+                plugins[name] = name
 
-    return discovered_plugins
+    legacy = [x for x in plugins if x.startswith('carnival_')]
+
+    for entry_point in _get_entry_points():
+        plugins[entry_point.name] = entry_point.value.partition(":")[0].strip()
+        if entry_point.name in legacy:
+            legacy.remove(entry_point.name)
+
+    return plugins, legacy
+
+
+def find_plugins() -> typing.Dict[str, str]:
+    """
+    Получить плагины, не импортируя их
+
+    :return: имя плагина -> имя модуля
+    """
+    global __plugins, __legacy_plugins
+
+    with __plugins_lock:
+        if __plugins is not None:
+            return __plugins
+
+        state = _get_environment_state()
+        index_path = os.path.join(get_cache_dir(), "plugins.json")
+        try:
+            with open(index_path, 'r') as fp:
+                index = json.load(fp)
+            if index["state"] == state:
+                __legacy_plugins = typing.cast(typing.List[str], index["legacy"])
+                __plugins = typing.cast(typing.Dict[str, str], index["plugins"])
+                return __plugins
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        __plugins, __legacy_plugins = _scan_plugins()
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump({"state": state, "plugins": __plugins, "legacy": __legacy_plugins}, fp)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            # Cache is optimization only
+            pass
+        return __plugins
+
+
+def load_plugin(name: str) -> typing.Any:
+    """
+    Импортировать модуль плагина
+
+    :param name: имя плагина, см :py:func:`find_plugins`
+    """
+    return importlib.import_module(find_plugins()[name])
+
+
+def import_legacy_plugins() -> None:
+    """
+    Импортировать пакеты `carnival_*`, не объявленные в entry points.
+    Задачи в них объявляются при импорте, как и раньше
+    """
+    find_plugins()
+    for name in __legacy_plugins:
+        load_plugin(name)
+
+
+def discover_plugins() -> typing.Dict[str, typing.Any]:
+    """
+    Импортировать все плагины
+
+    Устарело, используйте :py:func:`find_plugins` и :py:func:`load_plugin`
+
+    :return: имя плагина -> модуль
+    """
+    warnings.warn("discover_plugins() is deprecated, use find_plugins() and load_plugin()", DeprecationWarning, 2)
+    return {name: load_plugin(name) for name in find_plugins()}
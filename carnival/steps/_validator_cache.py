@@ -1,8 +1,12 @@
 """
     Кеширование валидаторов для Steps
     Кеширует значение по Type[Step], Host, fact_id:str(задается в валидаторе)
+
+    Валидация выполняется в нескольких потоках, поэтому доступ к кешу защищен блокировкой,
+    а вычисление одного и того же факта выполняется только один раз, см. `get_or_compute`
 """
 
+import threading
 import typing
 
 if typing.TYPE_CHECKING:
@@ -12,6 +16,8 @@ if typing.TYPE_CHECKING:
 
 StepValidatorBaseT = typing.TypeVar("StepValidatorBaseT", bound="StepValidatorBase")
 __vc: typing.Dict[str, typing.Optional[str]] = {}
+__vc_lock = threading.Lock()
+__vc_key_locks: typing.Dict[str, threading.Lock] = {}
 
 
 def __build_vc_key(step_class: typing.Type[StepValidatorBaseT], host: "Host", fact_id: str) -> str:
@@ -24,24 +30,43 @@ def try_get(
     host: "Host",
     fact_id: str,
 ) -> typing.Tuple[bool, typing.Optional[str]]:
-    global __vc
     cachekey = __build_vc_key(step_class=step_class, host=host, fact_id=fact_id)
 
-    return (
-        cachekey in __vc,
-        __vc.get(
-            __build_vc_key(step_class=step_class, host=host, fact_id=fact_id),
-            None,
-        )
-    )
+    with __vc_lock:
+        return cachekey in __vc, __vc.get(cachekey, None)
 
 
 def set(step_class: typing.Type[StepValidatorBaseT], host: "Host", fact_id: str, val: typing.Optional[str]) -> None:
-    global __vc
     cachekey = __build_vc_key(step_class=step_class, host=host, fact_id=fact_id)
 
-    is_exist, *_ = try_get(step_class=step_class, host=host, fact_id=fact_id)
-    if is_exist:
-        raise ValueError(f"Broken cache: '{cachekey}' already exist!")
+    with __vc_lock:
+        if cachekey in __vc:
+            raise ValueError(f"Broken cache: '{cachekey}' already exist!")
+
+        __vc[cachekey] = val
+
+
+def get_or_compute(
+    step_class: typing.Type[StepValidatorBaseT],
+    host: "Host",
+    fact_id: str,
+    compute: typing.Callable[[], typing.Optional[str]],
+) -> typing.Optional[str]:
+    """
+    Получить значение из кеша, либо вычислить и сохранить его
+
+    Пока один поток вычисляет факт, остальные потоки с тем же ключом ждут его результата
+    """
+    cachekey = __build_vc_key(step_class=step_class, host=host, fact_id=fact_id)
+
+    with __vc_lock:
+        key_lock = __vc_key_locks.setdefault(cachekey, threading.Lock())
+
+    with key_lock:
+        is_exist, val = try_get(step_class=step_class, host=host, fact_id=fact_id)
+        if is_exist:
+            return val
 
-    __vc[cachekey] = val
+        val = compute()
+        set(step_class=step_class, host=host, fact_id=fact_id, val=val)
+        return val
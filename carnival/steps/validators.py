@@ -48,18 +48,14 @@ class InlineValidator(StepValidatorBase):
         self.fact_id_for_caching = fact_id_for_caching
 
     def validate(self, c: "Connection") -> typing.Optional[str]:
-        if self.fact_id_for_caching is not None:
-            is_exist, val = _validator_cache.try_get(self.__class__, c.host, self.fact_id_for_caching)
-            if is_exist:
-                return val
+        def compute() -> typing.Optional[str]:
+            if self.if_err_true_fn(c):
+                return self.error_message
+            return None
 
-        val = None
-        if self.if_err_true_fn(c):
-            val = self.error_message
-
-        if self.fact_id_for_caching is not None:
-            _validator_cache.set(self.__class__, c.host, self.fact_id_for_caching, val=val)
-        return val
+        if self.fact_id_for_caching is None:
+            return compute()
+        return _validator_cache.get_or_compute(self.__class__, c.host, self.fact_id_for_caching, compute)
 
 
 class CommandRequiredValidator(StepValidatorBase):
@@ -78,17 +74,12 @@ class CommandRequiredValidator(StepValidatorBase):
         self.fact_id = f"path-{command}-required"
 
     def validate(self, c: "Connection") -> typing.Optional[str]:
-        is_exist, val = _validator_cache.try_get(self.__class__, c.host, self.fact_id)
-
-        if is_exist:
-            return val
-
-        val = None
-        if not shortcuts.is_cmd_exist(c, self.command):
-            val = f"'{self.command}' is required"
+        def compute() -> typing.Optional[str]:
+            if not shortcuts.is_cmd_exist(c, self.command):
+                return f"'{self.command}' is required"
+            return None
 
-        _validator_cache.set(self.__class__, c.host, self.fact_id, val=val)
-        return val
+        return _validator_cache.get_or_compute(self.__class__, c.host, self.fact_id, compute)
 
 
 class IsFileValidator(StepValidatorBase):
@@ -103,18 +94,12 @@ class IsFileValidator(StepValidatorBase):
         self.fact_id = f"isfile-{file_path}"
 
     def validate(self, c: "Connection") -> typing.Optional[str]:
-        is_exist, val = _validator_cache.try_get(self.__class__, c.host, self.fact_id)
-
-        if is_exist:
-            return val
-
-        val = None
+        def compute() -> typing.Optional[str]:
+            if not shortcuts.is_file(c, self.file_path):
+                return f"'{self.file_path}' is not file"
+            return None
 
-        if not shortcuts.is_file(c, self.file_path):
-            val = f"'{self.file_path}' is not file"
-
-        _validator_cache.set(self.__class__, c.host, self.fact_id, val=val)
-        return val
+        return _validator_cache.get_or_compute(self.__class__, c.host, self.fact_id, compute)
 
 
 class IsDirectoryValidator(StepValidatorBase):
@@ -130,18 +115,12 @@ class IsDirectoryValidator(StepValidatorBase):
         self.fact_id = f"is_directory-{directory_path}"
 
     def validate(self, c: "Connection") -> typing.Optional[str]:
-        is_exist, val = _validator_cache.try_get(self.__class__, c.host, self.fact_id)
-
-        if is_exist:
-            return val
-
-        val = None
-
-        if not shortcuts.is_directory(c, self.directory_path):
-            val = f"'{self.directory_path}' is not directory"
+        def compute() -> typing.Optional[str]:
+            if not shortcuts.is_directory(c, self.directory_path):
+                return f"'{self.directory_path}' is not directory"
+            return None
 
-        _validator_cache.set(self.__class__, c.host, self.fact_id, val=val)
-        return val
+        return _validator_cache.get_or_compute(self.__class__, c.host, self.fact_id, compute)
 
 
 class TemplateValidator(StepValidatorBase):
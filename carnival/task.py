@@ -10,15 +10,29 @@ carnival автоматически генерирует имена задач 
 """
 
 import abc
+import copy
+import functools
 import re
 import typing
 import sys
 
 from colorama import Fore as F, Style as S, Back as B  # type: ignore
 
+from carnival.utils import run_parallel
+
 if typing.TYPE_CHECKING:
     from carnival.role import Role
-    from carnival import Step
+    from carnival import Step, Connection
+
+
+ValidationJob = typing.Callable[[], typing.List[str]]
+
+
+def _run_validation_jobs(jobs: typing.Sequence[ValidationJob], workers: int) -> typing.List[str]:
+    errors: typing.List[str] = []
+    for job_errors in run_parallel(lambda job: job(), jobs, workers=workers):
+        errors.extend(job_errors)
+    return errors
 
 
 def _underscore(word: str) -> str:
@@ -64,9 +78,25 @@ class TaskBase:
     Строка помощи при вызове carnival help
     """
 
-    def __init__(self, no_validate: bool, servers: typing.List[str]) -> None:
+    forks: typing.ClassVar[typing.Optional[int]] = None
+    """
+    Сколько хостов обрабатывать одновременно.
+    Если не задано, используется значение опции `--forks`.
+    `forks = 1` выполняет задачу на хостах строго по очереди
+    """
+
+    def __init__(self, no_validate: bool, servers: typing.List[str], forks: int = 1) -> None:
         self.no_validate = no_validate
         self.servers = servers
+        self.default_forks = forks
+
+    def get_forks(self) -> int:
+        """
+        Количество хостов, обрабатываемых одновременно
+        """
+        if self.forks is not None:
+            return self.forks
+        return self.default_forks
 
     @classmethod
     def get_name(cls) -> str:
@@ -80,16 +110,27 @@ class TaskBase:
         """
         raise NotImplementedError
 
+    def _get_validation_jobs(self) -> typing.List[ValidationJob]:
+        """
+        Независимые части валидации, например по одной на хост
+
+        Части всех задач выполняются в одном пуле потоков, см :py:func:`validate_tasks`
+        """
+        return [self.get_validation_errors]
+
     def validate(self) -> bool:
         if self.no_validate:
             return True
 
+        print(f"Validating task {S.BRIGHT}{F.BLUE}{self._get_full_name()}{F.RESET}{S.RESET_ALL} ", end="", flush=True)
+        return self._print_validation_errors(self.get_validation_errors())
+
+    def _get_full_name(self) -> str:
         from carnival.cli import carnival_tasks_module
         from carnival.tasks_loader import get_task_full_name
-        task_name = get_task_full_name(carnival_tasks_module, self.__class__)
-        print(f"Validating task {S.BRIGHT}{F.BLUE}{task_name}{F.RESET}{S.RESET_ALL} ", end="", flush=True)
-        errors = self.get_validation_errors()
+        return get_task_full_name(carnival_tasks_module, self.__class__)
 
+    def _print_validation_errors(self, errors: typing.List[str]) -> bool:
         if errors:
             print(f" {F.RED}{len(errors)} errors{F.RESET}")
             for e in errors:
@@ -108,6 +149,7 @@ class TaskBase:
 
 
 RoleT = typing.TypeVar("RoleT", bound="Role")
+T = typing.TypeVar("T")
 
 
 class Task(abc.ABC, typing.Generic[RoleT], TaskBase):
@@ -139,8 +181,8 @@ class Task(abc.ABC, typing.Generic[RoleT], TaskBase):
 
     role: RoleT
 
-    def __init__(self, no_validate: bool, servers: typing.List[str]) -> None:
-        super().__init__(no_validate=no_validate, servers=servers)
+    def __init__(self, no_validate: bool, servers: typing.List[str], forks: int = 1) -> None:
+        super().__init__(no_validate=no_validate, servers=servers, forks=forks)
         # Get role from generic
         self.role_class: typing.Type[RoleT] = typing.get_args(self.__class__.__orig_bases__[0])[0]  # type: ignore
         self.hostroles: typing.List[RoleT] = self.role_class.resolve()
@@ -166,47 +208,72 @@ class Task(abc.ABC, typing.Generic[RoleT], TaskBase):
         raise NotImplementedError
 
     def get_validation_errors(self) -> typing.List[str]:
-        errors: typing.List[str] = []
+        return _run_validation_jobs(self._get_validation_jobs(), workers=self.get_forks())
+
+    def _get_validation_jobs(self) -> typing.List[ValidationJob]:
+        jobs: typing.List[ValidationJob] = []
 
         if len(self.hostroles) == 0:
-            errors.append(f"{self.__class__.__name__} no hosts with role '{self.role.__class__.__name__}'")
+            error = f"{self.__class__.__name__} no hosts with role '{self.role_class.__name__}'"
+            jobs.append(lambda: [error])
 
         for hostrole in self.hostroles:
-            with hostrole.host.connect() as c:
-                self.role = hostrole
-                hostrolesteps = self.get_steps()
+            jobs.append(functools.partial(self._validate_hostrole, hostrole))
+        return jobs
 
-                if len(hostrolesteps) == 0:
-                    errors.append(f"{self.__class__.__name__} no steps with host {hostrole.host}")
+    def _validate_hostrole(self, hostrole: RoleT) -> typing.List[str]:
+        task = copy.copy(self)
+        task.role = hostrole
+        hostrole_errors: typing.List[str] = []
 
-                for step in hostrolesteps:
-                    step_errors = step.validate(c=c)
+        with hostrole.host.connect() as c:
+            hostrolesteps = task.get_steps()
 
-                    if not step_errors:
-                        print(f"{F.GREEN}.{F.RESET}", end="", flush=True)
-                    else:
-                        step_name = step.get_name()
-                        for e in step_errors:
-                            errors.append(f"{step_name} on {hostrole.host}: {F.RED}{e}{F.RESET}")
-                        print(f"{F.RED}e{F.RESET}", end="", flush=True)
-                del self.role
-        return errors
+            if len(hostrolesteps) == 0:
+                hostrole_errors.append(f"{self.__class__.__name__} no steps with host {hostrole.host}")
+
+            for step in hostrolesteps:
+                step_errors = step.validate(c=c)
+
+                if not step_errors:
+                    print(f"{F.GREEN}.{F.RESET}", end="", flush=True)
+                else:
+                    step_name = step.get_name()
+                    for e in step_errors:
+                        hostrole_errors.append(f"{step_name} on {hostrole.host}: {F.RED}{e}{F.RESET}")
+                    print(f"{F.RED}e{F.RESET}", end="", flush=True)
+        return hostrole_errors
 
     def run(self) -> None:
-        from carnival.cli import carnival_tasks_module
-        from carnival.tasks_loader import get_task_full_name
+        task_name = self._get_full_name()
 
-        for hostrole in self.hostroles:
+        def run_hostrole(task: "Task[RoleT]", c: "Connection") -> None:
+            for step in task.get_steps():
+                step_name = step.get_name()
+                print(
+                    f"{B.YELLOW}💃💃💃{B.BLUE} {task.role.host}{B.RESET}{F.RESET} "
+                    f"Running {S.BRIGHT}{task_name}:{step_name}{S.RESET_ALL}"
+                )
+                step.run(c=c)
+
+        self.run_for_hostroles(run_hostrole)
+
+    def run_for_hostroles(self, fn: typing.Callable[["Task[RoleT]", "Connection"], T]) -> typing.List[T]:
+        """
+        Вызвать `fn` для каждого хоста задачи, не более чем на :py:meth:`TaskBase.get_forks` хостах одновременно
+
+        Каждый хост получает свою копию задачи с назначенной ролью :py:attr:`role`
+        и свое соединение `hostrole.host.connect()`
+
+        :return: результаты `fn` в порядке хостов
+        """
+        def worker(hostrole: RoleT) -> T:
+            task = copy.copy(self)
+            task.role = hostrole
             with hostrole.host.connect() as c:
-                self.role = hostrole
-                for step in self.get_steps():
-                    task_name = get_task_full_name(carnival_tasks_module, self.__class__)
-                    step_name = step.get_name()
-                    print(
-                        f"{B.YELLOW}💃💃💃{B.BLUE} {hostrole.host}{B.RESET}{F.RESET} "
-                        f"Running {S.BRIGHT}{task_name}:{step_name}{S.RESET_ALL}"
-                    )
-                    step.run(c=c)
+                return fn(task, c)
+
+        return run_parallel(worker, self.hostroles, workers=self.get_forks())
 
 
 class TaskGroup(abc.ABC, TaskBase):
@@ -223,18 +290,57 @@ class TaskGroup(abc.ABC, TaskBase):
     tasks: typing.List[typing.Type[TaskBase]]
 
     def get_validation_errors(self) -> typing.List[str]:
-        errors: typing.List[str] = []
+        return _run_validation_jobs(self._get_validation_jobs(), workers=self.get_forks())
+
+    def _get_validation_jobs(self) -> typing.List[ValidationJob]:
+        jobs: typing.List[ValidationJob] = []
         if len(self.tasks) == 0:
-            errors.append(f"{self.__class__.__name__} 'tasks' cannot be empty")
+            error = f"{self.__class__.__name__} 'tasks' cannot be empty"
+            jobs.append(lambda: [error])
 
-        for task_class in self.tasks:
-            task = task_class(no_validate=self.no_validate, servers=self.servers)
-            for error in task.get_validation_errors():
-                errors.append(f"{task_class.__name__} -> {error}")
+        def add_prefix(prefix: str, job: ValidationJob) -> ValidationJob:
+            return lambda: [f"{prefix} -> {error}" for error in job()]
 
-        return errors
+        for task_class in self.tasks:
+            task = task_class(no_validate=self.no_validate, servers=self.servers, forks=self.get_forks())
+            jobs.extend(add_prefix(task_class.__name__, job) for job in task._get_validation_jobs())
+        return jobs
 
     def run(self) -> None:
         for task_class in self.tasks:
-            task = task_class(no_validate=self.no_validate, servers=self.servers)
+            task = task_class(no_validate=self.no_validate, servers=self.servers, forks=self.get_forks())
             task.run()
+
+
+def validate_tasks(tasks: typing.Sequence[TaskBase], forks: int) -> bool:
+    """
+    Провалидировать цепочку задач, не более `forks` хостов одновременно на все задачи
+
+    Ошибки выводятся после завершения валидации всех задач, в порядке задач
+
+    :return: `True` если ошибок нет
+    """
+    tasks = [x for x in tasks if not x.no_validate]
+    if not tasks:
+        return True
+
+    if len(tasks) == 1:
+        return tasks[0].validate()
+
+    # Validate all hosts of all tasks in one pool, nested pools would open up to forks^2 connections
+    jobs = [(index, job) for index, task in enumerate(tasks) for job in task._get_validation_jobs()]
+
+    print(f"Validating {len(tasks)} tasks ", end="", flush=True)
+    jobs_errors = run_parallel(lambda item: item[1](), jobs, workers=forks)
+    print()
+
+    tasks_errors: typing.List[typing.List[str]] = [[] for _ in tasks]
+    for (index, _), job_errors in zip(jobs, jobs_errors):
+        tasks_errors[index].extend(job_errors)
+
+    is_valid = True
+    for task, errors in zip(tasks, tasks_errors):
+        print(f"Validating task {S.BRIGHT}{F.BLUE}{task._get_full_name()}{F.RESET}{S.RESET_ALL} ", end="")
+        if not task._print_validation_errors(errors):
+            is_valid = False
+    return is_valid
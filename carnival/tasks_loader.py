@@ -4,6 +4,7 @@ import sys
 import typing
 import collections
 
+from carnival.plugins import import_legacy_plugins
 from carnival.task import TaskBase
 
 
@@ -65,5 +66,6 @@ def get_tasks(
 ) -> typing.OrderedDict[str, typing.Type["TaskBase"]]:
     sys.path.insert(0, os.getcwd())
     from carnival import internal_tasks  # noqa
+    import_legacy_plugins()
     import_tasks_file(carnival_tasks_module, silent=for_completion)
     return collections.OrderedDict(sorted(get_tasks_from_runtime(carnival_tasks_module).items()))
@@ -1,17 +1,28 @@
 import os
-from typing import Any
+import threading
+import typing
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha1
+from typing import Any, Iterator
 
 from jinja2 import (
+    BaseLoader,
     ChoiceLoader,
     Environment,
+    FileSystemBytecodeCache,
     FileSystemLoader,
     PackageLoader,
     PrefixLoader,
+    Template,
+    meta,
 )
 from jinja2.runtime import StrictUndefined
 from jinja2.exceptions import UndefinedError, TemplateSyntaxError
 
-from carnival.plugins import discover_plugins
+from carnival.cache import get_cache_dir
+from carnival.plugins import find_plugins
 
 
 def escape_yaml(data: str) -> str:
@@ -23,32 +34,92 @@ def escape_yaml(data: str) -> str:
     return data.replace("$", "$$")
 
 
-"""
-Initialize loader on current working dir and plugin modules
-"""
-j2_env = Environment(
-    loader=ChoiceLoader([
-        FileSystemLoader(os.getcwd()),
-        PrefixLoader({x: PackageLoader(x, package_path="") for x in discover_plugins().keys()}),
-    ]),
-    keep_trailing_newline=True,
-    undefined=StrictUndefined,
-)
+class _PluginsLoader(PrefixLoader):
+    """
+    Загрузчик шаблонов плагинов по префиксу `<имя плагина>/`
+
+    Модуль плагина импортируется при первом обращении к его шаблону, см :py:func:`carnival.plugins.find_plugins`
+    """
 
+    def __init__(self) -> None:
+        self._loaders: typing.Dict[str, BaseLoader] = {}
+        super().__init__(self._loaders)
+        self._lock = threading.Lock()
 
-j2_env.filters['escape_yaml'] = escape_yaml
+    def _load(self, name: str) -> None:
+        with self._lock:
+            plugins = find_plugins()
+            if name not in self._loaders and name in plugins:
+                self._loaders[name] = PackageLoader(plugins[name], package_path="")
 
+    def get_loader(self, template: str) -> typing.Tuple[BaseLoader, str]:
+        self._load(template.split(self.delimiter, 1)[0])
+        return super().get_loader(template)
 
-def render(template_path: str, **context: Any) -> str:
+    def list_templates(self) -> typing.List[str]:
+        for name in find_plugins():
+            self._load(name)
+        return super().list_templates()
+
+
+class _LazyEnvironment:
+    """
+    Заменяет окружение jinja2, пока оно не создано: обращение к любому атрибуту создает его,
+    так что фильтры и глобальные переменные можно регистрировать при импорте, как и раньше
     """
-    Отрендерить jinja2-шаблон в строку
 
-    :param template_path: относительный путь до шаблона, ищется в текущей папке проекта и в папках плагинов
-    :param context: контекст шаблона
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_j2_env(), name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(get_j2_env(), name, value)
+
+    def __delattr__(self, name: str) -> None:
+        delattr(get_j2_env(), name)
+
+
+j2_env: Environment = typing.cast(Environment, _LazyEnvironment())
+"""
+Окружение jinja2, создается при первом рендеринге или обращении к нему, см :py:func:`get_j2_env`
+"""
+__j2_env: typing.Optional[Environment] = None
+__j2_env_lock = threading.Lock()
+
+
+def get_j2_env() -> Environment:
+    """
+    Получить окружение jinja2, создав его при первом вызове
+
+    Шаблоны ищутся в текущей папке проекта и в папках плагинов.
+    Скомпилированные шаблоны сохраняются в папке кеша проекта `jinja2`,
+    так что между запусками шаблоны компилируются заново только при изменении.
+    Если `j2_env` заменен своим окружением, возвращается оно
     """
+    global __j2_env
+
+    if isinstance(j2_env, Environment):
+        return j2_env
+
+    with __j2_env_lock:
+        if __j2_env is None:
+            env = Environment(
+                loader=ChoiceLoader([
+                    FileSystemLoader(os.getcwd()),
+                    _PluginsLoader(),
+                ]),
+                keep_trailing_newline=True,
+                undefined=StrictUndefined,
+                bytecode_cache=FileSystemBytecodeCache(get_cache_dir("jinja2")),
+            )
+            env.filters['escape_yaml'] = escape_yaml
+            __j2_env = env
+        return __j2_env
+
+
+@contextmanager
+def _template_errors(template_path: str) -> Iterator[None]:
     try:
-        template = j2_env.get_template(template_path)
-        return template.render(**context)
+        yield
     except UndefinedError as ex:
         raise UndefinedError(f"Can't render template {template_path} - {ex}") from ex
     except TemplateSyntaxError as ex:
@@ -57,3 +128,196 @@ def render(template_path: str, **context: Any) -> str:
             lineno=ex.lineno,
             filename=ex.filename,
         ) from ex
+
+
+render_cache_size = 128
+"""
+Сколько результатов рендеринга хранить в памяти
+"""
+render_cache_max_item_size = 4 * 1024 * 1024
+"""
+Результаты больше этого размера, в символах, не кешируются
+"""
+
+_RenderKey = typing.Tuple[str, typing.Tuple[Template, ...], str]
+__render_cache: "OrderedDict[_RenderKey, str]" = OrderedDict()
+__render_cache_lock = threading.Lock()
+# Entry lives while some thread renders the key, Lock itself can not be weakly referenced
+__render_key_locks: "weakref.WeakValueDictionary[_RenderKey, threading.Semaphore]" = weakref.WeakValueDictionary()
+__template_dependencies: "weakref.WeakKeyDictionary[Template, typing.Optional[typing.List[str]]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class _UnhashableContext(Exception):
+    pass
+
+
+def _update_context_hash(digest: Any, value: Any, stack: typing.List[int]) -> None:
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        digest.update(f"{type(value).__name__}:{value!r};".encode())
+        return
+    if isinstance(value, type):
+        digest.update(f"type:{value.__module__}.{value.__qualname__};".encode())
+        return
+
+    if id(value) in stack or len(stack) > 32:
+        raise _UnhashableContext()
+    stack.append(id(value))
+
+    if isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}[{len(value)}".encode())
+        for item in value:
+            _update_context_hash(digest, item, stack)
+    elif isinstance(value, (dict, set, frozenset)):
+        items = value.items() if isinstance(value, dict) else ((x, None) for x in value)
+        item_digests = []
+        for item_key, item_value in items:
+            item_digest = sha1()
+            _update_context_hash(item_digest, item_key, stack)
+            _update_context_hash(item_digest, item_value, stack)
+            item_digests.append(item_digest.hexdigest())
+        # Iteration order of dicts and sets does not change rendered template identity
+        digest.update(f"{type(value).__name__}{{{','.join(sorted(item_digests))}".encode())
+    elif hasattr(value, "__dict__") and not callable(value):
+        digest.update(f"{type(value).__module__}.{type(value).__qualname__}(".encode())
+        _update_context_hash(digest, vars(value), stack)
+    else:
+        # Functions, locks, sockets: value can not be compared between renders
+        raise _UnhashableContext()
+
+    stack.pop()
+    digest.update(b";")
+
+
+def _get_dependencies(env: Environment, template: Template, template_path: str) -> typing.Optional[typing.List[str]]:
+    """
+    Имена шаблонов, подключенных через `include`, `import` и `extends`, рекурсивно
+
+    :return: `None`, если имя подключаемого шаблона вычисляется при рендеринге
+    """
+    with __render_cache_lock:
+        if template in __template_dependencies:
+            return __template_dependencies[template]
+
+    dependencies: typing.Optional[typing.List[str]] = []
+    queue, seen = [template_path], {template_path}
+    while queue and dependencies is not None and env.loader is not None:
+        source, _, _ = env.loader.get_source(env, queue.pop())
+        for name in meta.find_referenced_templates(env.parse(source)):
+            if name is None:
+                dependencies = None
+                break
+            if name not in seen:
+                seen.add(name)
+                queue.append(name)
+                dependencies.append(name)
+
+    with __render_cache_lock:
+        __template_dependencies[template] = dependencies
+    return dependencies
+
+
+def _get_render_key(
+    env: Environment,
+    template: Template,
+    template_path: str,
+    context: typing.Dict[str, Any],
+) -> typing.Optional[_RenderKey]:
+    digest = sha1()
+    try:
+        _update_context_hash(digest, context, [])
+    except _UnhashableContext:
+        return None
+
+    dependencies = _get_dependencies(env, template, template_path)
+    if dependencies is None:
+        return None
+    # Environment returns new template object once its source changed, see `auto_reload`
+    templates = (template, *(env.get_template(x) for x in dependencies))
+    return template_path, templates, digest.hexdigest()
+
+
+def _get_cached(key: _RenderKey) -> typing.Optional[str]:
+    with __render_cache_lock:
+        rendered = __render_cache.get(key)
+        if rendered is not None:
+            __render_cache.move_to_end(key)
+        return rendered
+
+
+def _set_cached(key: _RenderKey, rendered: str) -> None:
+    if len(rendered) > render_cache_max_item_size:
+        return
+    with __render_cache_lock:
+        __render_cache[key] = rendered
+        __render_cache.move_to_end(key)
+        while len(__render_cache) > render_cache_size:
+            __render_cache.popitem(last=False)
+
+
+def render(template_path: str, **context: Any) -> str:
+    """
+    Отрендерить jinja2-шаблон в строку
+
+    Результат запоминается по пути, версиям шаблона и подключенных в него шаблонов и хешу контекста,
+    так что один и тот же шаблон с тем же контекстом рендерится за запуск один раз,
+    например при валидации и заливке на каждом хосте.
+    Контексты с функциями и прочими несравнимыми значениями и шаблоны,
+    подключающие шаблоны по вычисляемому имени, не кешируются
+
+    :param template_path: относительный путь до шаблона, ищется в текущей папке проекта и в папках плагинов
+    :param context: контекст шаблона
+    """
+    with _template_errors(template_path):
+        env = get_j2_env()
+        template = env.get_template(template_path)
+        key = _get_render_key(env, template, template_path, context)
+        if key is None:
+            return template.render(**context)
+
+        with __render_cache_lock:
+            key_lock = __render_key_locks.setdefault(key, threading.Semaphore())
+
+        # Other threads with the same key wait for the first render
+        with key_lock:
+            rendered = _get_cached(key)
+            if rendered is None:
+                rendered = template.render(**context)
+                _set_cached(key, rendered)
+            return rendered
+
+
+def render_stream(template_path: str, **context: Any) -> Iterator[str]:
+    """
+    Отрендерить jinja2-шаблон по частям, не собирая результат в памяти целиком
+
+    Использует тот же кеш, что и :py:func:`render`, если результат в нем есть или помещается
+
+    :param template_path: относительный путь до шаблона, ищется в текущей папке проекта и в папках плагинов
+    :param context: контекст шаблона
+    """
+    with _template_errors(template_path):
+        env = get_j2_env()
+        template = env.get_template(template_path)
+        key = _get_render_key(env, template, template_path, context)
+        if key is None:
+            yield from template.generate(**context)
+            return
+
+        rendered = _get_cached(key)
+        if rendered is not None:
+            yield rendered
+            return
+
+        parts: typing.Optional[typing.List[str]] = []
+        parts_size = 0
+        for part in template.generate(**context):
+            if parts is not None:
+                parts.append(part)
+                parts_size += len(part)
+                if parts_size > render_cache_max_item_size:
+                    parts = None
+            yield part
+        if parts is not None:
+            _set_cached(key, "".join(parts))
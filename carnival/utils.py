@@ -1,5 +1,6 @@
 import typing
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 
 def envvar(varname: str) -> str:
@@ -30,3 +31,28 @@ def get_class_full_name(klass: typing.Type[typing.Any]) -> str:
         task_full_name = task_full_name[len(carnival_tasks_module) + 1:]
 
     return task_full_name
+
+
+T = typing.TypeVar("T")
+R = typing.TypeVar("R")
+
+
+def run_parallel(fn: typing.Callable[[T], R], items: typing.Sequence[T], workers: int) -> typing.List[R]:
+    """
+    Выполнить `fn` для каждого элемента `items`, не более чем в `workers` потоков одновременно
+
+    Результаты возвращаются в порядке `items`.
+    При ошибке в одном из потоков еще не начатые вызовы отменяются,
+    дожидаемся уже запущенных и пробрасываем первое исключение.
+    """
+    if workers <= 1 or len(items) <= 1:
+        return [fn(x) for x in items]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        futures = [executor.submit(fn, x) for x in items]
+        try:
+            return [f.result() for f in futures]
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
@@ -1,8 +1,13 @@
-from typing import Type
+import os
+import socket
+import threading
+from typing import IO, Type, cast
 
+import paramiko
 import pytest
 from carnival import Step, SshHost, LocalHost
 from paramiko.client import WarningPolicy
+from paramiko.common import AUTH_SUCCESSFUL, OPEN_SUCCEEDED
 
 
 def pytest_configure(config):
@@ -10,6 +15,18 @@ def pytest_configure(config):
     config.addinivalue_line("markers", "remote: remote connection required")
 
 
+@pytest.fixture(scope="function", autouse=True)
+def carnival_cache_dir(tmp_path, mocker):
+    # Keep tests away from project cache, shared hash cache is flushed while patched dir is still active
+    from carnival import cache
+
+    cache_dir = tmp_path / "carnival_cache"
+    mocker.patch.object(cache, "carnival_cache_dir", str(cache_dir))
+    yield cache_dir
+    cache.file_hash_cache.flush()
+    cache.file_hash_cache._entries = None
+
+
 @pytest.fixture(scope="function")
 def noop_step_class() -> Type[Step]:
     class NoopStep(Step):
@@ -62,3 +79,80 @@ def centos_ssh_host():
         user="root", password="secret", port=22223,
         missing_host_key_policy=WarningPolicy
     )
+
+
+class _LocalSFTPHandle(paramiko.SFTPHandle):
+    readfile: IO[bytes]
+    writefile: IO[bytes]
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _LocalSFTP(paramiko.SFTPServerInterface):
+    # Local file system over SFTP protocol, paths are used as is
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(cast(int, ex.errno))
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(cast(int, ex.errno))
+        handle = _LocalSFTPHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, "r+b" if flags & (os.O_WRONLY | os.O_RDWR) else "rb")
+        return handle
+
+
+class _SFTPOnlyServer(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+
+@pytest.fixture(scope="session")
+def sftp_host_key():
+    return paramiko.RSAKey.generate(1024)
+
+
+@pytest.fixture(scope="function")
+def local_sftp(sftp_host_key):
+    """
+    SFTP-клиент к серверу в этом же процессе, отдающему локальную файловую систему
+    """
+    server_sock, client_sock = socket.socketpair()
+    server = paramiko.Transport(server_sock)
+    server.add_server_key(sftp_host_key)
+    server.set_subsystem_handler("sftp", paramiko.SFTPServer, _LocalSFTP)
+    server.start_server(event=threading.Event(), server=_SFTPOnlyServer())
+    client = paramiko.Transport(client_sock)
+    client.connect(username="test", password="test")
+    sftp = paramiko.SFTPClient.from_transport(client)
+    assert sftp is not None
+    yield sftp
+    sftp.close()
+    client.close()
+    server.close()
+
+
+@pytest.fixture(scope="function")
+def sftp_connection(local_sftp, mocker):
+    """
+    :py:class:`carnival.SshConnection`, файловые операции которого идут через :py:func:`local_sftp`
+    """
+    c = SshHost("192.0.2.1").connect()
+    c.conn = mocker.MagicMock()
+    c.sftp = local_sftp
+    yield c
+    c.sftp = None
+    c.conn = None
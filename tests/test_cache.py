@@ -0,0 +1,33 @@
+import hashlib
+import os
+
+from carnival import cache
+
+
+def test_file_hash_cache(tmp_path, mocker, carnival_cache_dir):
+    spy = mocker.spy(cache, "_file_sha1")
+
+    fpath = tmp_path / "artifact.bin"
+    fpath.write_bytes(b"hello")
+
+    hash_cache = cache.FileHashCache()
+    assert hash_cache.sha1(str(fpath)) == hashlib.sha1(b"hello").hexdigest()
+    assert hash_cache.sha1(str(fpath)) == hashlib.sha1(b"hello").hexdigest()
+    assert spy.call_count == 1
+
+    # Persisted between runs
+    hash_cache.flush()
+    assert cache.FileHashCache().sha1(str(fpath)) == hashlib.sha1(b"hello").hexdigest()
+    assert spy.call_count == 1
+
+    fpath.write_bytes(b"hello world")
+    assert hash_cache.sha1(str(fpath)) == hashlib.sha1(b"hello world").hexdigest()
+    assert spy.call_count == 2
+    hash_cache.flush()
+    assert [x.name for x in carnival_cache_dir.iterdir()] == ["file_hashes.json"]
+
+    # Restored mtime does not hide changed content
+    stat = fpath.stat()
+    fpath.write_bytes(b"HELLO WORLD")
+    os.utime(fpath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert hash_cache.sha1(str(fpath)) == hashlib.sha1(b"HELLO WORLD").hexdigest()
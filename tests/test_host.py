@@ -1,13 +1,294 @@
+import os
+import shlex
+import signal
+import stat
+import sys
+import tarfile
+import time
+from subprocess import TimeoutExpired
+
+import pytest
+
 from carnival import SshHost, LocalHost
+from carnival.hosts.base.result import CommandError
 
 
 def test_host_create():
     assert SshHost("1.2.3.4")
     assert LocalHost()
 
+    assert not SshHost("1.2.3.4").connect().use_session
+    connection = SshHost("1.2.3.4", pty=False, use_session=True).connect()
+    assert connection.use_session and not connection.pty
+
 
 def test_host_hash():
     h1 = SshHost("1.2.3.4")
     h2 = SshHost("1.2.3.4")
 
     assert h1.__hash__() == h2.__hash__()
+
+
+def test_ssh_connection_pool(mocker):
+    from carnival.hosts.ssh.pool import SshConnectionPool
+
+    pool = SshConnectionPool()
+    host = SshHost("1.2.3.4")
+    client = mocker.MagicMock()
+    client_close = client.close
+    client_is_active = client.get_transport.return_value.is_active
+    connect = mocker.patch.object(host.connect_config, "connect", return_value=client)
+
+    assert pool.get(host.connect_config) is client
+    assert pool.get(host.connect_config) is client
+    assert pool.get(SshHost("1.2.3.4").connect_config) is client
+    assert connect.call_count == 1
+
+    client_is_active.return_value = False
+    pool.get(host.connect_config)
+    assert connect.call_count == 2
+    assert client_close.call_count == 1
+
+    pool.close_all()
+    assert client_close.call_count == 2
+
+    # Last user closes connection
+    client_is_active.return_value = True
+    pool = SshConnectionPool()
+    assert pool.get(host.connect_config) is client
+    assert pool.get(host.connect_config) is client
+    pool.release(host.connect_config)
+    assert client_close.call_count == 2
+    pool.release(host.connect_config)
+    assert client_close.call_count == 3
+
+    # Inside keep_open connection lives until the end of the scope
+    with pool.keep_open():
+        pool.get(host.connect_config)
+        pool.release(host.connect_config)
+        assert client_close.call_count == 3
+    assert client_close.call_count == 4
+
+    # Different credentials do not share client
+    other = SshHost("1.2.3.4", password="other")
+    mocker.patch.object(other.connect_config, "connect", return_value=mocker.MagicMock())
+    assert pool.get(other.connect_config) is not pool.get(host.connect_config)
+
+
+def test_captured_output(mocker):
+    from carnival.hosts.base import result
+
+    mocker.patch.object(result, "capture_spill_size", 100)
+    mocker.patch.object(result, "capture_head_size", 10)
+    mocker.patch.object(result, "capture_tail_size", 10)
+
+    output = result.CapturedOutput()
+    for index in range(50):
+        output.write(f"{index:04}\n".encode())
+
+    assert output.size == 250
+    assert output._file is not None
+    assert output.head == b"0000\n0001\n"
+    assert output.tail == b"0048\n0049\n"
+    assert output.getvalue() == b"".join(f"{x:04}\n".encode() for x in range(50))
+    assert output.get_summary() == b"0000\n0001\n\n... 230 bytes skipped ...\n0048\n0049\n"
+
+    res = result.Result(return_code=0, stderr="", stdout=output, command="seq")
+    assert res.stdout.split("\n")[-1] == "0049"
+    assert res.stdout_bytes == output.getvalue()
+
+
+def test_local_shell_session():
+    with LocalHost().connect() as c:
+        c.use_session = True
+        commands = ["printf one", "echo two >&2; exit 3", "echo $X", "pwd"]
+        results = c.run_many(commands, warn=True, env={"X": "x y"}, cwd="/")
+        assert [r.stdout_bytes for r in results] == [b"one", b"", b"x y\n", b"/\n"]
+        assert results[1].stderr == "two"
+        assert [r.return_code for r in results] == [0, 3, 0, 0]
+        assert len(c._sessions) == 1
+    assert not c._sessions
+
+
+def test_local_interleaved_output():
+    # Both streams are far beyond pipe buffer, reading one of them only would block the command
+    script = "\n".join([
+        "import sys",
+        "for i in range(20000):",
+        "    sys.stdout.write(f'out {i:06}\\n' * 8)",
+        "    sys.stderr.write(f'err {i:06}\\n' * 8)",
+    ])
+    with LocalHost().connect() as c:
+        result = c.run(f"{sys.executable} -c {shlex.quote(script)}", timeout=60)
+    assert result.stdout_bytes == b"".join(f"out {i:06}\n".encode() * 8 for i in range(20000))
+    assert result.stderr_bytes == b"".join(f"err {i:06}\n".encode() * 8 for i in range(20000))
+
+
+def test_local_stream():
+    with LocalHost().connect() as c:
+        with c.stream("printf 'one\\ntwo\\r\\n'; echo err >&2; printf three") as stream:
+            assert list(stream) == ["one", "two", "three"]
+        assert stream.return_code == 0
+        assert stream.stderr.getvalue() == b"err\n"
+
+        # Leaving the context stops a command that is still running
+        started_at = time.monotonic()
+        with c.stream("while true; do echo line; done", timeout=60) as stream:
+            for index, line in enumerate(stream):
+                assert line == "line"
+                if index == 1000:
+                    break
+        assert time.monotonic() - started_at < 10
+        assert stream.return_code is None
+        assert stream.promise.is_done()
+
+        with pytest.raises(CommandError):
+            with c.stream("echo out; exit 3") as stream:
+                assert list(stream.chunks()) == [b"out\n"]
+        with c.stream("exit 3", warn=True) as stream:
+            assert not list(stream)
+        assert stream.return_code == 3
+
+
+@pytest.mark.parametrize("command,signals", [
+    ("sleep 5", ["-TERM"]),
+    ("trap '' TERM; sleep 5", ["-TERM", "-KILL"]),
+])
+def test_local_close_sudo(mocker, command, signals):
+    from carnival.hosts.local import result_promise
+
+    mocker.patch.object(result_promise, "CLOSE_TIMEOUT", 0.5)
+    promise = result_promise.LocalResultPromise(command, timeout=60, cwd=None, use_sudo=False)
+    # Process started by sudo belongs to root, it is signalled through `sudo kill`
+    promise.use_sudo = True
+    mocker.patch.object(promise.proc, "kill", side_effect=PermissionError)
+    sudo_kill = mocker.patch.object(
+        result_promise, "run",
+        side_effect=lambda args, **kwargs: os.kill(int(args[-1]), getattr(signal, f"SIG{args[-2][1:]}")),
+    )
+
+    time.sleep(0.1)
+    promise.close()
+    assert promise.proc.poll() is not None
+    assert [x.args[0][:4] for x in sudo_kill.call_args_list] == [["sudo", "-n", "kill", x] for x in signals]
+    assert promise.stdout.closed
+
+
+def test_local_binary_output():
+    # Not valid UTF-8, with \r\n and \0 that pty or decoding would change
+    stdout = bytes(range(256)) * 1024 + b"\r\n\xff"
+    stderr = b"\x80\x00err\r\n" * 1024
+    script = "\n".join([
+        "import sys",
+        "sys.stdout.buffer.write(bytes(range(256)) * 1024 + b'\\r\\n\\xff')",
+        "sys.stderr.buffer.write(b'\\x80\\x00err\\r\\n' * 1024)",
+    ])
+    with LocalHost().connect() as c:
+        result = c.run(f"{sys.executable} -c {shlex.quote(script)}", pty=False)
+    assert result.stdout_bytes == stdout
+    assert result.stderr_bytes == stderr
+
+
+def test_local_shell_session_errors():
+    with LocalHost().connect() as c:
+        c.use_session = True
+        # Failed command with output not ending in newline leaves session in sync
+        with pytest.raises(CommandError):
+            c.run("printf partial; printf partial >&2; exit 5")
+        session = c._sessions[False]
+        assert c.run("echo ok").stdout_bytes == b"ok\n"
+        assert c._sessions[False] is session
+
+        # Timed out command is still running, its session is dropped and next command gets a new one
+        with pytest.raises(TimeoutExpired):
+            c.run("sleep 5; echo late", timeout=1)
+        assert session.is_broken
+        assert c.run("echo after").stdout_bytes == b"after\n"
+        assert c._sessions[False] is not session
+
+
+@pytest.mark.parametrize("pipelining", [True, False])
+def test_sftp_file_stat_many(sftp_connection, tmp_path, mocker, pipelining):
+    from carnival.hosts.ssh import connection
+
+    mocker.patch.object(connection, "_sftp_pipelining", pipelining)
+    paths = []
+    for i in range(50):
+        (tmp_path / f"file{i}").write_bytes(b"x" * i)
+        paths += [str(tmp_path / f"file{i}"), str(tmp_path / f"missing{i}")]
+    paths.append(str(tmp_path))
+
+    stats = sftp_connection.file_stat_many(paths)
+    assert [x.st_size if x is not None else None for x in stats[:-1]] == [
+        x for i in range(50) for x in (i, None)
+    ]
+    assert stats[-1] is not None and stat.S_ISDIR(stats[-1].st_mode)
+    assert sftp_connection.exists_many(paths) == [x is not None for x in stats]
+    assert sftp_connection.file_stat_many([]) == []
+
+
+def test_sftp_file_stat_many_reordered(sftp_connection, mocker):
+    from paramiko.message import Message
+    from paramiko.sftp import CMD_ATTRS, CMD_STATUS
+    from paramiko.sftp_attr import SFTPAttributes
+
+    sizes = {"/a": 1, "/b": 2, "/c": 3}
+    requests = []
+
+    def async_request(collector, t, path):
+        requests.append((collector, path))
+        return len(requests)
+
+    def read_response():
+        # Server answers in reverse order
+        for num, (collector, path) in reversed(list(enumerate(requests, start=1))):
+            msg = Message()
+            if path in sizes:
+                attr = SFTPAttributes()
+                attr.st_size, attr.st_uid, attr.st_gid = sizes[path], 0, 0
+                attr.st_mode, attr.st_atime, attr.st_mtime = 0o100644, 0, 0
+                attr._pack(msg)  # type: ignore
+            msg.rewind()
+            collector._async_response(CMD_ATTRS if path in sizes else CMD_STATUS, msg, num)
+
+    sftp = mocker.Mock()
+    sftp._adjust_cwd.side_effect = lambda path: path
+    sftp._async_request.side_effect = async_request
+    sftp._read_response.side_effect = read_response
+    sftp._convert_status.side_effect = FileNotFoundError
+    sftp_connection.sftp = sftp
+
+    stats = sftp_connection.file_stat_many(["/a", "/missing", "/c", "/b"])
+    assert [x.st_size if x is not None else None for x in stats] == [1, None, 3, 2]
+    assert sftp._read_response.call_count == 1
+
+
+def test_sftp_file_read(sftp_connection, tmp_path, mocker):
+    from carnival.hosts.ssh import connection
+
+    mocker.patch.object(connection, "sftp_prefetch_window", 256 * 1024)
+    lines = [os.urandom(1000).replace(b"\n", b"") + b"\n" for _ in range(3000)]
+    data = b"".join(lines)
+    (tmp_path / "data").write_bytes(data)
+    prefetch = mocker.spy(connection._PrefetchReader, "_prefetch")
+
+    with sftp_connection.file_read(str(tmp_path / "data")) as reader:
+        assert reader.read(100) == data[:100]
+        assert reader.readline() == lines[0][100:]
+        assert reader.tell() == len(lines[0])
+        assert next(iter(reader)) == lines[1]
+        reader.seek(5)
+        assert reader.read() == data[5:]
+        assert reader.read(10) == b""
+    # Whole file is requested window by window, not at once
+    assert prefetch.call_count > len(data) // (256 * 1024)
+
+    with sftp_connection.file_read(str(tmp_path / "data"), offset=len(lines[0]), size=100) as reader:
+        assert reader.read(100) == lines[1][:100]
+
+    with tarfile.open(tmp_path / "data.tar", "w") as tar:
+        tar.add(tmp_path / "data", arcname="data")
+    with sftp_connection.file_read(str(tmp_path / "data.tar")) as reader:
+        with tarfile.open(fileobj=reader, mode="r:") as tar:
+            member = tar.extractfile("data")
+            assert member is not None and member.read() == data
@@ -0,0 +1,51 @@
+import sys
+
+import pytest
+
+from carnival import plugins
+
+
+@pytest.fixture
+def plugins_index(tmp_path, mocker):
+    mocker.patch("carnival.cache.carnival_cache_dir", str(tmp_path / "cache"))
+    mocker.patch("carnival.plugins.__plugins", None)
+    mocker.patch("carnival.plugins.__legacy_plugins", [])
+    entry_point = mocker.Mock(value="carnival_example.plugin:setup")
+    entry_point.name = "example"
+    mocker.patch("carnival.plugins._get_entry_points", return_value=[entry_point])
+
+
+def test_find_plugins(plugins_index, mocker):
+    scan = mocker.spy(plugins, "_scan_plugins")
+
+    found = plugins.find_plugins()
+    assert found["example"] == "carnival_example.plugin"
+    assert found["carnival"] == "carnival"
+
+    # Index is reused while installed packages are the same
+    mocker.patch("carnival.plugins.__plugins", None)
+    assert plugins.find_plugins() == found
+    assert scan.call_count == 1
+
+    mocker.patch("carnival.plugins.__plugins", None)
+    mocker.patch("carnival.plugins._get_environment_state", return_value="changed")
+    plugins.find_plugins()
+    assert scan.call_count == 2
+
+
+def test_legacy_plugins(plugins_index, tmp_path, mocker):
+    package = tmp_path / "site" / "carnival_legacy_example"
+    package.mkdir(parents=True)
+    (package / "__init__.py").write_text("imported = True\n")
+    mocker.patch.object(sys, "path", [str(tmp_path / "site"), *sys.path])
+    mocker.patch.dict(sys.modules)
+
+    assert plugins.find_plugins()["carnival_legacy_example"] == "carnival_legacy_example"
+    assert "carnival_legacy_example" not in sys.modules
+    plugins.import_legacy_plugins()
+    assert sys.modules["carnival_legacy_example"].imported
+
+    load_plugin = mocker.patch.object(plugins, "load_plugin")
+    with pytest.deprecated_call():
+        discovered = plugins.discover_plugins()
+    assert discovered["example"] == load_plugin.return_value
@@ -12,3 +12,24 @@ def test_step_abc(mocker):
     spy = mocker.spy(Step, 'validate')
     Step().validate(localhost_connection)  # type: ignore
     spy.assert_called_once()
+
+
+def test_validator_cache_concurrent():
+    from carnival.steps import _validator_cache
+    from carnival.steps.validators import InlineValidator
+    from carnival.utils import run_parallel
+
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return "error"
+
+    host = localhost_connection.host
+    results = run_parallel(
+        lambda _: _validator_cache.get_or_compute(InlineValidator, host, "concurrent-fact", compute),
+        list(range(16)),
+        workers=8,
+    )
+    assert results == ["error"] * 16
+    assert len(calls) == 1
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+import pytest
+
+from carnival import SshHost, localhost_connection
+from carnival.cache import file_hash_cache
+from carnival.contrib.steps._swarm import Swarm, get_swarm
+from carnival.contrib.steps.transfer import PutFile, _FileInfo
+from carnival.hosts.base.result import CommandError
+
+
+def test_swarm() -> None:
+    swarm = Swarm(seeds=1, fanout=2)
+    seed = SshHost("1.1.1.1")
+
+    # first host uploads from local, others have to wait for it
+    assert swarm.acquire() is None
+    swarm.add_peer(seed)
+    swarm.release(None)
+
+    assert swarm.acquire() is seed
+    assert swarm.acquire() is seed
+
+    # broken peer is not used anymore, fallback upload does not wait for peers
+    swarm.release(seed, ok=False)
+    assert swarm.acquire(peers=False) is None
+    swarm.release(None)
+    assert seed not in swarm._peers
+
+
+def test_swarm_remove_peer() -> None:
+    swarm = Swarm(seeds=1, fanout=2)
+    seed = SshHost("1.1.1.1")
+
+    assert swarm.acquire() is None
+    swarm.add_peer(seed)
+    swarm.release(None)
+    assert swarm.acquire() is seed
+
+    # Peer leaves only after running download is finished
+    leaving = threading.Thread(target=swarm.remove_peer, args=(seed,))
+    leaving.start()
+    time.sleep(0.05)
+    assert leaving.is_alive()
+    swarm.release(seed)
+    leaving.join(timeout=1)
+    assert not leaving.is_alive()
+
+    # Without peers hosts upload from local again instead of waiting forever
+    assert swarm.acquire() is None
+
+
+def test_put_file_failing_peer(tmp_path, mocker):
+    local_path = tmp_path / "file"
+    local_path.write_bytes(b"data")
+    remote_path = str(tmp_path / "remote")
+    step = PutFile(str(local_path), remote_path, distribute=True)
+    swarm = get_swarm(file_hash_cache.sha1(str(local_path)), remote_path, seeds=step.seeds, fanout=step.fanout)
+    peer = SshHost("1.1.1.1")
+    swarm.add_peer(peer)
+
+    mocker.patch.object(step, "_get_file_info", return_value=_FileInfo(user_id=0, group_id=0, exists=False))
+    pull = mocker.patch.object(step, "_pull_from_peer", side_effect=CommandError("ssh failed"))
+    upload = mocker.patch.object(step, "_upload")
+    commit = mocker.patch("carnival.contrib.steps.transfer.commit_files")
+
+    # Failed peer is not used anymore, file is uploaded from local
+    c = mocker.MagicMock(host=SshHost("2.2.2.2"))
+    step._run_distributed(c)
+    assert pull.call_args.args[1] is peer
+    commit.assert_called_once_with(c, [upload.return_value])
+    assert list(swarm._peers) == [c.host]
+
+    # Host error after successful download keeps peer
+    pull.side_effect = None
+    commit.side_effect = CommandError("mv failed")
+    with pytest.raises(CommandError):
+        step._run_distributed(mocker.MagicMock(host=SshHost("3.3.3.3")))
+    assert swarm._peers == {c.host: 0}
+
+
+@pytest.mark.parametrize("forward_agent", [False, True])
+def test_pull_from_peer(tmp_path, mocker, sftp_host_key, forward_agent):
+    data = b"image" * 1000
+    (tmp_path / "file").write_bytes(data)
+    # Peer copy of the file, fake ssh runs peer command locally and keeps known_hosts it was given
+    (tmp_path / "remote").write_bytes(data)
+    fake_ssh = tmp_path / "ssh"
+    fake_ssh.write_text("\n".join([
+        "#!/bin/sh",
+        "for a; do case \"$a\" in UserKnownHostsFile=*) f=\"${a#UserKnownHostsFile=}\";; esac; cmd=\"$a\"; done",
+        f"cp \"$f\" {tmp_path / 'known_hosts'}; echo \"$f\" > {tmp_path / 'known_hosts_path'}",
+        "exec sh -c \"$cmd\"",
+    ]))
+    fake_ssh.chmod(0o755)
+
+    step = PutFile(
+        str(tmp_path / "file"), str(tmp_path / "remote"),
+        distribute=True, peer_ssh_command=str(fake_ssh), peer_forward_agent=forward_agent,
+    )
+    peer = SshHost("192.0.2.10")
+    mocker.patch.object(peer, "connect").return_value.__enter__.return_value.get_host_key.return_value = sftp_host_key
+    c = mocker.MagicMock(use_sudo=False)
+    c.run_promise.side_effect = lambda command, **kwargs: localhost_connection.run_promise(command, use_sudo=False)
+
+    info = _FileInfo(user_id=0, group_id=0, exists=False)
+    staged = step._pull_from_peer(c, peer, file_hash_cache.sha1(str(tmp_path / "file")), info)
+    assert open(staged.upload_path, "rb").read() == data
+    assert c.run_promise.call_args.kwargs["forward_agent"] is forward_agent
+    # Peer key is pinned to the key local machine has seen
+    known_host = f"carnival-peer {sftp_host_key.get_name()} {sftp_host_key.get_base64()}\n"
+    assert (tmp_path / "known_hosts").read_text() == known_host
+    assert not os.path.exists((tmp_path / "known_hosts_path").read_text().strip())
+
+    with pytest.raises(IOError, match="sha1 mismatch"):
+        step._pull_from_peer(c, peer, "0" * 40, info)
@@ -63,3 +63,89 @@ def test_simple_task(noop_step, mocker):
 
     t.run()
     spy.assert_called()
+
+
+def test_task_forks():
+    seen_hosts = []
+
+    class ForksRole(Role):
+        pass
+
+    hosts = [LocalHost() for _ in range(5)]
+    for host in hosts:
+        ForksRole(host)
+
+    class RecordStep(Step):
+        def __init__(self, role):
+            self.role = role
+
+        def run(self, c):
+            assert c.host is self.role.host
+            seen_hosts.append(c.host)
+
+    class ForksTask(Task[ForksRole]):
+        def get_steps(self) -> typing.List[Step]:
+            return [RecordStep(self.role), ]
+
+    t = ForksTask(True, [], forks=3)
+    assert t.get_forks() == 3
+    t.run()
+    assert sorted(map(id, seen_hosts)) == sorted(map(id, hosts))
+    assert not hasattr(t, "role")
+
+    class SerialTask(ForksTask):
+        forks = 1
+
+    assert SerialTask(True, [], forks=3).get_forks() == 1
+
+
+def test_validate_tasks_forks():
+    import threading
+    import time
+
+    from carnival.task import TaskGroup, validate_tasks
+
+    lock = threading.Lock()
+    running = [0, 0]
+
+    class ValidateRole(Role):
+        pass
+
+    for _ in range(4):
+        ValidateRole(LocalHost())
+
+    class SlowStep(Step):
+        def __init__(self, role):
+            self.role = role
+
+        def validate(self, c):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return [f"error on {c.host}"]
+
+        def run(self, c):
+            pass
+
+    class FirstTask(Task[ValidateRole]):
+        def get_steps(self) -> typing.List[Step]:
+            return [SlowStep(self.role), ]
+
+    class SecondTask(FirstTask):
+        pass
+
+    class Group(TaskGroup):
+        tasks = [FirstTask, SecondTask]
+
+    assert not validate_tasks([Group(False, [], forks=3), FirstTask(False, [], forks=3)], forks=3)
+    # Hosts of all tasks share one pool
+    assert running[1] == 3
+
+    errors = Group(False, [], forks=3).get_validation_errors()
+    assert len(errors) == 8
+    assert errors[0].startswith("FirstTask -> ")
+    assert errors[-1].startswith("SecondTask -> ")
+    assert running[1] == 3
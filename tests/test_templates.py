@@ -1,4 +1,6 @@
-from jinja2 import Environment, DictLoader
+import gc
+
+from jinja2 import Environment, DictLoader, Template
 
 from carnival import templates
 
@@ -10,3 +12,86 @@ def test_render(mocker):
     )
     rendered = templates.render("index.html", name="world")
     assert rendered == "Hello: world"
+
+
+def test_lazy_j2_env(mocker, monkeypatch, tmp_path, carnival_cache_dir):
+    mocker.patch("carnival.templates.__j2_env", None)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "lazy.txt").write_text("{{ name | shout }} {{ greeting }}")
+
+    # Registering filters and globals at import time creates environment on first access
+    assert getattr(templates, "__j2_env") is None
+    templates.j2_env.filters["shout"] = lambda x: x.upper()
+    env = getattr(templates, "__j2_env")
+    assert env is not None
+    templates.j2_env.globals["greeting"] = "hi"
+    assert templates.get_j2_env() is env
+    assert "escape_yaml" in templates.j2_env.filters
+
+    assert templates.render("lazy.txt", name="world") == "WORLD hi"
+    assert getattr(templates, "__j2_env") is env
+    # Compiled template is stored in project cache
+    assert list((carnival_cache_dir / "jinja2").iterdir())
+
+
+def test_render_stream(mocker):
+    mocker.patch(
+        'carnival.templates.j2_env',
+        new=Environment(loader=DictLoader({"hosts": "{% for x in hosts %}{{ x }}\n{% endfor %}"})),
+    )
+    chunks = list(templates.render_stream("hosts", hosts=["a", "b"]))
+    assert len(chunks) > 1
+    assert "".join(chunks) == "a\nb\n"
+
+
+def test_render_cache(mocker):
+    class Item:
+        def __init__(self, name):
+            self.name = name
+
+    loader = DictLoader({"cached.txt": "{{ items|map(attribute='name')|join(',') }}"})
+    env = Environment(loader=loader)
+    mocker.patch('carnival.templates.j2_env', new=env)
+    compile_template = mocker.spy(env, "compile")
+    render = mocker.spy(Template, "render")
+    generate = mocker.spy(Template, "generate")
+
+    assert templates.render("cached.txt", items=[Item("a"), Item("b")]) == "a,b"
+    assert "".join(templates.render_stream("cached.txt", items=[Item("a"), Item("b")])) == "a,b"
+    assert render.call_count == 1
+    assert generate.call_count == 0
+    assert templates.render("cached.txt", items=[Item("a"), Item("c")]) == "a,c"
+    assert render.call_count == 2
+    # functions can not be compared, such contexts are rendered every time
+    assert templates.render("cached.txt", items=[], f=lambda: 1) == ""
+    assert templates.render("cached.txt", items=[], f=lambda: 1) == ""
+    assert render.call_count == 4
+    assert compile_template.call_count == 1
+
+
+def test_render_cache_dependencies(mocker):
+    sources = {
+        "page.txt": "{% extends 'base.txt' %}{% block body %}{{ name }}{% endblock %}",
+        "base.txt": "<{% block body %}{% endblock %}>{% include 'footer.txt' %}",
+        "footer.txt": "v1",
+        "dynamic.txt": "{% include name %}",
+    }
+    mocker.patch('carnival.templates.j2_env', new=Environment(loader=DictLoader(sources)))
+    render = mocker.spy(Template, "render")
+
+    assert templates.render("page.txt", name="a") == "<a>v1"
+    assert templates.render("page.txt", name="a") == "<a>v1"
+    assert render.call_count == 1
+    # Change of an included template invalidates templates that use it
+    sources["footer.txt"] = "v2"
+    assert templates.render("page.txt", name="a") == "<a>v2"
+    assert render.call_count == 2
+
+    # Included template is known only at render time
+    assert templates.render("dynamic.txt", name="footer.txt") == "v2"
+    assert templates.render("dynamic.txt", name="footer.txt") == "v2"
+    assert render.call_count == 4
+
+    # Locks of finished renders are not kept
+    gc.collect()
+    assert not len(templates.__dict__["__render_key_locks"])
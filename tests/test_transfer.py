@@ -0,0 +1,339 @@
+import os
+import pathlib
+import typing
+import zlib
+from hashlib import sha1
+
+import pytest
+
+from carnival import LocalHost, SshHost, localhost_connection
+from carnival.contrib.steps.transfer import (
+    GetFile,
+    GetFiles,
+    PutDir,
+    PutFile,
+    _get_delta_ops,
+    _get_local_manifest,
+    _get_remote_manifest,
+    commit_files,
+)
+from carnival.hosts.base.result import CommandError
+from carnival.utils import run_parallel
+
+
+def test_delta_ops() -> None:
+    block_size = 1024
+    remote = os.urandom(block_size * 8)
+    signatures = {}
+    for index in range(8):
+        block = remote[index * block_size:(index + 1) * block_size]
+        signatures[zlib.adler32(block)] = {sha1(block).digest(): index}
+
+    # insertion shifts blocks, rolling checksum must find them anyway
+    local = b"new" + remote[:block_size * 4] + b"changed" + remote[block_size * 5:]
+    ops = _get_delta_ops(local, block_size, signatures)
+    assert ops == [
+        (False, 0, 3),
+        (True, 0, block_size * 4),
+        (False, 3 + block_size * 4, 7),
+        (True, 5, block_size * 3),
+    ]
+
+
+def _hidden_files(path: pathlib.Path) -> typing.List[str]:
+    return sorted(x.name for x in path.iterdir() if x.name.startswith("."))
+
+
+def test_commit_files_failure(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "dst").mkdir()
+    (tmp_path / "src" / "a").write_bytes(b"a")
+    (tmp_path / "src" / "b").write_bytes(b"b")
+
+    staged = [
+        *PutFile(str(tmp_path / "src" / "a"), str(tmp_path / "dst" / "a")).stage(localhost_connection),
+        *PutFile(str(tmp_path / "src" / "b"), str(tmp_path / "dst" / "b")).stage(localhost_connection),
+    ]
+    assert len(_hidden_files(tmp_path / "dst")) == 2
+
+    # Second rename fails after first one is done
+    staged[1].dst_path = str(tmp_path / "missing" / "b")
+    with pytest.raises(CommandError):
+        commit_files(localhost_connection, staged)
+    assert not _hidden_files(tmp_path / "dst")
+    assert (tmp_path / "dst" / "a").read_bytes() == b"a"
+
+
+def test_upload_service_stage_failure(tmp_path, mocker):
+    from carnival.contrib.steps import docker_compose
+
+    mocker.patch("carnival.contrib.steps.docker_compose.systemd.Start")
+    for name in ("a", "b"):
+        (tmp_path / name).write_bytes(name.encode())
+
+    step = docker_compose.UploadService(
+        app_dir=str(tmp_path / "app"),
+        template_files=[],
+        template_context={},
+        static_files=[str(tmp_path / "a"), str(tmp_path / "b")],
+    )
+    mocker.patch.object(step.transfer_chain[1], "stage", side_effect=IOError("disk full"))
+    with pytest.raises(IOError, match="disk full"):
+        step.run(localhost_connection)
+    assert not list((tmp_path / "app").iterdir())
+
+
+def test_put_dir(tmp_path, mocker):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    (src / "sub").mkdir(parents=True)
+    (src / "a").write_bytes(b"aaaa")
+    (src / "sub" / "b c").write_bytes(b"b" * 100)
+    upload = mocker.spy(PutDir, "_upload")
+
+    PutDir(str(src), str(dst)).run(localhost_connection)
+    assert (dst / "a").read_bytes() == b"aaaa"
+    assert (dst / "sub" / "b c").read_bytes() == b"b" * 100
+
+    local_manifest = _get_local_manifest(str(src), checksum=True)
+    remote_manifest = _get_remote_manifest(localhost_connection, str(dst), checksum=True)
+    assert sorted(remote_manifest) == ["a", "sub/b c"]
+    assert remote_manifest == local_manifest
+    assert _get_remote_manifest(localhost_connection, str(tmp_path / "missing"), checksum=False) == {}
+
+    # Same size and mtime, changed content is found only by checksum
+    stat = os.stat(src / "a")
+    (src / "a").write_bytes(b"bbbb")
+    os.utime(src / "a", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    upload.reset_mock()
+    PutDir(str(src), str(dst)).run(localhost_connection)
+    upload.assert_not_called()
+    PutDir(str(src), str(dst), checksum=True).run(localhost_connection)
+    assert upload.call_args.args[2] == ["a"]
+    assert (dst / "a").read_bytes() == b"bbbb"
+
+    # Changed mtime is enough without checksum
+    os.utime(src / "sub" / "b c", (stat.st_atime, stat.st_mtime + 10))
+    upload.reset_mock()
+    PutDir(str(src), str(dst)).run(localhost_connection)
+    assert upload.call_args.args[2] == ["sub/b c"]
+
+    # Extraneous files are removed only with delete=True
+    (dst / "extra").write_bytes(b"")
+    (dst / "sub" / "extra 2").write_bytes(b"")
+    PutDir(str(src), str(dst)).run(localhost_connection)
+    assert (dst / "extra").exists()
+    PutDir(str(src), str(dst), delete=True).run(localhost_connection)
+    assert sorted(_get_remote_manifest(localhost_connection, str(dst), checksum=False)) == ["a", "sub/b c"]
+
+
+def test_compression_decision(mocker):
+    from carnival.contrib.steps import transfer
+
+    mocker.patch.object(transfer, "zstandard", None)
+    mocker.patch.dict(transfer._link_rates, clear=True)
+    c = mocker.MagicMock(host=SshHost("192.0.2.1"))
+    size = transfer._COMPRESSION_MIN_SIZE
+    text = b"carnival compression probe line\n" * 8192
+    noise = os.urandom(len(text))
+
+    assert transfer._get_compression(c, text, size) == "gzip"
+    assert transfer._get_compression(c, noise, size) is None
+    assert transfer._get_compression(c, text, size - 1) is None
+    assert transfer._get_compression(c, b"", size) is None
+    assert transfer._get_compression(localhost_connection, text, size) is None
+
+    # Compression does not pay off on a link faster than compression itself
+    transfer._link_rates[c.host] = 1024 ** 4
+    assert transfer._get_compression(c, text, size) is None
+    transfer._link_rates[c.host] = 1024 ** 2
+    assert transfer._get_compression(c, text, size) == "gzip"
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_compressed_transfer(tmp_path, mocker, compression):
+    from carnival.contrib.steps import transfer
+
+    mocker.patch.object(transfer, "_get_compression", return_value=compression)
+    compressor = mocker.spy(transfer, "_get_compressor")
+    decompressed = mocker.spy(transfer, "_remote_compressed_chunks")
+    # Compressible head and incompressible tail, size is not a multiple of block size
+    data = b"\0" * 300_000 + os.urandom(300_001)
+    (tmp_path / "src").write_bytes(data)
+
+    PutFile(str(tmp_path / "src"), str(tmp_path / "put"), bufsize=64 * 1024).run(localhost_connection)
+    assert (tmp_path / "put").read_bytes() == data
+    assert compressor.call_count == (compression is not None)
+
+    GetFile(str(tmp_path / "src"), str(tmp_path / "get"), bufsize=64 * 1024).run(localhost_connection)
+    assert (tmp_path / "get").read_bytes() == data
+    assert decompressed.call_count == (compression is not None)
+
+
+@pytest.mark.parametrize("prefix_matches", [True, False])
+def test_resume_transfer(tmp_path, mocker, prefix_matches):
+    from carnival.contrib.steps import transfer
+
+    data = os.urandom(300_001)
+    (tmp_path / "src").write_bytes(data)
+    source_key = sha1(data).hexdigest()
+    partial_path, _ = transfer._get_partial_path(str(tmp_path / "dst"), source_key)
+    prefix = data[:100_000] if prefix_matches else b"x" * 100_000
+    pathlib.Path(partial_path).write_bytes(prefix)
+    # Partial file of another source version is removed
+    stale_path, _ = transfer._get_partial_path(str(tmp_path / "dst"), "0" * 40)
+    pathlib.Path(stale_path).write_bytes(data[:10])
+    chunks = mocker.spy(transfer, "_local_file_chunks")
+
+    PutFile(str(tmp_path / "src"), str(tmp_path / "dst"), bufsize=64 * 1024).run(localhost_connection)
+    assert (tmp_path / "dst").read_bytes() == data
+    assert chunks.call_args.args[2] == (100_000 if prefix_matches else 0)
+    assert not _hidden_files(tmp_path)
+
+
+def test_remote_objects(tmp_path, mocker):
+    from carnival.contrib.steps import transfer
+
+    mocker.patch.object(transfer, "remote_objects_dir", str(tmp_path / "objects"))
+    transfer_file = mocker.spy(transfer, "_transfer_file")
+    data = os.urandom(100_000)
+    digest = sha1(data).hexdigest()
+    (tmp_path / "src").write_bytes(data)
+
+    PutFile(str(tmp_path / "src"), str(tmp_path / "a")).run(localhost_connection)
+    assert transfer_file.call_count == 1
+    assert (tmp_path / "objects" / digest[:2] / digest).read_bytes() == data
+
+    # Identical object is copied on the host instead of transferred
+    PutFile(str(tmp_path / "src"), str(tmp_path / "b" / "c"), chmod="600").run(localhost_connection)
+    assert transfer_file.call_count == 1
+    assert (tmp_path / "b" / "c").read_bytes() == data
+    assert os.stat(tmp_path / "b" / "c").st_mode & 0o777 == 0o600
+
+    # Destination is a copy, changing it keeps stored object intact
+    (tmp_path / "b" / "c").write_bytes(b"changed")
+    assert (tmp_path / "objects" / digest[:2] / digest).read_bytes() == data
+    assert os.stat(tmp_path / "objects" / digest[:2] / digest).st_mode & 0o777 != 0o600
+    assert not _hidden_files(tmp_path / "b")
+
+
+class _NamedLocalHost(LocalHost):
+    def __init__(self, addr: str) -> None:
+        super().__init__()
+        self.addr = addr
+
+
+def test_get_files(tmp_path, mocker):
+    from carnival.contrib.steps import transfer
+
+    mocker.patch.dict(transfer._link_rates, clear=True)
+    data = os.urandom(transfer.DEFAULT_BUFSIZE * 2 + 1)
+    (tmp_path / "src").write_bytes(data)
+    hosts = [_NamedLocalHost("web-1"), _NamedLocalHost("web-2"), _NamedLocalHost("web-3")]
+    # Only {host} is substituted, other braces are part of the path
+    step = GetFiles(str(tmp_path / "src"), str(tmp_path / "logs" / "{host}" / "app{1}.log"), max_transfers=2)
+
+    def download(host: LocalHost) -> None:
+        with host.connect() as c:
+            step.run(c)
+
+    run_parallel(download, hosts, workers=len(hosts))
+    for host in hosts:
+        assert (tmp_path / "logs" / host.addr / "app{1}.log").read_bytes() == data
+    # Link speed belongs to remote host, not to the local writer
+    assert sorted(x.addr for x in transfer._link_rates) == ["web-1", "web-2", "web-3"]
+
+    with pytest.raises(ValueError):
+        GetFiles(str(tmp_path / "src"), str(tmp_path / "app.log"))
+
+
+def test_sudo_transfer(tmp_path, mocker, monkeypatch):
+    # Fake sudo runs command as is and logs it
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "sudo").write_text(f'#!/bin/sh\nshift 2\necho "$3" >> {tmp_path / "sudo.log"}\nexec "$@"\n')
+    (bin_dir / "sudo").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    (tmp_path / "tmp").mkdir()
+    data = os.urandom(300_001)
+    (tmp_path / "src").write_bytes(data)
+
+    with LocalHost().connect() as c:
+        c.use_sudo = True
+        c.tempdir = str(tmp_path / "tmp")
+        file_write = mocker.spy(c, "file_write")
+        PutFile(str(tmp_path / "src"), str(tmp_path / "dst" / "file")).run(c)
+
+    assert (tmp_path / "dst" / "file").read_bytes() == data
+    # Written under sudo next to destination, not through SFTP and tempdir
+    file_write.assert_not_called()
+    assert not list((tmp_path / "tmp").iterdir())
+    assert not _hidden_files(tmp_path / "dst")
+    sudo_commands = (tmp_path / "sudo.log").read_text().splitlines()
+    assert any(x.startswith(f'cat > "{tmp_path / "dst"}/.file.carnival.') for x in sudo_commands)
+
+
+def test_remote_objects_copy_failure(tmp_path, mocker):
+    from carnival.contrib.steps import transfer
+
+    mocker.patch.object(transfer, "remote_objects_dir", str(tmp_path / "objects"))
+    data = os.urandom(100_000)
+    (tmp_path / "src").write_bytes(data)
+    PutFile(str(tmp_path / "src"), str(tmp_path / "a")).run(localhost_connection)
+    object_path = transfer._get_object_path(sha1(data).hexdigest())
+
+    # Object exists, but can not be copied: copy is left half done and file is transferred instead
+    copy_command = transfer._copy_command
+
+    def failing_copy_command(src, dst):
+        return f"{copy_command(src, dst)} && false" if src == object_path else copy_command(src, dst)
+
+    mocker.patch.object(transfer, "_copy_command", side_effect=failing_copy_command)
+    transfer_file = mocker.spy(transfer, "_transfer_file")
+    PutFile(str(tmp_path / "src"), str(tmp_path / "b" / "c")).run(localhost_connection)
+    assert transfer_file.call_count == 1
+    assert (tmp_path / "b" / "c").read_bytes() == data
+    assert not _hidden_files(tmp_path / "b")
+
+
+def test_compressed_download_wire_size(tmp_path, mocker):
+    from carnival.contrib.steps import transfer
+
+    mocker.patch.object(transfer, "_get_compression", return_value="gzip")
+    transfer_file = mocker.spy(transfer, "_transfer_file")
+    (tmp_path / "src").write_bytes(b"\0" * 2_000_000 + os.urandom(100_000))
+
+    GetFile(str(tmp_path / "src"), str(tmp_path / "get")).run(localhost_connection)
+    # Link speed is measured by bytes that went through the link
+    packed_size = int(localhost_connection.run(f'gzip -c -1 < "{tmp_path / "src"}" | wc -c').stdout)
+    assert transfer_file.call_args.kwargs["get_wire_size"]() == packed_size
+
+
+def test_ranges_transfer(tmp_path, mocker):
+    from carnival.contrib.steps import transfer
+
+    # Ranges are used for ssh hosts only, let local host pass for one
+    mocker.patch.object(transfer, "SshHost", LocalHost)
+    mocker.patch.object(transfer, "_get_compression", return_value=None)
+    mocker.patch.object(transfer, "_RANGES_MIN_SIZE", 1024)
+    transfer_ranges = mocker.spy(transfer, "_transfer_ranges")
+    data = os.urandom(1_000_003)
+    (tmp_path / "src").write_bytes(data)
+    (tmp_path / "dst").mkdir()
+
+    PutFile(str(tmp_path / "src"), str(tmp_path / "dst" / "put"), bufsize=64 * 1024, channels=3).run(
+        localhost_connection,
+    )
+    GetFile(str(tmp_path / "src"), str(tmp_path / "dst" / "get"), bufsize=64 * 1024, channels=3).run(
+        localhost_connection,
+    )
+    assert transfer_ranges.call_count == 2
+    assert (tmp_path / "dst" / "put").read_bytes() == data
+    assert (tmp_path / "dst" / "get").read_bytes() == data
+
+    # Damaged result is not kept for resume
+    mocker.patch.object(transfer, "_get_file_sha1", return_value="0" * 40)
+    with pytest.raises(IOError, match="sha1 mismatch"):
+        PutFile(str(tmp_path / "src"), str(tmp_path / "dst" / "bad"), channels=3).run(localhost_connection)
+    assert transfer_ranges.call_count == 3
+    assert not (tmp_path / "dst" / "bad").exists()
+    assert not _hidden_files(tmp_path / "dst")
@@ -0,0 +1,24 @@
+import time
+
+import pytest
+
+from carnival.utils import run_parallel
+
+
+def test_run_parallel_order():
+    def slow_square(x):
+        time.sleep((5 - x) * 0.01)
+        return x * x
+
+    assert run_parallel(slow_square, [1, 2, 3, 4], workers=4) == [1, 4, 9, 16]
+    assert run_parallel(slow_square, [1, 2, 3, 4], workers=1) == [1, 4, 9, 16]
+
+
+def test_run_parallel_error():
+    def fail(x):
+        if x == 2:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        run_parallel(fail, [1, 2, 3], workers=2)